@@ -0,0 +1,172 @@
+
+# alerts.py
+
+import json
+import time
+
+class AlertRule:
+    """
+    Threshold rule for one metric of a VitalsReading.
+
+    The rule is breached when the value goes above high or below low. It fires once
+    the breach has lasted min_duration seconds, and does not fire again until the
+    value is back inside the band shrunk by hysteresis on each side.
+
+    Parameters:
+        metric (str): VitalsReading attribute (heart_rate, systolic, diastolic, spo2,
+            glucose, battery_level).
+        alert_type (str): alert_type sent to the backend.
+        low (float): Lower bound, or None.
+        high (float): Upper bound, or None.
+        hysteresis (float): How far back inside the bounds the value must go to clear.
+        min_duration (float): Seconds the breach must last before the alert fires.
+        worn_only (bool): Ignore readings taken while the watch is not worn.
+        low_text (str): Message template for a low value ({value} is substituted).
+        high_text (str): Message template for a high value.
+    """
+
+    __slots__ = ("metric", "alert_type", "low", "high", "hysteresis", "min_duration", "worn_only",
+                 "low_text", "high_text")
+
+    def __init__(self, metric, alert_type=None, low=None, high=None, hysteresis=0.0, min_duration=0.0,
+                 worn_only=True, low_text=None, high_text=None):
+        self.metric = metric
+        self.alert_type = alert_type or metric
+        self.low = low
+        self.high = high
+        self.hysteresis = hysteresis
+        self.min_duration = min_duration
+        self.worn_only = worn_only
+        self.low_text = low_text or f"{metric} is too low: {{value}}"
+        self.high_text = high_text or f"{metric} is too high: {{value}}"
+
+    @classmethod
+    def from_dict(cls, config):
+        return cls(**config)
+
+    def breach(self, value):
+        """Return "low", "high" or None."""
+        if self.low is not None and value < self.low:
+            return "low"
+        if self.high is not None and value > self.high:
+            return "high"
+        return None
+
+    def cleared(self, value):
+        if self.low is not None and value < self.low + self.hysteresis:
+            return False
+        if self.high is not None and value > self.high - self.hysteresis:
+            return False
+        return True
+
+# Vital limits the gateway always alerted on; the poll scheduler uses the same ones
+HEART_RATE_LOW = 84
+HEART_RATE_HIGH = 100
+SPO2_LOW = 92
+
+# Defaults: the heart-rate and battery thresholds the gateway always used, plus SpO2 and
+# blood pressure. Like before, heart rate alerts whether or not the watch is classified
+# as worn. Glucose is supported but has no default, since its unit depends on the watch
+# firmware; add a rule for it through load_rules or set_device_rules.
+DEFAULT_RULES = [
+    AlertRule("heart_rate", low=HEART_RATE_LOW, high=HEART_RATE_HIGH, hysteresis=3, min_duration=0, worn_only=False,
+              low_text="Heart rate is too low: {value}", high_text="Heart rate is too high: {value}"),
+    AlertRule("battery_level", low=20, hysteresis=5, worn_only=False,
+              low_text="Battery level is low: {value}%"),
+    AlertRule("spo2", "blood_oxygen", low=SPO2_LOW, hysteresis=2, min_duration=60,
+              low_text="Blood oxygen is too low: {value}%"),
+    AlertRule("systolic", "blood_pressure", low=90, high=140, hysteresis=5, min_duration=60,
+              low_text="Systolic blood pressure is too low: {value}", high_text="Systolic blood pressure is too high: {value}"),
+    AlertRule("diastolic", "blood_pressure", low=60, high=90, hysteresis=5, min_duration=60,
+              low_text="Diastolic blood pressure is too low: {value}", high_text="Diastolic blood pressure is too high: {value}"),
+]
+
+def load_rules(path):
+    """
+    Load rules from a JSON file: a list of AlertRule keyword dicts.
+
+    Returns:
+        list: AlertRule objects.
+    """
+    with open(path) as f:
+        return [AlertRule.from_dict(config) for config in json.load(f)]
+
+class _RuleState:
+    __slots__ = ("active", "since")
+
+    def __init__(self):
+        self.active = None  # "low" or "high" while the alert is raised
+        self.since = None
+
+class AlertEngine:
+    """
+    Evaluates alert rules incrementally, one reading at a time, without any I/O.
+
+    Each (watch, rule) pair keeps whether its alert is active and since when its
+    condition has held, so a watch reporting the same out-of-range value every poll
+    raises one alert, not one per reading.
+    """
+
+    def __init__(self, rules=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.device_rules = {}
+        self._states = {}
+
+    def set_device_rules(self, address, rules):
+        """Use these rules instead of the defaults for one watch (None restores the defaults)."""
+        if rules is None:
+            self.device_rules.pop(address, None)
+        else:
+            self.device_rules[address] = list(rules)
+        self._states.pop(address, None)
+
+    def forget(self, address):
+        self._states.pop(address, None)
+
+    def evaluate(self, address, reading, now=None):
+        """
+        Update rule state with a reading and return the alerts that should be sent.
+
+        Parameters:
+            address (str): The watch address.
+            reading (VitalsReading): The decoded reading.
+            now (float): Timestamp of the reading, defaults to time.monotonic().
+
+        Returns:
+            list: (alert_type, alert_text) tuples for newly raised alerts.
+        """
+        now = time.monotonic() if now is None else now
+        rules = self.device_rules.get(address, self.rules)
+        states = self._states.get(address)
+        if states is None or len(states) != len(rules):
+            states = self._states[address] = [_RuleState() for _ in rules]
+        not_worn = reading.watch_status == "Not Worn"
+
+        alerts = []
+        for rule, state in zip(rules, states):
+            value = getattr(reading, rule.metric, None)
+            if value is None or (rule.worn_only and not_worn):
+                continue
+            side = rule.breach(value)
+            if state.active is not None:
+                if rule.cleared(value):
+                    state.active = None
+                    state.since = None
+                # Still raised on the same side: suppress the repeat
+                if side is None or side == state.active:
+                    continue
+                state.active = None
+                state.since = None
+            if side is None:
+                state.since = None
+                continue
+            if state.since is None:
+                state.since = now
+            if now - state.since >= rule.min_duration:
+                state.active = side
+                template = rule.high_text if side == "high" else rule.low_text
+                alerts.append((rule.alert_type, template.format(value=value)))
+        return alerts
+
+# Engine shared by every watch on this gateway
+default_engine = AlertEngine()
@@ -1,32 +1,54 @@
 import requests
-import subprocess  # To fetch the MAC address
+import threading
+import time
+import metrics
+import logs
+from uploader import VitalsUploader, make_session, DEFAULT_TIMEOUT
+from outbox import Outbox, OutboxReplayer
+from upload_filter import UploadFilter
 
 # Backend API URLs
 vital_url = "http://51.20.63.166:8000/api/v1/fbd-device/vitals"
 alert_url = "http://51.20.63.166:8000/api/v1/fbd-device/alerts"
 
-# Function to fetch the host machine's MAC address
-def get_host_machine_mac():
-    try:
-        result = subprocess.run(['ifconfig'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        output = result.stdout
-        for line in output.split("\n"):
-            if "ether" in line:
-                return line.split()[1]
-        return None
-    except Exception as e:
-        print(f"Error fetching MAC address: {e}")
-        return None
-
-# Function to send vital data to the backend
-def send_data_to_backend(parsed_data, client, smartwatch_mac_address, host_mac_address):
-    # Extract the heart rate, battery level, and other data from the parsed data
-    heart_rate = parsed_data.get("Heart Rate", "")
+# Timeout for every backend request: (connect, read) in seconds
+REQUEST_TIMEOUT = DEFAULT_TIMEOUT
+
+# Local outbox every payload is written to before it is sent
+outbox_path = "outbox.db"
+
+# Suppresses unchanged readings between heartbeats (delta encoding stays off until the
+# backend supports it)
+upload_filter = UploadFilter(heartbeat_interval=300.0, send_deltas=False)
+
+log = logs.get_logger("back")
+
+# When set, queued payloads are handed to payload_sink(kind, payload, received_at)
+# instead of the local outbox and uploaders (sharding workers forward them to the
+# coordinator's single uploader this way)
+payload_sink = None
+
+_outbox = None
+_replayer = None
+_uploaders = {}
+_delivery_lock = threading.Lock()
+_local = threading.local()
+
+# Keep-alive session for the calling thread (sessions are not shared between threads)
+def get_session():
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = _local.session = make_session()
+    return session
+
+def _url_for(kind):
+    return vital_url if kind == "vitals" else alert_url
+
+# Build the JSON payload the vitals endpoint expects from parsed data
+def build_vitals_payload(parsed_data, smartwatch_mac_address, host_mac_address):
     battery_level = parsed_data.get("Battery Level", "")
-    
-    # Prepare the payload with the extracted values
-    payload = {
-        "heart_rate": heart_rate,
+    return {
+        "heart_rate": parsed_data.get("Heart Rate", ""),
         "blood_pressure": parsed_data.get("Blood Pressure", ""),
         "spo2": parsed_data.get("Blood Oxygen", ""),
         "device_id": parsed_data.get("1", 12345),
@@ -38,26 +60,120 @@ def send_data_to_backend(parsed_data, client, smartwatch_mac_address, host_mac_a
         "watch_status": parsed_data.get("Watch Status", ""),
     }
 
-    print("Sending vital data with payload:", payload)
-    headers = {"Content-Type": "application/json"}
+# Called by the uploaders and, through _replay_payload, the replayer once the backend
+# accepted a payload. The backend applies payloads in the order they arrive, so the last
+# one delivered, replayed or not, is the base later deltas are computed against.
+def _on_delivered(kind, payload, key):
+    if key:
+        get_outbox().ack(key)
+    if kind == "vitals":
+        upload_filter.acknowledge(payload)
+    else:
+        log.info("Alert sent successfully: %s", payload["alert_type"],
+                 extra={"device": payload.get("smartwatch_mac_address")})
+
+# Post one payload synchronously, tagged with its idempotency key
+def post_payload(kind, payload, key=None):
+    headers = {"Idempotency-Key": key} if key else None
+    start = time.perf_counter()
     try:
-        response = requests.post(vital_url, json=payload, headers=headers, verify=False)
+        response = get_session().post(_url_for(kind), json=payload, headers=headers, timeout=REQUEST_TIMEOUT)
         if response.status_code in [200, 201]:
-            print("Vital data sent successfully.")
-            # Check heart rate and battery levels for alerts
-            if isinstance(heart_rate, (int, float)) and (heart_rate > 100 or heart_rate < 84):
-                alert_text = f"Heart rate is {'too high' if heart_rate > 100 else 'too low'}: {heart_rate}"
-                send_alert2(smartwatch_mac_address, host_mac_address, "heart_rate", alert_text)
-            if isinstance(battery_level, int) and battery_level < 20:
-                alert_text = f"Battery level is low: {battery_level}%"
-                send_alert2(smartwatch_mac_address, host_mac_address, "battery_level", alert_text)
             return True
-        else:
-            print(f"Failed to send data. Status: {response.status_code}, Response: {response.text}")
-            return False
+        metrics.backend_post_failures.inc((kind, "status"))
+        log.warning("Failed to send %s. Status: %s, Response: %s", kind, response.status_code, response.text)
+        return False
     except requests.exceptions.RequestException as e:
-        print(f"Error sending data: {e}")
+        metrics.backend_post_failures.inc((kind, "error"))
+        log.warning("Error sending %s: %s", kind, e)
+        return False
+    finally:
+        metrics.backend_post_seconds.observe(time.perf_counter() - start, (kind,))
+
+# Send function of the outbox replayer (it acks the outbox entry itself)
+def _replay_payload(kind, payload, key):
+    if not post_payload(kind, payload, key):
         return False
+    _on_delivered(kind, payload, None)
+    return True
+
+# Shared outbox and replayer, created on first use
+def get_outbox():
+    global _outbox, _replayer
+    with _delivery_lock:
+        if _outbox is None:
+            _outbox = Outbox(outbox_path).start()
+            _replayer = OutboxReplayer(_outbox, _replay_payload).start()
+        return _outbox
+
+# Shared background uploader per kind ("vitals" or "alerts"), created on first use
+def get_uploader(kind="vitals"):
+    get_outbox()
+    with _delivery_lock:
+        uploader = _uploaders.get(kind)
+        if uploader is None:
+            options = {} if kind == "vitals" else {"batch_size": 1, "workers": 1}
+            uploader = VitalsUploader(_url_for(kind), name=kind, **options,
+                                      on_sent=lambda payload, key: _on_delivered(kind, payload, key))
+            _uploaders[kind] = uploader.start()
+        return uploader
+
+# Stop the uploaders and replayer, committing whatever is still in the outbox
+def stop_delivery(timeout=5):
+    global _outbox, _replayer
+    with _delivery_lock:
+        uploaders = list(_uploaders.values())
+        _uploaders.clear()
+        outbox, replayer = _outbox, _replayer
+        _outbox = _replayer = None
+    for uploader in uploaders:
+        uploader.stop(timeout)
+    if replayer:
+        replayer.stop(timeout)
+    if outbox:
+        outbox.close(timeout)
+
+# Record a payload in the outbox, then hand it to the live uploader
+# received_at is the time.monotonic() of the notification that produced the payload
+def queue_payload(kind, payload, received_at=None):
+    if payload_sink is not None:
+        return payload_sink(kind, payload, received_at)
+    key = get_outbox().append(kind, payload)
+    return get_uploader(kind).submit(payload, key, received_at)
+
+# Upload queue depth per kind, read when /metrics is scraped
+def _queue_depths():
+    return {(kind,): uploader.depth() for kind, uploader in list(_uploaders.items())}
+
+# Payloads in the outbox not yet acknowledged by the backend
+def _outbox_pending():
+    outbox = _outbox
+    return outbox.pending_count() if outbox is not None else 0
+
+metrics.Gauge("gateway_upload_queue_depth", "Payloads waiting in the live upload queue.", _queue_depths, ("kind",))
+metrics.Gauge("gateway_outbox_pending", "Payloads in the outbox not yet acknowledged.", _outbox_pending)
+
+# Function to queue vital data for the backend without blocking the BLE event loop
+def queue_data_for_backend(parsed_data, smartwatch_mac_address, host_mac_address, received_at=None):
+    payload = upload_filter.filter(build_vitals_payload(parsed_data, smartwatch_mac_address, host_mac_address))
+    if payload is None:
+        return True  # Unchanged since the last upload and no heartbeat due
+    log.debug("Queueing vital data: %s", payload, extra={"device": smartwatch_mac_address})
+    return queue_payload("vitals", payload, received_at)
+
+# Function to send vital data to the backend (blocking; prefer queue_data_for_backend)
+def send_data_to_backend(parsed_data, client, smartwatch_mac_address, host_mac_address):
+    payload = build_vitals_payload(parsed_data, smartwatch_mac_address, host_mac_address)
+
+    log.debug("Sending vital data: %s", payload, extra={"device": smartwatch_mac_address})
+    outbox = get_outbox()
+    key = outbox.append("vitals", payload)
+    if post_payload("vitals", payload, key):
+        log.debug("Vital data sent successfully.", extra={"device": smartwatch_mac_address})
+        outbox.ack(key)
+        return True
+    # The payload stays in the outbox and is replayed once the backend recovers
+    return False
 
 # Function to send an alert
 def send_alert1(smartwatch_mac_address, host_mac_address, alert_type1, alert_text1):
@@ -67,32 +183,16 @@ def send_alert1(smartwatch_mac_address, host_mac_address, alert_type1, alert_tex
         "smartwatch_mac_address": smartwatch_mac_address,
         "fbd_mac_address": host_mac_address,
     }
-    print("Sending Alert1 with payload:", payload)
-    headers = {"Content-Type": "application/json"}
-    try:
-        response = requests.post(alert_url, json=payload, headers=headers, verify=False)
-        if response.status_code in [200, 201]:
-            print("Alert1 sent successfully.")
-        else:
-            print(f"Failed to send alert. Status: {response.status_code}, Response: {response.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending alert: {e}")
+    log.info("Queueing alert: %s", payload, extra={"device": smartwatch_mac_address})
+    queue_payload("alerts", payload)
 
 # Function to send an alert for battery level or heart rate
-def send_alert2(smartwatch_mac_address, host_mac_address, alert_type2, alert_text2):
+def send_alert2(smartwatch_mac_address, host_mac_address, alert_type2, alert_text2, received_at=None):
     payload = {
         "alert_type": alert_type2,
         "alert_text": alert_text2,
         "smartwatch_mac_address": smartwatch_mac_address,
         "fbd_mac_address": host_mac_address,
     }
-    print("Sending Alert2 with payload:", payload)
-    headers = {"Content-Type": "application/json"}
-    try:
-        response = requests.post(alert_url, json=payload, headers=headers, verify=False)
-        if response.status_code in [200, 201]:
-            print("Alert2 sent successfully.")
-        else:
-            print(f"Failed to send alert. Status: {response.status_code}, Response: {response.text}")
-    except requests.exceptions.RequestException as e:
-        print(f"Error sending alert: {e}")
+    log.info("Queueing alert: %s", payload, extra={"device": smartwatch_mac_address})
+    queue_payload("alerts", payload, received_at)
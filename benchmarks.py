@@ -0,0 +1,303 @@
+
+# benchmarks.py
+#
+# Reproducible benchmarks for the gateway hot paths. Results are written as JSON so
+# two runs (e.g. two releases) can be compared with --compare.
+#
+#   python benchmarks.py --output before.json
+#   python benchmarks.py --output after.json --compare before.json
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import crc_utils
+import columnar
+import frames
+import currentdata
+import back
+import logs
+from reassembly import FrameReassembler
+from router import NotificationRouter
+from scheduler import PollScheduler
+from simulator import SimulatedWatch
+from standin_backend import StandinBackend
+from uploader import VitalsUploader
+
+WATCH_ADDRESS = "C0:FF:EE:00:00:01"
+HOST_ADDRESS = "00:11:22:33:44:55"
+
+class _IdleClient:
+    """Connected client whose writes go nowhere; the benchmark feeds frames directly."""
+
+    is_connected = True
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        pass
+
+    async def start_notify(self, char_uuid, callback, **kwargs):
+        pass
+
+    async def stop_notify(self, char_uuid):
+        pass
+
+def _time(function, number, repeat):
+    """Best-of-repeat time per call, in microseconds."""
+    best = min(timeit.Timer(function).repeat(repeat=repeat, number=number))
+    return round(best / number * 1e6, 3)
+
+def micro_benchmarks(number=20000, repeat=5):
+    vitals_frame = frames.build_vitals_frame(72, 120, 80, 98, 5)
+    battery_frame = frames.build_frame(frames.OPCODE_BATTERY, b"\x00\x50")
+    vitals_hex = vitals_frame.hex().upper()
+    battery_hex = battery_frame.hex().upper()
+    data, crc_hex = vitals_frame[:-2], vitals_hex[-4:]
+    payload_source = frames.decode_vitals(vitals_frame).as_dict()
+    payload_source["Battery Level"] = 80
+    payload_source["Watch Status"] = "Worn"
+
+    reassembler = FrameReassembler(lambda sender, frame: None)
+    fragments = (vitals_frame[:20], vitals_frame[20:])
+    coalesced = vitals_frame + battery_frame
+
+    def feed_fragments():
+        for fragment in fragments:
+            reassembler.feed(fragment)
+
+    cases = {
+        "crc16_bitwise": lambda: crc_utils.crc16_bitwise(data, 0, len(data)),
+        "crc16": lambda: crc_utils.crc16(data, 0, len(data)),
+        "verify_crc": lambda: crc_utils.verify_crc(data, crc_hex),
+        "verify_frame": lambda: crc_utils.verify_frame(vitals_frame),
+        "parse_watch_data_with_crc": lambda: currentdata.parse_watch_data_with_crc(vitals_hex),
+        "decode_vitals": lambda: frames.decode_vitals(vitals_frame),
+        "parse_battery_data": lambda: currentdata.parse_battery_data(battery_hex),
+        "decode_battery": lambda: frames.decode_battery(battery_frame),
+        "reassemble_whole_frame": lambda: reassembler.feed(vitals_frame),
+        "reassemble_two_fragments": feed_fragments,
+        "reassemble_two_coalesced": lambda: reassembler.feed(coalesced),
+        "build_vitals_payload": lambda: back.build_vitals_payload(payload_source, WATCH_ADDRESS, HOST_ADDRESS),
+    }
+    return {name: {"us_per_call": _time(case, number, repeat)} for name, case in cases.items()}
+
+async def _capture_handlers():
+    """Start fetch_current_data against an idle client and return its registered handlers."""
+    client = _IdleClient()
+    router = NotificationRouter(client, "notify")
+    scheduler = PollScheduler(normal_interval=3600, fast_interval=3600, slow_interval=3600)
+    task = asyncio.create_task(currentdata.fetch_current_data(
+        client, "write", "notify", WATCH_ADDRESS, HOST_ADDRESS, router=router, scheduler=scheduler))
+    while frames.OPCODE_VITALS not in router.handlers:
+        await asyncio.sleep(0)
+    return task, router
+
+def throughput(frame_count=20000):
+    """
+    Frames per second through the whole decode -> decide -> enqueue path: the real
+    notification handler, with uploads going to a local stand-in backend.
+
+    The vitals uploader's workers are only started after the timed section: while
+    they post, they compete with the handler for the GIL and the figure would
+    measure the machine's thread scheduling rather than the per-frame path.
+    """
+    watch = SimulatedWatch(WATCH_ADDRESS)
+    notifications = [bytearray(frames.build_vitals_frame(*watch.next_vitals())) for _ in range(frame_count)]
+    outbox_dir = tempfile.mkdtemp(prefix="gateway-bench-")
+
+    async def run():
+        task, router = await _capture_handlers()
+        start = time.perf_counter()
+        for notification in notifications:
+            router.dispatch(None, notification)
+        elapsed = time.perf_counter() - start
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        return elapsed
+
+    with StandinBackend() as backend, open(os.devnull, "w") as devnull:
+        # The default logging setup (INFO, per-frame DEBUG lines off), written nowhere
+        logs.configure(stream=devnull)
+        back.vital_url = backend.url("/vitals")
+        back.alert_url = backend.url("/alerts")
+        back.outbox_path = os.path.join(outbox_dir, "outbox.db")
+        back.get_outbox()
+        uploader = back._uploaders["vitals"] = VitalsUploader(
+            back.vital_url, max_queue=frame_count + 1,
+            on_sent=lambda payload, key: back._on_delivered("vitals", payload, key))
+        elapsed = asyncio.run(run())
+        uploader.start()
+        back.stop_delivery(timeout=60)
+        logs.shutdown()
+    return {
+        "frames": frame_count,
+        "frames_per_second": round(frame_count / elapsed, 1),
+        "us_per_frame": round(elapsed / frame_count * 1e6, 3),
+    }
+
+def bulk_decode(frame_count=100000, repeat=3):
+    """Per-frame cost of columnar.decode_vitals_frames over one contiguous buffer."""
+    frame = frames.build_vitals_frame(72, 120, 80, 98, 5)
+    buffer = frame * frame_count
+    best = min(timeit.Timer(lambda: columnar.decode_vitals_frames(buffer, len(frame))).repeat(repeat=repeat, number=1))
+    return {"frames": frame_count, "us_per_frame": round(best / frame_count * 1e6, 3)}
+
+def reconnect(latency=0.05):
+    """
+    Seconds from the start of connect_to_device to the first valid reading of one
+    simulated watch: a cold connect, a quick reconnect (cached settings verified by
+    one poll, handshake skipped), a quick reconnect after the watch rebooted
+    (verification fails, full handshake) and one after the cache expired.
+    """
+    import connect
+    import simulator
+    from watch_cache import WatchConfigCache
+
+    watch = SimulatedWatch(WATCH_ADDRESS, latency=latency)
+
+    async def session(cache):
+        currentdata.default_scheduler = PollScheduler(writes_per_second=100.0, burst=10)
+        task = asyncio.create_task(connect.connect_to_device(WATCH_ADDRESS, "write", "notify", max_retries=1,
+                                                             cache=cache))
+        entry = None
+        while entry is None or entry.connecting_at is not None or entry.first_reading_seconds is None:
+            await asyncio.sleep(0.005)
+            entry = cache.watches.get(WATCH_ADDRESS)
+        watch.drop_link()
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        seconds, entry.first_reading_seconds = entry.first_reading_seconds, None
+        return {"handshake": entry.mode, "seconds": seconds}
+
+    async def run():
+        cache = WatchConfigCache()
+        results = {"cold": await session(cache), "quick_reconnect": await session(cache)}
+        watch.reset()
+        results["after_reboot"] = await session(cache)
+        cache.verify_within = 0  # Every later reconnect is past the cache window
+        results["after_expiry"] = await session(cache)
+        return results
+
+    scheduler = currentdata.default_scheduler
+    back.payload_sink = lambda kind, payload, received_at: True  # Readings go nowhere
+    with simulator.install(simulator.SimulatedFleet([watch])), open(os.devnull, "w") as devnull:
+        logs.configure(stream=devnull)
+        try:
+            return asyncio.run(run())
+        finally:
+            currentdata.default_scheduler = scheduler
+            back.payload_sink = None
+            logs.shutdown()
+
+def memory_per_device(devices=500):
+    """
+    Bytes allocated per watch by the per-device state: rolling window, local history,
+    alert rule state, poll state and upload filter entry, after a few readings each.
+    """
+    from signals import VitalsWindow
+    from timeseries import TimeSeriesStore
+    from alerts import AlertEngine
+    from upload_filter import UploadFilter
+
+    reading_frame = frames.build_vitals_frame(72, 120, 80, 98, 5)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    windows, store, engine = [], TimeSeriesStore(), AlertEngine()
+    scheduler, upload_filter = PollScheduler(), UploadFilter()
+    for i in range(devices):
+        address = f"C0:FF:EE:00:{i >> 8:02X}:{i & 0xFF:02X}"
+        window = VitalsWindow()
+        scheduler.register(address)
+        for _ in range(4):
+            reading = frames.decode_vitals(reading_frame)
+            reading.watch_status = "Worn"
+            window.push(reading)
+            store.record(address, reading)
+            engine.evaluate(address, reading)
+            scheduler.report_reading(address, reading)
+            upload_filter.filter(back.build_vitals_payload(reading.as_dict(), address, HOST_ADDRESS))
+        windows.append(window)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {"devices": devices, "bytes_per_device": round((after - before) / devices)}
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    try:
+        import numpy
+        numpy_version = numpy.__version__
+    except ImportError:
+        numpy_version = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit or None,
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "numpy": numpy_version,
+    }
+
+def run_all(quick=False):
+    return {
+        "environment": environment(),
+        "micro": micro_benchmarks(number=2000 if quick else 20000, repeat=3 if quick else 5),
+        "throughput": throughput(frame_count=2000 if quick else 20000),
+        "bulk_decode": bulk_decode(frame_count=10000 if quick else 100000),
+        "reconnect": reconnect(),
+        "memory": memory_per_device(devices=50 if quick else 500),
+    }
+
+def compare(current, baseline):
+    """Print the ratio current/baseline of every timing (below 1.0 is faster)."""
+    for name, result in current["micro"].items():
+        old = baseline.get("micro", {}).get(name)
+        if old:
+            print(f"{name:28s} {old['us_per_call']:10.3f} -> {result['us_per_call']:10.3f} us  "
+                  f"x{result['us_per_call'] / old['us_per_call']:.2f}")
+    old = baseline.get("throughput")
+    if old:
+        print(f"{'frames_per_second':28s} {old['frames_per_second']:10.1f} -> "
+              f"{current['throughput']['frames_per_second']:10.1f}")
+    old = baseline.get("bulk_decode")
+    if old:
+        print(f"{'bulk_decode us_per_frame':28s} {old['us_per_frame']:10.3f} -> {current['bulk_decode']['us_per_frame']:10.3f}")
+    for name, result in current["reconnect"].items():
+        old = baseline.get("reconnect", {}).get(name)
+        if old:
+            print(f"{'reconnect ' + name:28s} {old['seconds']:10.3f} -> {result['seconds']:10.3f} s  "
+                  f"({old['handshake']} -> {result['handshake']})")
+    old = baseline.get("memory")
+    if old:
+        print(f"{'bytes_per_device':28s} {old['bytes_per_device']:10d} -> {current['memory']['bytes_per_device']:10d}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gateway hot paths.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against.")
+    parser.add_argument("--quick", action="store_true", help="Fewer iterations, for a smoke run.")
+    args = parser.parse_args()
+
+    results = run_all(quick=args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print(json.dumps(results, indent=2))
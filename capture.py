@@ -0,0 +1,350 @@
+
+# capture.py
+#
+# Optional recorder of every raw notification, and an offline replay tool that runs
+# recorded traffic back through the frame reassembler and the parsers.
+#
+#   python capture.py replay captures/*.bin            # decode counts and speed
+#   python capture.py replay --dump captures/*.bin     # one JSON line per frame
+#
+# File layout (little-endian): an 8-byte magic, then the wall-clock and monotonic
+# time at which the file was opened (two doubles), then records of
+#   kind (1 byte) | address index (2) | length (2) | monotonic timestamp (8) | body
+# A RECORD_ADDRESS record maps a new address index to its address string (UTF-8
+# body); a RECORD_FRAME record holds one notification exactly as it was received.
+# Every file defines its own addresses, so a rotated file can be replayed alone.
+
+import collections
+import contextlib
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import logs
+import metrics
+from frames import decode_vitals, decode_battery, OPCODE_VITALS, OPCODE_BATTERY
+from reassembly import FrameReassembler
+
+MAGIC = b"GTSCAP01"
+FILE_HEADER = struct.Struct("<8sdd")
+RECORD_HEADER = struct.Struct("<BHHd")
+
+RECORD_ADDRESS = 0
+RECORD_FRAME = 1
+
+# Default size at which a capture file is closed and a new one started
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Notifications waiting for the writer thread; when full (the writer is failing or
+# far behind), the oldest are dropped
+MAX_PENDING = 100000
+
+log = logs.get_logger("capture")
+
+capture_dropped = metrics.Counter(
+    "gateway_capture_dropped_total", "Notifications dropped from the capture queue because the writer fell behind.")
+
+# Recorder picked up by every new NotificationRouter; None until enable() is called
+default_recorder = None
+
+class NotificationRecorder:
+    """
+    Appends raw notifications to size-rotated capture files.
+
+    record() only appends to a bounded in-memory deque, so it is safe to call for
+    every notification on the BLE event loop. A writer thread drains the deque every
+    flush_interval seconds and does the file I/O. While the writer cannot keep up
+    (e.g. the disk is full), the oldest queued notifications are dropped and counted.
+
+    Parameters:
+        directory (str): Where capture files are written.
+        max_bytes (int): Size at which the current file is rotated.
+        max_files (int): Oldest files beyond this count are deleted; None keeps all.
+        flush_interval (float): Longest time a notification waits before it is written.
+        max_pending (int): Notifications queued for the writer at most.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES, max_files=None, flush_interval=1.0,
+                 max_pending=MAX_PENDING):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.flush_interval = flush_interval
+        self.recorded = 0
+        self.dropped = 0
+        self.files = []
+        self._sequence = 0
+        self._pending = collections.deque(maxlen=max_pending)
+        self._stopping = threading.Event()
+        self._writer = None
+        self._file = None
+        self._size = 0
+        self._addresses = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        if self._writer is None:
+            self._stopping.clear()
+            self._writer = threading.Thread(target=self._run, name="capture-writer", daemon=True)
+            self._writer.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Write everything recorded so far and close the current file."""
+        self._stopping.set()
+        if self._writer is not None:
+            self._writer.join(timeout)
+            self._writer = None
+
+    def record(self, address, data, timestamp=None):
+        """
+        Queue one notification for the capture file.
+
+        Parameters:
+            address (str): The watch address.
+            data (bytes | bytearray): The notification as received.
+            timestamp (float): time.monotonic() of arrival, defaults to now.
+        """
+        if len(self._pending) == self._pending.maxlen:
+            self.dropped += 1
+            capture_dropped.inc()
+        # bytes() copies: bleak may reuse the bytearray for the next notification
+        self._pending.append((address, bytes(data), time.monotonic() if timestamp is None else timestamp))
+
+    def _run(self):
+        try:
+            while not self._stopping.wait(self.flush_interval):
+                self._drain()
+            self._drain()
+        finally:
+            self._close_file()
+
+    def _drain(self):
+        if not self._pending:
+            return
+        chunk = bytearray()
+        pending = 0  # Notifications in chunk, not written yet
+        try:
+            while self._pending:
+                address, data, timestamp = self._pending.popleft()
+                pending += 1
+                if self._file is None or self._size + len(chunk) >= self.max_bytes:
+                    self._write(chunk)
+                    self.recorded += pending - 1
+                    chunk = bytearray()
+                    pending = 1  # Only this one still waits to be written
+                    self._rotate()
+                index = self._addresses.get(address)
+                if index is None:
+                    index = self._addresses[address] = len(self._addresses)
+                    encoded = str(address).encode()
+                    chunk += RECORD_HEADER.pack(RECORD_ADDRESS, index, len(encoded), timestamp) + encoded
+                chunk += RECORD_HEADER.pack(RECORD_FRAME, index, len(data), timestamp) + data
+            self._write(chunk)
+            self.recorded += pending
+            pending = 0
+            self._file.flush()
+        except OSError as e:
+            # The notifications taken for this chunk are lost; the next drain starts a new file
+            self.dropped += pending
+            capture_dropped.inc(amount=pending)
+            log.error("Error writing capture file, dropped %d notifications: %s", pending, e)
+            try:
+                self._close_file()
+            except OSError:
+                self._file = None
+
+    def _write(self, chunk):
+        if chunk:
+            self._file.write(chunk)
+            self._size += len(chunk)
+
+    def _rotate(self):
+        self._close_file()
+        path = os.path.join(self.directory, time.strftime("notifications-%Y%m%d-%H%M%S") +
+                            f"-{self._sequence:04d}.bin")
+        self._sequence += 1
+        self._file = open(path, "wb")
+        header = FILE_HEADER.pack(MAGIC, time.time(), time.monotonic())
+        self._file.write(header)
+        self._size = len(header)
+        self._addresses = {}
+        self.files.append(path)
+        if self.max_files is not None:
+            while len(self.files) > self.max_files:
+                old = self.files.pop(0)
+                try:
+                    os.remove(old)
+                except OSError as e:
+                    log.warning("Error removing old capture file %s: %s", old, e)
+        log.info("Capturing notifications to %s", path)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def enable(directory, **options):
+    """Start recording every notification of every new connection to directory."""
+    global default_recorder
+    disable()
+    default_recorder = NotificationRecorder(directory, **options).start()
+    return default_recorder
+
+def disable():
+    global default_recorder
+    if default_recorder is not None:
+        default_recorder.stop()
+        default_recorder = None
+
+@contextlib.contextmanager
+def open_capture(path):
+    """
+    Memory-map one capture file.
+
+    Parameters:
+        path (str): A capture file.
+
+    Yields:
+        tuple: (mmap, wall_offset), where adding wall_offset to a record's monotonic
+        timestamp gives its wall-clock time.
+
+    Raises:
+        ValueError: If the file is not a capture file.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a capture file.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, wall_start, monotonic_start = FILE_HEADER.unpack_from(data, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a capture file.")
+            yield data, wall_start - monotonic_start
+
+def iter_records(data, path=""):
+    """
+    Walk the records of a mapped capture file without copying their bodies.
+
+    A record cut short (the gateway stopped while writing it) ends the file with a
+    warning rather than an error.
+
+    Yields:
+        tuple: (kind, address index, body offset, body length, monotonic timestamp).
+    """
+    unpack_header = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    position, end = FILE_HEADER.size, len(data)
+    while position < end:
+        kind, index, length, timestamp = (unpack_header(data, position) if position + header_size <= end
+                                          else (None, None, end, None))
+        if position + header_size + length > end:
+            log.warning("%s: truncated record at byte %d, ignoring the rest of the file.", path, position)
+            return
+        position += header_size
+        yield kind, index, position, length, timestamp
+        position += length
+
+def read_capture(path):
+    """
+    Iterate over the notifications in one capture file, memory-mapped.
+
+    Parameters:
+        path (str): A capture file.
+
+    Yields:
+        tuple: (address, wall-clock time, frame bytes) per notification, in order.
+    """
+    with open_capture(path) as (data, wall_offset):
+        addresses = {}
+        for kind, index, offset, length, timestamp in iter_records(data, path):
+            if kind == RECORD_FRAME:
+                yield addresses[index], timestamp + wall_offset, data[offset:offset + length]
+            elif kind == RECORD_ADDRESS:
+                addresses[index] = data[offset:offset + length].decode()
+
+def replay(paths, on_reading=None):
+    """
+    Run recorded notifications through the reassembler and the current parsers at
+    full speed.
+
+    Parameters:
+        paths (list): Capture files, replayed in the given order.
+        on_reading (callable): Called with (address, wall-clock time, opcode, result)
+            per frame, where result is a VitalsReading for DA8D frames and a
+            (battery_level, error) tuple for DA86 frames.
+
+    Returns:
+        dict: Notification and frame counts, frames per opcode and per decode error,
+        bytes the reassembler discarded, and the replay speed.
+    """
+    counts = collections.Counter()
+    errors = collections.Counter()
+    reassemblers = {}
+    notifications = 0
+
+    def handle_frame(sender, frame):
+        address, timestamp = sender
+        frame_opcode = frame[1]
+        counts[f"DA{frame_opcode:02X}"] += 1
+        if frame_opcode == OPCODE_VITALS:
+            result = decode_vitals(frame, crc_checked=True)
+            if result.error is not None:
+                errors[result.error] += 1
+        elif frame_opcode == OPCODE_BATTERY:
+            result = decode_battery(frame)
+            if result[1] is not None:
+                errors[result[1]] += 1
+        else:
+            return
+        if on_reading is not None:
+            on_reading(address, timestamp, frame_opcode, result)
+
+    start = time.perf_counter()
+    for path in paths:
+        for address, timestamp, notification in read_capture(path):
+            notifications += 1
+            reassembler = reassemblers.get(address)
+            if reassembler is None:
+                # Recorded time, not replay time, decides when a partial frame is stale
+                reassembler = reassemblers[address] = FrameReassembler(handle_frame, address, stale_after=None)
+            reassembler.feed(notification, (address, timestamp))
+    elapsed = time.perf_counter() - start
+    frames = sum(reassembler.frames for reassembler in reassemblers.values())
+    return {
+        "files": len(paths),
+        "notifications": notifications,
+        "frames": frames,
+        "devices": len(reassemblers),
+        "opcodes": dict(counts),
+        "errors": dict(errors),
+        "discarded_bytes": sum(reassembler.discarded for reassembler in reassemblers.values()),
+        "seconds": round(elapsed, 3),
+        "frames_per_second": round(frames / elapsed, 1) if elapsed else None,
+    }
+
+def _dump_reading(address, timestamp, frame_opcode, result):
+    record = {"address": address, "time": round(timestamp, 6), "opcode": f"DA{frame_opcode:02X}"}
+    if frame_opcode == OPCODE_VITALS:
+        record.update(result.as_dict())
+    else:
+        battery_level, error = result
+        record.update({"error": error} if error else {"Battery Level": battery_level})
+    print(json.dumps(record))
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Replay captured notifications through the parsers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    replay_parser = subparsers.add_parser("replay", help="Decode capture files.")
+    replay_parser.add_argument("paths", nargs="+", help="Capture files or glob patterns, replayed in sorted order.")
+    replay_parser.add_argument("--dump", action="store_true", help="Print every decoded frame as a JSON line.")
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.paths for path in (glob.glob(pattern) or [pattern]))
+    summary = replay(paths, _dump_reading if args.dump else None)
+    if not args.dump:
+        print(json.dumps(summary, indent=2))
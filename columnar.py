@@ -0,0 +1,153 @@
+
+# columnar.py
+#
+# Bulk decoding of stored vitals frames into NumPy columns, for research exports and
+# for backfilling after a parser fix.
+#
+#   python columnar.py export captures/*.bin --output vitals.npz
+
+import glob
+import json
+import time
+import numpy as np
+from crc_utils import verify_frames_numpy
+from frames import FRAME_HEADER, HEADER_SIZE, CRC_SIZE, OPCODE_VITALS, VITALS_STRUCT, VITALS_OFFSETS
+import capture
+
+# One row per frame; invalid rows (bad CRC, wrong opcode, measuring) hold zeros
+VITALS_DTYPE = np.dtype([(name, np.uint8) for name, _ in VITALS_OFFSETS] + [("valid", np.bool_)])
+
+# Capture rows add the wall-clock time and the index into the address list
+CAPTURE_DTYPE = np.dtype([("timestamp", np.float64), ("device", np.uint16)] + VITALS_DTYPE.descr)
+
+def decode_vitals_frames(buffer, frame_length):
+    """
+    Decode a contiguous buffer of same-length vitals frames in bulk.
+
+    A row is valid when the frame is a DA8D frame whose CRC matches and whose payload
+    is long enough to hold every field, i.e. exactly when frames.decode_vitals would
+    return a reading without an error.
+
+    Parameters:
+        buffer (bytes | bytearray | memoryview | numpy.ndarray): Back-to-back frames.
+        frame_length (int): Length of each frame, header and CRC included.
+
+    Returns:
+        numpy.ndarray: Structured array of VITALS_DTYPE, one row per frame.
+
+    Raises:
+        ValueError: If the buffer length is not a multiple of frame_length.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if frame_length < HEADER_SIZE + CRC_SIZE or data.size % frame_length:
+        raise ValueError("Buffer length is not a multiple of the frame length.")
+    frames = data.reshape(-1, frame_length)
+    result = np.zeros(len(frames), dtype=VITALS_DTYPE)
+    if frame_length - HEADER_SIZE - CRC_SIZE < VITALS_STRUCT.size or not len(frames):
+        return result  # Too short to carry vitals ("Measuring Vitals" frames)
+    valid = verify_frames_numpy(data, frame_length)
+    valid &= frames[:, 0] == FRAME_HEADER
+    valid &= frames[:, 1] == OPCODE_VITALS
+    for name, offset in VITALS_OFFSETS:
+        result[name] = np.where(valid, frames[:, HEADER_SIZE + offset], 0)
+    result["valid"] = valid
+    return result
+
+def decode_capture(paths):
+    """
+    Decode every vitals frame of some capture files into one columnar table.
+
+    Only the record headers are walked in Python; frames are gathered by length into
+    contiguous buffers straight from the memory-mapped file and decoded in bulk.
+    Each notification is taken as one frame: a frame split over several
+    notifications shows up as invalid rows (capture.replay reassembles them).
+
+    Parameters:
+        paths (list): Capture files written by capture.NotificationRecorder.
+
+    Returns:
+        tuple: (rows, addresses) where rows is a CAPTURE_DTYPE array in capture order
+        and addresses maps the device column to watch addresses.
+    """
+    addresses = []
+    address_ids = {}
+    tables = []
+    for path in paths:
+        with capture.open_capture(path) as (data, wall_offset):
+            local_ids = {}
+            offsets, lengths, timestamps, devices = [], [], [], []
+            for kind, index, offset, length, timestamp in capture.iter_records(data, path):
+                if kind == capture.RECORD_FRAME:
+                    if length > 1 and data[offset + 1] == OPCODE_VITALS:
+                        offsets.append(offset)
+                        lengths.append(length)
+                        timestamps.append(timestamp)
+                        devices.append(local_ids[index])
+                elif kind == capture.RECORD_ADDRESS:
+                    address = data[offset:offset + length].decode()
+                    if address not in address_ids:
+                        address_ids[address] = len(addresses)
+                        addresses.append(address)
+                    local_ids[index] = address_ids[address]
+            raw = np.frombuffer(data, dtype=np.uint8)
+            offsets = np.asarray(offsets, dtype=np.int64)
+            lengths = np.asarray(lengths, dtype=np.int64)
+            rows = np.zeros(len(offsets), dtype=CAPTURE_DTYPE)
+            rows["timestamp"] = np.asarray(timestamps, dtype=np.float64) + wall_offset
+            rows["device"] = devices
+            for frame_length in np.unique(lengths):
+                selected = np.flatnonzero(lengths == frame_length)
+                # Fancy indexing copies the frames into one contiguous (n, frame_length) block
+                block = raw[offsets[selected, None] + np.arange(frame_length)]
+                decoded = decode_vitals_frames(block, int(frame_length))
+                for name in VITALS_DTYPE.names:
+                    rows[name][selected] = decoded[name]
+            del raw  # Release the mapping before the file is closed
+            tables.append(rows)
+    rows = np.concatenate(tables) if tables else np.zeros(0, dtype=CAPTURE_DTYPE)
+    return rows, addresses
+
+def export_columns(path, rows, addresses=()):
+    """
+    Write decoded rows to a compressed .npz file with one array per column.
+
+    Parameters:
+        path (str): Output file.
+        rows (numpy.ndarray): VITALS_DTYPE or CAPTURE_DTYPE rows.
+        addresses (list): Watch addresses the device column indexes, if any.
+    """
+    columns = {name: np.ascontiguousarray(rows[name]) for name in rows.dtype.names}
+    np.savez_compressed(path, addresses=np.asarray(addresses, dtype=str), **columns)
+
+def load_columns(path):
+    """
+    Read a file written by export_columns.
+
+    Returns:
+        dict: Column name -> NumPy array, plus "addresses".
+    """
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Decode capture files into a columnar .npz export.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Decode capture files and write the columns.")
+    export_parser.add_argument("paths", nargs="+", help="Capture files or glob patterns, decoded in sorted order.")
+    export_parser.add_argument("--output", required=True, help="The .npz file to write.")
+    args = parser.parse_args()
+
+    paths = sorted(path for pattern in args.paths for path in (glob.glob(pattern) or [pattern]))
+    start = time.perf_counter()
+    rows, addresses = decode_capture(paths)
+    elapsed = time.perf_counter() - start
+    export_columns(args.output, rows, addresses)
+    print(json.dumps({
+        "files": len(paths),
+        "frames": len(rows),
+        "valid": int(rows["valid"].sum()),
+        "devices": len(addresses),
+        "decode_seconds": round(elapsed, 3),
+    }, indent=2))
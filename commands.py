@@ -0,0 +1,133 @@
+
+# commands.py
+
+import asyncio
+import logging
+import logs
+from frames import opcode
+
+log = logs.get_logger("commands")
+
+# A watch answers a command with the command's opcode with the high bit set (DA70 -> DAF0)
+RESPONSE_BIT = 0x80
+
+def response_opcode(command):
+    """
+    Return the opcode a watch answers the given command frame with.
+
+    Parameters:
+        command (bytes): The command frame.
+
+    Returns:
+        int: The expected response opcode.
+    """
+    return command[1] | RESPONSE_BIT
+
+def _acceptor(expected):
+    """Turn request()'s expected argument into a predicate on the response frame."""
+    if expected is None:
+        return lambda response: True
+    if callable(expected):
+        return expected
+    if isinstance(expected, str):
+        expected = bytes.fromhex(expected)
+    return lambda response: response == expected
+
+class CommandChannel:
+    """
+    Correlates commands written to a watch with the notifications that answer them.
+
+    request() registers a future keyed on the expected response opcode, writes the
+    command and returns as soon as handle_notification() sees a matching frame. A
+    frame with the right opcode that is not the expected answer (a non-OK ack) does
+    not end the request: the command is resent, like after a timeout. With
+    a router, the channel registers each expected opcode for the duration of its
+    request; without one, handle_notification must be given to start_notify.
+
+    Parameters:
+        client (BleakClient): Connected client.
+        write_char_uuid (str): Characteristic commands are written to.
+        router (NotificationRouter): The client's notification router, if any.
+    """
+
+    def __init__(self, client, write_char_uuid, router=None):
+        self.client = client
+        self.write_char_uuid = write_char_uuid
+        self.router = router
+        self._pending = {}
+
+    def handle_notification(self, sender, data):
+        """
+        Resolve the request waiting for this frame's opcode, if any.
+
+        Returns:
+            bool: True if the frame answered a pending request.
+        """
+        future = self._pending.get(opcode(data))
+        if future is None or future.done():
+            return False
+        future.set_result(bytes(data))
+        return True
+
+    def expecting(self, response_op):
+        return response_op in self._pending
+
+    async def request(self, command, timeout=1.0, max_attempts=10, backoff=2.0, max_timeout=5.0, label=None,
+                      expected=None):
+        """
+        Write a command and wait for its response, resending on timeout or on an
+        unexpected response.
+
+        Parameters:
+            command (bytes | str): The command frame (bytes or hex string).
+            timeout (float): Seconds to wait for the first response.
+            max_attempts (int): How many times the command is written at most.
+            backoff (float): Factor the wait grows by after each failed attempt.
+            max_timeout (float): Upper bound for the wait of one attempt.
+            label (str): Name used in progress messages.
+            expected (bytes | str | callable): The exact response frame, or a predicate
+                taking the frame; None accepts any frame with the response opcode.
+
+        Returns:
+            bytes | None: The expected response; if none came, the last unexpected
+            response, or None if every attempt timed out.
+        """
+        if isinstance(command, str):
+            command = bytes.fromhex(command)
+        accept = _acceptor(expected)
+        response_op = response_opcode(command)
+        label = label or f"DA{command[1]:02X}"
+        if response_op in self._pending:
+            raise RuntimeError(f"A request waiting for DA{response_op:02X} is already in flight.")
+        loop = asyncio.get_running_loop()
+        future = self._pending[response_op] = loop.create_future()
+        if self.router is not None:
+            self.router.register(response_op, self.handle_notification)
+        address = getattr(self.client, "address", None)
+        unexpected = None
+        try:
+            for attempt in range(max_attempts):
+                log.log(logging.DEBUG if attempt == 0 else logging.INFO, "Attempt %d/%d: Sending %s",
+                        attempt + 1, max_attempts, label, extra={"device": address})
+                await self.client.write_gatt_char(self.write_char_uuid, command)
+                started = loop.time()
+                try:
+                    # shield: a timeout must not cancel the future a late response may still resolve
+                    response = await asyncio.wait_for(asyncio.shield(future), timeout)
+                except asyncio.TimeoutError:
+                    timeout = min(timeout * backoff, max_timeout)
+                    continue
+                if accept(response):
+                    return response
+                unexpected = response
+                log.info("Unexpected response to %s: %s", label, response.hex().upper(), extra={"device": address})
+                future = self._pending[response_op] = loop.create_future()
+                if attempt + 1 < max_attempts:
+                    # Back off for the rest of this attempt's wait before resending
+                    await asyncio.sleep(max(0.0, timeout - (loop.time() - started)))
+                timeout = min(timeout * backoff, max_timeout)
+            return unexpected
+        finally:
+            del self._pending[response_op]
+            if self.router is not None:
+                self.router.unregister(response_op, self.handle_notification)
@@ -1,35 +1,41 @@
 import asyncio
+import time
+from contextlib import asynccontextmanager
 from bleak import BleakClient
-from currentdata import fetch_current_data  # Fetch current data functionality
+from commands import CommandChannel
+from router import NotificationRouter
+from currentdata import fetch_current_data, CURRENT_DATA_COMMAND  # Fetch current data functionality
 from back import send_alert1  # Import send_alert from back.py
-
-import subprocess  # To fetch the local machine's MAC address
-
-# Function to get the host machine's MAC address using ifconfig
-def get_host_machine_mac():
-    """Fetch the MAC address of the host machine (local machine)."""
-    try:
-        result = subprocess.run(['ifconfig'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        output = result.stdout
-
-        # Searching for MAC address in the output
-        for line in output.split('\n'):
-            if 'ether' in line:  # 'ether' is the keyword used in 'ifconfig' output
-                mac_address = line.split()[1]
-                return mac_address
-        return "UNKNOWN_HOST_MAC"
-    except Exception as e:
-        print(f"Error fetching MAC address: {e}")
-        return "UNKNOWN_HOST_MAC"
-
-async def connect_to_device(address, write_char_uuid, notify_char_uuid, max_retries=3, retry_interval=5):
-    print(f"Attempting to connect to device: {address}")
+from sessions import CONNECTING, HANDSHAKE, STREAMING
+from frames import decode_vitals
+from host_identity import host_mac
+from watch_cache import default_cache, FULL, VERIFIED
+import metrics
+import logs
+
+log = logs.get_logger("connect")
+
+# Logger tagged with the address of the watch behind a client
+def device_log(client):
+    return logs.for_device(log, getattr(client, "address", None))
+
+# on_state, if given, is called with the session state as the connection progresses;
+# adapter selects the Bluetooth adapter (e.g. "hci1"), None uses the system default.
+# cache remembers each watch's handshake, so a quick reconnect skips or verifies it.
+# sync, on_reading and keep_polling are passed to fetch_current_data; once it returns
+# (a sync is done, or keep_polling() said stop) the watch is disconnected.
+async def connect_to_device(address, write_char_uuid, notify_char_uuid, max_retries=3, retry_interval=5, on_state=None,
+                            pipeline_handshake=False, adapter=None, cache=None, sync=False, on_reading=None,
+                            keep_polling=None):
+    address_log = logs.for_device(log, address)
+    address_log.info("Attempting to connect")
+    cache = cache or default_cache
 
     retries = 0
     client = None
 
-    # Fetch the host MAC address in advance
-    host_mac_address = get_host_machine_mac()
+    # The host MAC address, resolved once per process
+    host_mac_address = host_mac() or "UNKNOWN_HOST_MAC"
     smartwatch_mac_address = address  # The smartwatch MAC address is the device address we're trying to connect to.
 
     # Define alert parameters
@@ -38,35 +44,62 @@ async def connect_to_device(address, write_char_uuid, notify_char_uuid, max_retr
   
     while retries < max_retries:
         try:
-            print(f"Connecting to {address}... Attempt {retries + 1}/{max_retries}")
-            client = BleakClient(address)  # Create BleakClient instance
+            address_log.info("Connecting, attempt %d/%d", retries + 1, max_retries)
+            if on_state:
+                on_state(CONNECTING)
+            cache.connecting(address)
+            client = BleakClient(address, **({"adapter": adapter} if adapter else {}))  # Create BleakClient instance
             await client.connect()  # Attempt to connect to the device
 
             if client.is_connected:
-                print(f"Connected to {address}")
-
-                # Fetch and send commands after successful connection
-                await sensorsON(client, write_char_uuid, notify_char_uuid)
-                await MasterS(client, write_char_uuid, notify_char_uuid)
-                await send_device_setting_request(client, write_char_uuid, notify_char_uuid)
-
-                # Fetch and send current data with the smartwatch and host MAC addresses
-                await fetch_current_data(client, write_char_uuid, notify_char_uuid, smartwatch_mac_address, host_mac_address)
-
-                return client  # Return the connected client instance
+                address_log.info("Connected")
+                if on_state:
+                    on_state(HANDSHAKE)
+
+                try:
+                    # One notify subscription for the whole connection, shared by every phase
+                    router = await NotificationRouter(client, notify_char_uuid).start()
+
+                    # Send the handshake steps this watch needs after successful connection; a
+                    # watch that did not acknowledge them is disconnected and tried again
+                    mode, configured = await configure_watch(client, write_char_uuid, notify_char_uuid, router, cache,
+                                                             pipeline=pipeline_handshake)
+                    if not configured:
+                        raise ConnectionError("Handshake failed")
+
+                    # Fetch and send current data with the smartwatch and host MAC addresses
+                    if on_state:
+                        on_state(STREAMING)
+                    await fetch_current_data(client, write_char_uuid, notify_char_uuid, smartwatch_mac_address, host_mac_address,
+                                             router=router,
+                                             on_first_reading=lambda reading: cache.first_reading(address),
+                                             on_reading=on_reading, sync=sync, keep_polling=keep_polling)
+                finally:
+                    cache.disconnected(address)
+
+                # Done with the watch: free the adapter's link for the next one
+                try:
+                    await client.disconnect()
+                except Exception as e:
+                    address_log.info("Error disconnecting: %s", e)
+                return client  # Return the client instance
             else:
-                print(f"Failed connecting to {address}")
+                address_log.warning("Failed connecting")
         except Exception as e:
-            print(f"Connection attempt {retries + 1}/{max_retries} failed: {str(e)}")
-            print(f"Smartwatch MAC address attempted: {smartwatch_mac_address}")  # Print the MAC address
+            address_log.warning("Connection attempt %d/%d failed: %s", retries + 1, max_retries, e)
+            if client is not None:
+                try:
+                    await client.disconnect()
+                except Exception:
+                    pass
 
         retries += 1
         if retries < max_retries:
-            print(f"Retrying in {retry_interval} seconds...")
+            address_log.info("Retrying in %s seconds", retry_interval)
             await asyncio.sleep(retry_interval)
 
-    # If connection fails after max retries, send an alert and print the MAC address
-    print(f"Failed to connect to device {address} after {max_retries} attempts.")
+    # If connection fails after max retries, log it and send an alert
+    address_log.error("Failed to connect after %d attempts.", max_retries)
     
     # Send an alert with the real MAC addresses
     send_alert1(
@@ -80,136 +113,160 @@ async def connect_to_device(address, write_char_uuid, notify_char_uuid, max_retr
 
     return None
 
+# Expected responses to the handshake commands
+BINDING_RESPONSES = {
+    "DA81010002A1EE": "ERROR, Binding Failed.",
+    "DA8102000000EF5C": "No response.",
+    "DA8102000001EF5C": "Successfully Bound.",
+    "DA81020000002E9C": "Binding Rejected",
+}
+SENSORS_ON_OK = "DAF00100003B13"
+MASTER_SWITCH_OK = "DA8E010000233B"
+DEVICE_SETTING_OK = "DAB10100002F2F"
+
+# Handshake commands
+SENSORS_ON_COMMAND = "DA700700112131415161717B2D"
+MASTER_SWITCH_COMMAND = "DA0E060001010101010144BE"
+DEVICE_SETTING_COMMAND = "DA310600000000000164FD49"
+
+# Use the given command channel, or subscribe a temporary one for a single step
+@asynccontextmanager
+async def command_channel(client, write_char_uuid, notify_char_uuid, channel=None):
+    if channel is not None:
+        yield channel
+        return
+    router = await NotificationRouter(client, notify_char_uuid).start()
+    try:
+        yield CommandChannel(client, write_char_uuid, router)
+    finally:
+        await router.stop()
+
+# Run the handshake steps over the client's router. With pipeline=True the three
+# commands are in flight together; their responses have distinct opcodes, so each
+# still resolves its own step. only limits the run to the named steps; cache, if
+# given, records which of them the watch acknowledged.
+async def run_handshake(client, write_char_uuid, notify_char_uuid, router, pipeline=False, only=None, cache=None):
+    channel = CommandChannel(client, write_char_uuid, router)
+    steps = [(name, step, command) for name, step, command in HANDSHAKE_STEPS if only is None or name in only]
+    timed_steps = (timed_step(name, step, client, write_char_uuid, notify_char_uuid, channel) for name, step, _ in steps)
+    if pipeline:
+        results = await asyncio.gather(*timed_steps)
+    else:
+        results = [await step for step in timed_steps]
+    if cache is not None:
+        for (name, _, command), result in zip(steps, results):
+            cache.step_applied(client.address, name, command, result)
+    return all(results)
+
+# Run one handshake step and record its duration and outcome in the metrics
+async def timed_step(name, step, *args):
+    start = time.perf_counter()
+    result = False
+    try:
+        result = await step(*args)
+        return result
+    finally:
+        metrics.handshake_step_seconds.observe(time.perf_counter() - start, (name, "ok" if result else "failed"))
+
+# Send the handshake steps the cache says a watch needs. Returns the mode used
+# (watch_cache.FULL or VERIFIED) and whether every step sent was acknowledged.
+# Cached steps are never trusted without a poll: a watch that rebooted is usually
+# back within seconds, with its settings gone.
+async def configure_watch(client, write_char_uuid, notify_char_uuid, router, cache, pipeline=False):
+    address = client.address
+    mode, pending = cache.plan(address, [(name, command) for name, _, command in HANDSHAKE_STEPS])
+    if mode == VERIFIED and not await still_configured(client, write_char_uuid, router):
+        device_log(client).info("Cached configuration no longer applied (watch rebooted?), sending every step")
+        cache.invalidate(address)
+        mode, pending = FULL, [name for name, _, _ in HANDSHAKE_STEPS]
+    if mode != FULL:
+        device_log(client).info("Reconnected with cached configuration, handshake %s (%d of %d steps sent)",
+                                mode, len(pending), len(HANDSHAKE_STEPS))
+    configured = True
+    if pending:
+        configured = await run_handshake(client, write_char_uuid, notify_char_uuid, router, pipeline=pipeline,
+                                         only=pending, cache=cache)
+    cache.handshake_done(address, mode)
+    return mode, configured
+
+# Poll the current data once: a watch that still has its sensors configured answers
+# with a complete vitals frame, one that was reset answers "measuring" or not at all
+async def still_configured(client, write_char_uuid, router):
+    channel = CommandChannel(client, write_char_uuid, router)
+    response = await channel.request(CURRENT_DATA_COMMAND, timeout=1.0, max_attempts=2, label="configuration check")
+    return response is not None and decode_vitals(response).error is None
+
 # Function to send the binding request and handle response
-async def send_binding_request(client, write_char_uuid, notify_char_uuid):
+async def send_binding_request(client, write_char_uuid, notify_char_uuid, channel=None):
     binding_request = "DA0101000009EF"
-    print(f"Sending Binding Request")
-    await client.write_gatt_char(write_char_uuid, bytes.fromhex(binding_request))
-
-    # Define a response handler for the notify characteristic
-    def response_handler(sender, data):
-        response_code = data.hex().upper()
-        if response_code == "DA81010002A1EE":
-            print("ERROR, Binding Failed.")
-        elif response_code == "DA8102000000EF5C":
-            print("No response.")
-        elif response_code == "DA8102000001EF5C":
-            print("Successfully Bound.")
-        elif response_code == "DA81020000002E9C":
-            print("Binding Rejected")
-        else:
-            print("No response.")
-
-    await client.start_notify(notify_char_uuid, response_handler)
-    print("Awaiting Binding Response...")
-    await asyncio.sleep(10)
-    await client.stop_notify(notify_char_uuid)
-    print("Binding DONE.")
+    step_log = device_log(client)
+    step_log.info("Sending binding request")
+    async with command_channel(client, write_char_uuid, notify_char_uuid, channel) as channel:
+        response = await channel.request(binding_request, timeout=10, max_attempts=1, label="Binding Request")
+    response_code = response.hex().upper() if response else None
+    step_log.info("Binding: %s", BINDING_RESPONSES.get(response_code, "No response."))
+    return response_code == "DA8102000001EF5C"
 
 # Function to send the sensor ON command after binding
-async def sensorsON(client, write_char_uuid, notify_char_uuid):
-    device_setting_request = "DA700700112131415161717B2D"
-   #print(f"Sending sensors ON command")
-    
-    response_received = False
-    
-    def sensorsON_handler(sender, data):
-        nonlocal response_received
-        response_code = data.hex().upper()
-
-        if response_code == "DAF00100003B13":
-            print("Sensors ON, SUCCESSFUL")
-            response_received = True
-
-    await client.start_notify(notify_char_uuid, sensorsON_handler)
-    
-    attempts = 0
+async def sensorsON(client, write_char_uuid, notify_char_uuid, channel=None):
+    device_setting_request = SENSORS_ON_COMMAND
     max_attempts = 10
-    
-    while attempts < max_attempts:
-        if response_received:
-            break
-        
-        print(f"Attempt {attempts + 1}/{max_attempts}: Sending sensors ON command...")
-        await client.write_gatt_char(write_char_uuid, bytes.fromhex(device_setting_request))
-
-        await asyncio.sleep(5)
-        attempts += 1
-
-    if not response_received:
-        print(f"Failed after {max_attempts} attempts.")
-    await client.stop_notify(notify_char_uuid)
-    print("Switching ON Sensors DONE.")
-    print("")
 
-# Function to send Heartrate Synchronization
-async def MasterS(client, write_char_uuid, notify_char_uuid):
-    device_setting_request = "DA0E060001010101010144BE"
-    print(f"Master Switching")
-    
-    response_received = False
-    
-    def MasterS(sender, data):
-        nonlocal response_received
-        response_code = data.hex().upper()
+    async with command_channel(client, write_char_uuid, notify_char_uuid, channel) as channel:
+        response = await channel.request(device_setting_request, max_attempts=max_attempts, label="sensors ON command",
+                                         expected=SENSORS_ON_OK)
 
-        if response_code == "DA8E010000233B":
-            print("Master Switching, SUCCESSFUL")
-            response_received = True
+    response_received = response is not None and response.hex().upper() == SENSORS_ON_OK
+    step_log = device_log(client)
+    if response_received:
+        step_log.info("Sensors ON, SUCCESSFUL")
+    elif response is None:
+        step_log.warning("Sensors ON failed after %d attempts.", max_attempts)
+    else:
+        step_log.warning("Unexpected sensors ON response: %s", response.hex().upper())
+    return response_received
 
-    await client.start_notify(notify_char_uuid, MasterS)
-    
-    attempts = 0
+# Function to send Heartrate Synchronization
+async def MasterS(client, write_char_uuid, notify_char_uuid, channel=None):
+    device_setting_request = MASTER_SWITCH_COMMAND
     max_attempts = 10
-    
-    while attempts < max_attempts:
-        if response_received:
-            break
-        
-        print(f"Attempt {attempts + 1}/{max_attempts}: Switching on Master Sensors..")
-        await client.write_gatt_char(write_char_uuid, bytes.fromhex(device_setting_request))
-
-        await asyncio.sleep(5)
-        attempts += 1
-
-    if not response_received:
-        print(f"Failed after {max_attempts} attempts.")
-    await client.stop_notify(notify_char_uuid)
-    print("Master Switching, DONE.")
-    print("")
 
-# Function to send the device setting command after binding
-async def send_device_setting_request(client, write_char_uuid, notify_char_uuid):
-    device_setting_request = "DA310600000000000164FD49"
-    print(f"Setting Device Measurement Interval")
-    
-    response_received = False
-    
-    def device_setting_response_handler(sender, data):
-        nonlocal response_received
-        response_code = data.hex().upper()
+    async with command_channel(client, write_char_uuid, notify_char_uuid, channel) as channel:
+        response = await channel.request(device_setting_request, max_attempts=max_attempts, label="Master Sensors switch",
+                                         expected=MASTER_SWITCH_OK)
 
-        if response_code == "DAB10100002F2F":
-            print("Measurement Interval Setting, SUCCESSFUL")
-            response_received = True
+    response_received = response is not None and response.hex().upper() == MASTER_SWITCH_OK
+    step_log = device_log(client)
+    if response_received:
+        step_log.info("Master Switching, SUCCESSFUL")
+    elif response is None:
+        step_log.warning("Master Switching failed after %d attempts.", max_attempts)
+    else:
+        step_log.warning("Unexpected Master Switching response: %s", response.hex().upper())
+    return response_received
 
-    await client.start_notify(notify_char_uuid, device_setting_response_handler)
-    
-    attempts = 0
+# Function to send the device setting command after binding
+async def send_device_setting_request(client, write_char_uuid, notify_char_uuid, channel=None):
+    device_setting_request = DEVICE_SETTING_COMMAND
     max_attempts = 10
-    
-    while attempts < max_attempts:
-        if response_received:
-            break
-        
-        print(f"Attempt {attempts + 1}/{max_attempts}: Sending measurement interval setting request...")
-        await client.write_gatt_char(write_char_uuid, bytes.fromhex(device_setting_request))
-
-        await asyncio.sleep(5)
-        attempts += 1
-
-    if not response_received:
-        print(f"Failed to set after {max_attempts} attempts.")
-    await client.stop_notify(notify_char_uuid)
-    print("Measurement Interval process DONE.")
-    print("")
+
+    async with command_channel(client, write_char_uuid, notify_char_uuid, channel) as channel:
+        response = await channel.request(device_setting_request, max_attempts=max_attempts, label="measurement interval setting request",
+                                         expected=DEVICE_SETTING_OK)
+
+    response_received = response is not None and response.hex().upper() == DEVICE_SETTING_OK
+    step_log = device_log(client)
+    if response_received:
+        step_log.info("Measurement Interval Setting, SUCCESSFUL")
+    elif response is None:
+        step_log.warning("Measurement Interval Setting failed after %d attempts.", max_attempts)
+    else:
+        step_log.warning("Unexpected measurement interval response: %s", response.hex().upper())
+    return response_received
+
+# Handshake steps in the order they are sent: (name, step function, command)
+HANDSHAKE_STEPS = (
+    ("sensors_on", sensorsON, SENSORS_ON_COMMAND),
+    ("master_switch", MasterS, MASTER_SWITCH_COMMAND),
+    ("measurement_interval", send_device_setting_request, DEVICE_SETTING_COMMAND),
+)
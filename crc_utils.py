@@ -1,9 +1,79 @@
 
 # crc_utils.py
 
+import time
+import metrics
+
+try:
+    import numpy as np  # Optional, only used by verify_frames_numpy
+except ImportError:
+    np = None
+
+CRC16_POLY = 0xA001  # CRC-16 ARC polynomial (0x8005 reflected)
+
+def _build_crc16_table():
+    """
+    Precompute the 256-entry lookup table for CRC-16 ARC.
+
+    Returns:
+        tuple: The CRC of every possible byte value, indexed by that byte.
+    """
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            if crc & 0x0001:
+                crc = (crc >> 1) ^ CRC16_POLY
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+CRC16_TABLE = _build_crc16_table()
+
 def crc16(data, offset, length):
     """
-    Calculate CRC-16 ARC for the given data.
+    Calculate CRC-16 ARC for the given data using the precomputed table.
+
+    Parameters:
+        data (bytes | bytearray | memoryview): The data to calculate CRC for.
+        offset (int): The starting point in the data for CRC calculation.
+        length (int): The number of bytes to include in the CRC calculation.
+
+    Returns:
+        int: The CRC-16 ARC checksum value.
+    """
+    if data is None or offset < 0 or offset > len(data) - 1 or offset + length > len(data):
+        return 0
+    table = CRC16_TABLE
+    crc = 0x0000
+    # Slicing a memoryview does not copy, and iterating it yields ints
+    for byte in memoryview(data)[offset:offset + length]:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def crc16_update(crc, data, offset, length):
+    """
+    Continue a CRC-16 ARC over more bytes, so a frame arriving in pieces is only
+    summed once: crc16_update(crc16(data, 0, n), data, n, m) == crc16(data, 0, n + m).
+
+    Parameters:
+        crc (int): The CRC of the bytes before offset (0 to start a new one).
+        data (bytes | bytearray | memoryview): The buffer.
+        offset (int): First byte to add.
+        length (int): Number of bytes to add.
+
+    Returns:
+        int: The updated CRC.
+    """
+    table = CRC16_TABLE
+    for byte in memoryview(data)[offset:offset + length]:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+def crc16_bitwise(data, offset, length):
+    """
+    Calculate CRC-16 ARC bit by bit (reference implementation, used by the benchmark).
 
     Parameters:
         data (bytes): The data to calculate CRC for.
@@ -20,7 +90,7 @@ def crc16(data, offset, length):
         crc ^= data[i]
         for j in range(8):
             if (crc & 0x0001) > 0:
-                crc = (crc >> 1) ^ 0xA001
+                crc = (crc >> 1) ^ CRC16_POLY
             else:
                 crc = crc >> 1
     return crc
@@ -44,13 +114,107 @@ def verify_crc(data, received_crc):
     Verify the CRC-16 ARC checksum of the given data.
 
     Parameters:
-        data (bytes): The data to verify (excluding CRC bytes).
-        received_crc (str): The received CRC in hexadecimal format.
+        data (bytes | bytearray | memoryview): The data to verify (excluding CRC bytes).
+        received_crc (str | bytes | int): The received CRC, either as it appears on the
+            wire (hex string or the two trailing bytes, low byte first) or as an int.
 
     Returns:
         bool: True if the CRC matches, False otherwise.
     """
     calculated_crc = crc16(data, 0, len(data))
-    calculated_crc_reversed = reverse_bytes(calculated_crc)
-    return calculated_crc_reversed.upper() == received_crc.upper()
+    if isinstance(received_crc, str):
+        try:
+            wire_value = int(received_crc, 16)
+        except ValueError:
+            return False
+        # The CRC is sent little-endian, so the hex string reads byte-swapped
+        received_crc = ((wire_value & 0xFF) << 8) | (wire_value >> 8)
+    elif not isinstance(received_crc, int):
+        if len(received_crc) != 2:
+            return False
+        received_crc = received_crc[0] | (received_crc[1] << 8)
+    if calculated_crc != received_crc:
+        metrics.crc_failures.inc()
+        return False
+    return True
+
+def verify_frame(frame):
+    """
+    Verify a complete frame whose last two bytes are its CRC (low byte first).
+
+    Parameters:
+        frame (bytes | bytearray | memoryview): The whole notification, CRC included.
+
+    Returns:
+        bool: True if the CRC matches, False otherwise.
+    """
+    length = len(frame) - 2
+    if length < 1:
+        return False
+    if crc16(frame, 0, length) != (frame[length] | (frame[length + 1] << 8)):
+        metrics.crc_failures.inc()
+        return False
+    return True
+
+def verify_frames(frames):
+    """
+    Verify many complete frames at once.
+
+    Parameters:
+        frames (iterable): Frames (bytes-like), each ending with its two CRC bytes.
+
+    Returns:
+        list: One bool per frame, True where the CRC matches.
+    """
+    return [verify_frame(frame) for frame in frames]
+
+def verify_frames_numpy(buffer, frame_length):
+    """
+    Verify a contiguous buffer of fixed-length frames with NumPy, one column at a time.
+
+    The table lookup runs across every frame in parallel, so the Python-level loop
+    is frame_length iterations regardless of how many frames there are.
+
+    Parameters:
+        buffer (bytes | bytearray | memoryview | numpy.ndarray): Back-to-back frames.
+        frame_length (int): Length of each frame, CRC bytes included.
+
+    Returns:
+        numpy.ndarray: Boolean mask with one entry per frame.
+    """
+    if np is None:
+        raise RuntimeError("verify_frames_numpy requires numpy to be installed.")
+    if frame_length < 3:
+        raise ValueError("Frames must hold at least one data byte and two CRC bytes.")
+    frames = np.frombuffer(buffer, dtype=np.uint8)
+    if frames.size % frame_length:
+        raise ValueError("Buffer length is not a multiple of the frame length.")
+    frames = frames.reshape(-1, frame_length)
+    table = np.asarray(CRC16_TABLE, dtype=np.uint16)
+    crc = np.zeros(frames.shape[0], dtype=np.uint16)
+    for column in range(frame_length - 2):
+        crc = (crc >> 8) ^ table[(crc ^ frames[:, column]) & 0xFF]
+    received = frames[:, -2].astype(np.uint16) | (frames[:, -1].astype(np.uint16) << 8)
+    mask = crc == received
+    failures = int(mask.size - np.count_nonzero(mask))
+    if failures:
+        metrics.crc_failures.inc(amount=failures)  # Counted like verify_frame does, one per frame
+    return mask
+
+# Micro-benchmark: table-driven vs bit-by-bit CRC over a typical vitals frame
+def benchmark(iterations=20000):
+    frame = bytes(range(4)) + bytes(30)
+    results = {}
+    for name, function in (("crc16_bitwise", crc16_bitwise), ("crc16", crc16)):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            function(frame, 0, len(frame))
+        elapsed = time.perf_counter() - start
+        results[name] = elapsed / iterations * 1e6
+    return results
 
+if __name__ == "__main__":
+    results = benchmark()
+    for name, per_call_us in results.items():
+        print(f"{name}: {per_call_us:.2f} us/frame")
+    print(f"Speedup: {results['crc16_bitwise'] / results['crc16']:.1f}x")
@@ -1,160 +1,210 @@
 import asyncio
 from bleak import BleakClient
-from crc_utils import verify_crc
+from router import NotificationRouter
+from scheduler import default_scheduler
+from alerts import default_engine
+from signals import VitalsWindow
+from timeseries import default_store
+from streams import default_hub
+from frames import (decode_vitals, decode_battery, OPCODE_BATTERY, OPCODE_VITALS,
+                    ERROR_TOO_SHORT, ERROR_CRC, ERROR_MEASURING, ERROR_BATTERY_TOO_SHORT)
+import metrics
+import logs
 import time
-import subprocess  # To fetch the local machine's MAC address
 import back  # Import the backend communication module
+from host_identity import host_mac
+
+# Polling commands: current vitals (answered with a DA8D frame) and battery level
+CURRENT_DATA_COMMAND = bytes.fromhex("DA0D0000AADB")
+BATTERY_COMMAND = bytes.fromhex("DA060000DB19")
+
+# A sync asks this many times, waiting this many seconds each, for an answer
+SYNC_ATTEMPTS = 3
+SYNC_TIMEOUT = 2.0
+
+# Parse error labels (kind, reason) for the metrics, by decoder error
+PARSE_ERROR_LABELS = {
+    ERROR_TOO_SHORT: ("vitals", "too_short"),
+    ERROR_CRC: ("vitals", "crc"),
+    ERROR_MEASURING: ("vitals", "measuring"),
+    ERROR_BATTERY_TOO_SHORT: ("battery", "too_short"),
+}
+INVALID_VITALS_LABELS = ("vitals", "invalid")
+
+log = logs.get_logger("currentdata")
 
 # Centralized error handling function
 def log_error(message, details=None):
     if details:
-        print(f"Error: {message} | Details: {details}")
+        log.error("%s | Details: %s", message, details)
     else:
-        print(f"Error: {message}")
+        log.error("%s", message)
 
-# Function to get the host machine's MAC address using ifconfig
-def get_host_machine_mac():
-    """Fetch the MAC address of the host machine (local machine)."""
-    try:
-        result = subprocess.run(['ifconfig'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        output = result.stdout
-        
-        for line in output.split('\n'):
-            if 'ether' in line:
-                mac_address = line.split()[1]
-                return mac_address
-        return None
-    except Exception as e:
-        log_error("Error fetching MAC address", str(e))
-        return None
-
-# Parsing function for general data
+# Parsing function for general data (hex string in, dict out; see frames.decode_vitals)
 def parse_watch_data_with_crc(response):
     if len(response) < 6:
-        return {"error": "Response too short for CRC verification."}
-
-    data_hex = response[:-4]
-    received_crc = response[-4:]
-    data_bytes = bytes.fromhex(data_hex)
-    
-    if not verify_crc(data_bytes, received_crc):
-        return {"error": "CRC verification failed."}
-
-    data_length = int(data_hex[4:8], 16)
-    data_payload = data_hex[8:]
-
-    if len(data_payload) < 44:
-        return {"error": "Measuring Vitals"}
-
+        return {"error": ERROR_TOO_SHORT}
     try:
-        systolic = int(data_payload[40:42], 16)
-        diastolic = int(data_payload[42:44], 16)
-
-        return {"Heart Rate": int(data_payload[38:40], 16), "Blood Pressure": f"{systolic}/{diastolic}", "Blood Oxygen": int(data_payload[44:46], 16), "Blood Glucose": int(data_payload[56:58], 16)}
-
+        data = bytes.fromhex(response)
     except ValueError as e:
         return {"error": f"Error parsing values: {str(e)}"}
+    return decode_vitals(data).as_dict()
 
-# Parsing function for battery data
+# Parsing function for battery data (hex string in, dict out; see frames.decode_battery)
 def parse_battery_data(response):
     if len(response) < 10:
-        return {"error": "Battery response too short."}
+        return {"error": ERROR_BATTERY_TOO_SHORT}
 
     try:
-        battery_hex = response[8:12]
-        battery_level = int(battery_hex, 16)
-        return {"Battery Level": battery_level}
+        battery_level, error = decode_battery(bytes.fromhex(response[:12]))
     except ValueError as e:
         return {"error": f"Error parsing battery data: {str(e)}"}
+    if error:
+        return {"error": error}
+    return {"Battery Level": battery_level}
 
 # Function to fetch current data
-async def fetch_current_data(client, write_char_uuid, notify_char_uuid, smartwatch_mac_address, host_mac_address):
-    fixed_command = "DA0D0000AADB"
-    battery_command = "DA060000DB19"
+# router is the client's NotificationRouter; without one, a subscription is opened here.
+# Polling cadence and the write budget come from the gateway-wide scheduler; the first
+# poll is sent immediately. initial_delay, if given, waits that many seconds before it, and
+# on_first_reading(reading) is called once, with the connection's first valid reading;
+# on_reading(reading) is called with every valid reading that is not an isolated outlier.
+# With sync=True the watch is asked once for its battery level and data and the function
+# returns as soon as they are in; otherwise it polls until keep_polling() returns False
+# (forever without it). Returns the last valid reading.
+async def fetch_current_data(client, write_char_uuid, notify_char_uuid, smartwatch_mac_address, host_mac_address, router=None,
+                             scheduler=None, alert_engine=None, initial_delay=None, on_first_reading=None,
+                             on_reading=None, sync=False, keep_polling=None):
+    fixed_command = CURRENT_DATA_COMMAND
+    battery_command = BATTERY_COMMAND
+    scheduler = scheduler or default_scheduler
+    alert_engine = alert_engine or default_engine
 
     # Create a dictionary to store shared data
     shared_data = {
-        "last_parsed_data": None,
+        "last_reading": None,
+        "battery_level": None,
         "last_check_time": time.time(),
-        "unchanged_count": 0  # Counter to track unchanged iterations
+        "window": VitalsWindow(),  # Recent readings, for worn detection, smoothing and glitch rejection
+        "on_first_reading": on_first_reading,
+        "reading_received": asyncio.Event(),
+        "battery_received": asyncio.Event()
     }
 
+    device_log = logs.for_device(log, smartwatch_mac_address)
+
     if client.is_connected:
+        def battery_handler(sender, data):
+            battery_level, error = decode_battery(data)
+            if error:
+                metrics.parse_errors.inc(PARSE_ERROR_LABELS[error])
+                device_log.warning("%s", error)
+            else:
+                device_log.info("Battery level %d%%", battery_level)
+
+                # Save battery level in shared data
+                shared_data["battery_level"] = battery_level
+                shared_data["battery_received"].set()
+
         def notification_handler(sender, data):
-            nonlocal shared_data
-            response = data.hex().upper()
-
-            if response.startswith("DA86"):
-                print(f"{smartwatch_mac_address} Fetching Battery Level...")
-                result = parse_battery_data(response)
-                if "error" in result:
-                    log_error(result["error"])
-                else:
-                    battery_level = result["Battery Level"]
-                    print(f"Battery Level: {battery_level}%")
-
-                    # Save battery level in shared data
-                    if shared_data["last_parsed_data"]:
-                        shared_data["last_parsed_data"]["Battery_Level"] = battery_level
-                    else:
-                        shared_data["last_parsed_data"] = {"Battery_Level": battery_level}
+            received_at = time.monotonic()  # Start of the notification-to-upload latency
+            reading = decode_vitals(data, crc_checked=True)  # The router's reassembler checked it
+            if reading.error is not None:
+                metrics.parse_errors.inc(PARSE_ERROR_LABELS.get(reading.error, INVALID_VITALS_LABELS))
+                if reading.error != ERROR_MEASURING:
+                    device_log.warning("%s", reading.error)
             else:
-                result = parse_watch_data_with_crc(response)
-                if "error" in result:
-                    if result["error"] != "Measuring Vitals":
-                        log_error(result["error"])
+                # Add battery level to the reading if available
+                reading.battery_level = shared_data["battery_level"]
+
+                # Classify worn / not worn from the rolling window of recent readings
+                window = shared_data["window"]
+                glitch = window.push(reading)
+                reading.watch_status = "Worn" if window.is_worn() else "Not Worn"
+                reading.smoothed = window.smoothed()  # Rolling median, for live stream subscribers
+                # Per-frame line: only built when DEBUG is enabled, and rate limited then
+                device_log.debug("Parsed data: %s", reading)
+
+                # Update shared data for the next iteration
+                shared_data["last_reading"] = reading
+                shared_data["last_check_time"] = time.time()
+                shared_data["reading_received"].set()
+                if shared_data["on_first_reading"] is not None:
+                    callback, shared_data["on_first_reading"] = shared_data["on_first_reading"], None
+                    callback(reading)
+
+                # Keep recent history locally for the Flask query endpoints, and push the
+                # reading to live stream subscribers (a no-op when there are none)
+                default_store.record(smartwatch_mac_address, reading, shared_data["last_check_time"])
+                default_hub.publish(smartwatch_mac_address, reading, shared_data["last_check_time"])
+
+                # Raise alerts for rules this reading newly breaches (queued, no network I/O here).
+                # Every reading is evaluated, even a suspected glitch: an alert must not wait
+                # for the window to confirm a real change.
+                for alert_type, alert_text in alert_engine.evaluate(smartwatch_mac_address, reading):
+                    back.send_alert2(smartwatch_mac_address, host_mac_address, alert_type, alert_text,
+                                     received_at=received_at)
+
+                # An isolated outlier does not change the polling cadence until it repeats
+                if glitch:
+                    device_log.warning("Possible sensor glitch, cadence unchanged unless it repeats: %s", reading)
                 else:
-                    print("Parsed Data:")
-                    for key, value in result.items():
-                        print(f"{key}: {value}")
-
-                    # Add battery level to the parsed data if available
-                    if shared_data["last_parsed_data"] and "Battery_Level" in shared_data["last_parsed_data"]:
-                        result["Battery Level"] = shared_data["last_parsed_data"]["Battery_Level"]
-
-                    if all(k in result for k in ["Heart Rate", "Blood Pressure", "Blood Oxygen"]):
-                        # Check if the data is unchanged to determine if the watch is worn
-                        if shared_data["last_parsed_data"]:
-                            unchanged = all(result[key] == shared_data["last_parsed_data"].get(key) for key in ["Heart Rate", "Blood Pressure", "Blood Oxygen"])
-
-                            if unchanged:
-                                shared_data["unchanged_count"] += 1
-                            else:
-                                shared_data["unchanged_count"] = 0
-
-                        # If data hasn't changed for 2 iterations, assume the watch is not worn
-                        if shared_data["unchanged_count"] >= 2:
-                            print(f"{smartwatch_mac_address}: Watch is not worn")
-                            result["Watch Status"] = "Not Worn"
-                        else:
-                            print(f"{smartwatch_mac_address}: Watch is being worn")
-                            result["Watch Status"] = "Worn"
-
-                        # Update shared data for the next iteration
-                        shared_data["last_parsed_data"] = result
-                        shared_data["last_check_time"] = time.time()
-
-                    # Send parsed data to the backend (now includes battery level)
-                    print("Sending data to the server...")
-                    success = back.send_data_to_backend(result, client, smartwatch_mac_address, host_mac_address)
-                    if success:
-                        print("Data sent successfully.")
-                    else:
-                        log_error("Failed to send data to the backend.")
-
-        # Start notifications
-        await client.start_notify(notify_char_uuid, notification_handler)
-
-        while True:
-            # Send fixed command to the smartwatch
-            await client.write_gatt_char(write_char_uuid, bytes.fromhex(fixed_command))
-            await asyncio.sleep(1)  # Wait for a second before sending the battery command
-            await client.write_gatt_char(write_char_uuid, bytes.fromhex(battery_command))
-            await asyncio.sleep(30)  # Wait for 30 seconds before the next iteration
+                    scheduler.report_reading(smartwatch_mac_address, reading)
+                    if on_reading is not None:
+                        on_reading(reading)
+
+                # Queue parsed data for the backend (now includes battery level); the
+                # upload happens on the uploader's threads, never on the BLE loop
+                if not back.queue_data_for_backend(reading.as_dict(), smartwatch_mac_address, host_mac_address,
+                                                   received_at=received_at):
+                    device_log.warning("Upload queue full, dropped the oldest queued reading.")
+
+        # Route battery and vitals frames to their handlers on the client's single subscription
+        own_router = router is None
+        if own_router:
+            router = await NotificationRouter(client, notify_char_uuid).start()
+        router.register(OPCODE_BATTERY, battery_handler)
+        router.register(OPCODE_VITALS, notification_handler)
+
+        poll_state = scheduler.register(smartwatch_mac_address)
+        try:
+            if sync:
+                # One sample: battery first, so the reading is uploaded with it, then the current
+                # vitals. The watch keeps no history, so this is all a sync can fetch.
+                for command, received in ((battery_command, shared_data["battery_received"]),
+                                          (fixed_command, shared_data["reading_received"])):
+                    for attempt in range(SYNC_ATTEMPTS):
+                        await scheduler.write(client, write_char_uuid, command)
+                        try:
+                            await asyncio.wait_for(received.wait(), SYNC_TIMEOUT)
+                            break
+                        except asyncio.TimeoutError:
+                            pass
+                return shared_data["last_reading"]
+
+            if initial_delay:
+                await asyncio.sleep(initial_delay)
+            while True:
+                # Send fixed command to the smartwatch
+                await scheduler.write(client, write_char_uuid, fixed_command)
+                scheduler.poll_sent(poll_state)
+                if scheduler.battery_due(poll_state):
+                    await asyncio.sleep(1)  # Wait for a second before sending the battery command
+                    await scheduler.write(client, write_char_uuid, battery_command)
+                # Staggered after the first poll, then adapted to the watch's last reading
+                await scheduler.wait_for_poll(poll_state)
+                if keep_polling is not None and not keep_polling():
+                    return shared_data["last_reading"]
+        finally:
+            scheduler.unregister(smartwatch_mac_address)
+            router.unregister(OPCODE_BATTERY, battery_handler)
+            router.unregister(OPCODE_VITALS, notification_handler)
+            if own_router:
+                await router.stop()
 
 # Main function to connect to the smartwatch and start fetching data
 async def main(smartwatch_mac_address):
-    host_mac_address = get_host_machine_mac()
+    host_mac_address = host_mac()
     async with BleakClient(smartwatch_mac_address) as client:
         write_char_uuid = "YOUR_WRITE_CHARACTERISTIC_UUID"
         notify_char_uuid = "YOUR_NOTIFY_CHARACTERISTIC_UUID"
@@ -162,5 +212,6 @@ async def main(smartwatch_mac_address):
 
 # Entry point of the script
 if __name__ == "__main__":
+    logs.configure()
     smartwatch_mac_address = "YOUR_SMARTWATCH_MAC_ADDRESS"
     asyncio.run(main(smartwatch_mac_address))
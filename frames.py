@@ -0,0 +1,159 @@
+
+# frames.py
+
+import struct
+from crc_utils import crc16, verify_frame
+
+# Frame layout: DA | opcode | length (2 bytes) | payload | CRC (2 bytes, low byte first)
+FRAME_HEADER = 0xDA
+HEADER_SIZE = 4
+CRC_SIZE = 2
+
+OPCODE_BATTERY = 0x86
+OPCODE_VITALS = 0x8D
+
+# Vitals fields sit at fixed payload offsets: HR 19, SYS 20, DIA 21, SpO2 22, glucose 28
+VITALS_STRUCT = struct.Struct("19xBBBB5xB")
+VITALS_OFFSETS = (("heart_rate", 19), ("systolic", 20), ("diastolic", 21), ("spo2", 22), ("glucose", 28))
+VITALS_MIN_PAYLOAD = 22  # Shorter payloads mean the watch is still measuring
+
+ERROR_TOO_SHORT = "Response too short for CRC verification."
+ERROR_CRC = "CRC verification failed."
+ERROR_MEASURING = "Measuring Vitals"
+ERROR_BATTERY_TOO_SHORT = "Battery response too short."
+
+class VitalsReading:
+    """
+    A decoded vitals frame. Fields are plain ints so no per-field objects are created.
+
+    When decoding fails, error holds the reason and the vitals fields are None.
+    smoothed holds the watch's rolling median per vital, once the gateway set it.
+    """
+
+    __slots__ = ("heart_rate", "systolic", "diastolic", "spo2", "glucose",
+                 "battery_level", "watch_status", "error", "smoothed")
+
+    def __init__(self, heart_rate=None, systolic=None, diastolic=None, spo2=None,
+                 glucose=None, battery_level=None, watch_status=None, error=None):
+        self.heart_rate = heart_rate
+        self.systolic = systolic
+        self.diastolic = diastolic
+        self.spo2 = spo2
+        self.glucose = glucose
+        self.battery_level = battery_level
+        self.watch_status = watch_status
+        self.error = error
+        self.smoothed = None
+
+    @property
+    def blood_pressure(self):
+        return f"{self.systolic}/{self.diastolic}"
+
+    def vitals(self):
+        """Return the fields used to tell whether two readings are identical."""
+        return (self.heart_rate, self.systolic, self.diastolic, self.spo2)
+
+    def as_dict(self):
+        """
+        Convert the reading to the dict layout returned by parse_watch_data_with_crc.
+
+        Returns:
+            dict: Either {"error": ...} or the named vitals, plus battery and watch
+            status when they are known.
+        """
+        if self.error is not None:
+            return {"error": self.error}
+        result = {
+            "Heart Rate": self.heart_rate,
+            "Blood Pressure": self.blood_pressure,
+            "Blood Oxygen": self.spo2,
+            "Blood Glucose": self.glucose,
+        }
+        if self.battery_level is not None:
+            result["Battery Level"] = self.battery_level
+        if self.watch_status is not None:
+            result["Watch Status"] = self.watch_status
+        return result
+
+    def __repr__(self):
+        if self.error is not None:
+            return f"VitalsReading(error={self.error!r})"
+        return (f"VitalsReading(heart_rate={self.heart_rate}, blood_pressure={self.blood_pressure}, "
+                f"spo2={self.spo2}, glucose={self.glucose}, battery_level={self.battery_level}, "
+                f"watch_status={self.watch_status!r})")
+
+def opcode(data):
+    """
+    Return the opcode byte of a notification, or None if it is not a DA frame.
+
+    Parameters:
+        data (bytes | bytearray | memoryview): The raw notification.
+
+    Returns:
+        int | None: The opcode.
+    """
+    if len(data) < 2 or data[0] != FRAME_HEADER:
+        return None
+    return data[1]
+
+def decode_vitals(data, crc_checked=False):
+    """
+    Decode a vitals notification straight from its bytes.
+
+    Parameters:
+        data (bytes | bytearray | memoryview): The raw notification, CRC included.
+        crc_checked (bool): The CRC was already verified (frames from a FrameReassembler).
+
+    Returns:
+        VitalsReading: The decoded reading, or one with error set.
+    """
+    length = len(data)
+    if length < 3:
+        return VitalsReading(error=ERROR_TOO_SHORT)
+    if not crc_checked and not verify_frame(data):
+        return VitalsReading(error=ERROR_CRC)
+    payload_length = length - HEADER_SIZE - CRC_SIZE
+    if payload_length < VITALS_MIN_PAYLOAD:
+        return VitalsReading(error=ERROR_MEASURING)
+    if payload_length < VITALS_STRUCT.size:
+        return VitalsReading(error=f"Error parsing values: payload has {payload_length} bytes")
+    heart_rate, systolic, diastolic, spo2, glucose = VITALS_STRUCT.unpack_from(data, HEADER_SIZE)
+    return VitalsReading(heart_rate, systolic, diastolic, spo2, glucose)
+
+def decode_battery(data):
+    """
+    Decode the battery level from a DA86 notification.
+
+    Parameters:
+        data (bytes | bytearray | memoryview): The raw notification.
+
+    Returns:
+        tuple: (battery_level, error); exactly one of them is None.
+    """
+    length = len(data)
+    if length < 5:
+        return None, ERROR_BATTERY_TOO_SHORT
+    if length == 5:
+        return data[4], None
+    return (data[4] << 8) | data[5], None
+
+def build_frame(frame_opcode, payload=b""):
+    """
+    Build a complete frame: header, little-endian length, payload and CRC.
+
+    Parameters:
+        frame_opcode (int): The opcode byte.
+        payload (bytes): The payload.
+
+    Returns:
+        bytes: The frame as the watch would send it.
+    """
+    body = bytes((FRAME_HEADER, frame_opcode)) + len(payload).to_bytes(2, "little") + bytes(payload)
+    crc = crc16(body, 0, len(body))
+    return body + bytes((crc & 0xFF, crc >> 8))
+
+def build_vitals_frame(heart_rate, systolic, diastolic, spo2, glucose, payload_length=30):
+    """Build a DA8D vitals frame with the fields at the offsets decode_vitals reads."""
+    payload = bytearray(payload_length)
+    VITALS_STRUCT.pack_into(payload, 0, heart_rate, systolic, diastolic, spo2, glucose)
+    return build_frame(OPCODE_VITALS, payload)
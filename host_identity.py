@@ -0,0 +1,76 @@
+
+# host_identity.py
+#
+# The gateway's own MAC address, sent as fbd_mac_address with every payload. It is
+# resolved once and cached: it used to be looked up by running ifconfig on every
+# connection attempt.
+
+import os
+import uuid
+import logs
+
+log = logs.get_logger("host_identity")
+
+# Interfaces preferred for the host identity, in order; any other interface is used after them
+PREFERRED_INTERFACES = ("eth0", "wlan0")
+
+SYS_CLASS_NET = "/sys/class/net"
+
+# Cached address, set by resolve_host_mac()
+_host_mac = None
+_resolved = False
+
+def _read_interface_mac(interface):
+    try:
+        with open(os.path.join(SYS_CLASS_NET, interface, "address")) as f:
+            address = f.read().strip().lower()
+    except OSError:
+        return None
+    if not address or address == "00:00:00:00:00:00":
+        return None
+    return address
+
+def _sysfs_mac():
+    """Read the MAC address of the preferred interface from sysfs (Linux), or None."""
+    try:
+        interfaces = sorted(os.listdir(SYS_CLASS_NET))
+    except OSError:
+        return None
+    ordered = [name for name in PREFERRED_INTERFACES if name in interfaces]
+    ordered += [name for name in interfaces if name not in PREFERRED_INTERFACES and name != "lo"]
+    for interface in ordered:
+        address = _read_interface_mac(interface)
+        if address is not None:
+            return address
+    return None
+
+def _node_mac():
+    """MAC address from uuid.getnode(), or None when it had to make up a random one."""
+    node = uuid.getnode()
+    if node >> 40 & 0x01:  # Multicast bit set: getnode() found no hardware address
+        return None
+    return ":".join(f"{node >> shift & 0xFF:02x}" for shift in range(40, -1, -8))
+
+def resolve_host_mac(refresh=False):
+    """
+    Look up the host MAC address once, without starting a subprocess.
+
+    Parameters:
+        refresh (bool): Look it up again even if it was already resolved.
+
+    Returns:
+        str | None: The address as aa:bb:cc:dd:ee:ff, or None if none was found.
+    """
+    global _host_mac, _resolved
+    if not _resolved or refresh:
+        _host_mac = _sysfs_mac() or _node_mac()
+        _resolved = True
+        if _host_mac:
+            log.debug("Host MAC address: %s", _host_mac)
+        else:
+            log.warning("No host MAC address found.")
+    return _host_mac
+
+# Cached host MAC address, resolved on first use
+def host_mac():
+    return _host_mac if _resolved else resolve_host_mac()
@@ -0,0 +1,190 @@
+
+# logs.py
+#
+# Structured, asynchronous logging for the gateway. Records are put on a bounded
+# queue by the calling thread (usually the BLE event loop) and formatted and written
+# by one background thread, so a log line never waits on stdout or journald.
+#
+#   log = logs.get_logger("currentdata")
+#   device_log = logs.for_device(log, address)
+#   device_log.debug("Parsed data: %s", reading, extra=logs.fields(hr=72))
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+import metrics
+
+ROOT_LOGGER = "gateway"
+
+# Records waiting for the writer thread; when full, new records are dropped
+QUEUE_SIZE = 10000
+
+# Default rate limit for DEBUG records: one per (logger, device, message template)
+# every RATE_LIMIT_INTERVAL seconds
+RATE_LIMIT_INTERVAL = 10.0
+
+log_dropped = metrics.Counter("gateway_log_dropped_total", "Log records dropped, by reason (queue_full or rate_limited).",
+                              ("reason",))
+QUEUE_FULL_LABELS = ("queue_full",)
+RATE_LIMITED_LABELS = ("rate_limited",)
+
+_listener = None
+_handler = None
+
+def get_logger(name):
+    """
+    Return the logger of one gateway module.
+
+    Parameters:
+        name (str): Module name, e.g. "connect".
+
+    Returns:
+        logging.Logger: A child of the gateway logger.
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
+
+class DeviceLogger(logging.LoggerAdapter):
+    """Adapter that tags every record with the watch address, keeping any other extra."""
+
+    def process(self, msg, kwargs):
+        kwargs["extra"] = {**self.extra, **kwargs["extra"]} if "extra" in kwargs else self.extra
+        return msg, kwargs
+
+def for_device(logger, address):
+    """Return a DeviceLogger that tags every record of logger with the watch address."""
+    return DeviceLogger(logger, {"device": address})
+
+def fields(**values):
+    """Structured key/value fields for one record, passed as extra=logs.fields(...)."""
+    return {"fields": values}
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most one record per (logger, device, message template) every
+    interval seconds, for records below max_level (so DEBUG only, by default). The
+    next record that gets through carries the number suppressed in between.
+
+    Parameters:
+        interval (float): Seconds between two records with the same key.
+        max_level (int): Records at or above this level are never limited.
+    """
+
+    def __init__(self, interval=RATE_LIMIT_INTERVAL, max_level=logging.INFO):
+        super().__init__()
+        self.interval = interval
+        self.max_level = max_level
+        self._last = {}  # key -> [monotonic time of the last record let through, suppressed count]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.max_level or self.interval <= 0:
+            return True
+        key = (record.name, getattr(record, "device", None), record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._last.get(key)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                log_dropped.inc(RATE_LIMITED_LABELS)
+                return False
+            suppressed = state[1] if state is not None else 0
+            self._last[key] = [now, 0]
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that never blocks and never formats on the calling thread.
+
+    The stdlib handler formats the message before queuing it so the record can be
+    pickled; this queue stays in the process, so formatting is left to the writer
+    thread. Arguments must therefore not be mutated after they are logged.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped.inc(QUEUE_FULL_LABELS)
+
+class StructuredFormatter(logging.Formatter):
+    """
+    One line per record: time, level, logger, device, message and key=value fields,
+    or the same as a JSON object with json_lines=True.
+    """
+
+    def __init__(self, json_lines=False):
+        super().__init__()
+        self.json_lines = json_lines
+
+    def format(self, record):
+        values = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        device = getattr(record, "device", None)
+        if device is not None:
+            values["device"] = device
+        values["message"] = record.getMessage()
+        values.update(getattr(record, "fields", None) or {})
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            values["suppressed"] = suppressed
+        if record.exc_info:
+            values["exception"] = self.formatException(record.exc_info)
+        if self.json_lines:
+            return json.dumps(values, default=str)
+        head = f"{values.pop('time')} {values.pop('level'):7s} {values.pop('logger')}"
+        if "device" in values:
+            head += f" [{values.pop('device')}]"
+        message = values.pop("message")
+        extra = " ".join(f"{key}={value}" for key, value in values.items())
+        return f"{head} {message} {extra}" if extra else f"{head} {message}"
+
+def configure(level="INFO", json_lines=False, stream=None, rate_limit_interval=RATE_LIMIT_INTERVAL):
+    """
+    Route the gateway loggers through the queue to a background writer thread.
+
+    Parameters:
+        level (str | int): Lowest level logged. DEBUG enables the per-frame lines.
+        json_lines (bool): Write one JSON object per line instead of key=value text.
+        stream (file): Where records are written, defaults to sys.stderr.
+        rate_limit_interval (float): Seconds between two DEBUG records with
+            the same logger, device and message template; 0 disables rate limiting.
+
+    Returns:
+        logging.handlers.QueueListener: The running writer.
+    """
+    global _listener, _handler
+    shutdown()
+    records = queue.Queue(maxsize=QUEUE_SIZE)
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(StructuredFormatter(json_lines))
+    _handler = _DroppingQueueHandler(records)
+    _handler.addFilter(RateLimitFilter(rate_limit_interval))
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(level)
+    root.addHandler(_handler)
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(records, writer)
+    _listener.start()
+    return _listener
+
+def shutdown():
+    """Write whatever is still queued and stop the writer thread."""
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger(ROOT_LOGGER).removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,14 +1,71 @@
 import asyncio
-import subprocess
+import time
 import threading
-from flask import Flask, jsonify
-from scan import scan_ble_devices  # BLE device scanning functionality
+from flask import Flask, Response, jsonify, request
+import metrics  # Counters and histograms served on /metrics
+import logs  # Structured logging, written by a background thread
+import capture  # Optional raw notification recording
+from server import GatewayServer  # Async HTTP server sharing the BLE loop, with live streams
+from scan import DeviceRegistry, BackgroundScanner, APPEARED  # Always-on BLE discovery
 from connect import connect_to_device  # BLE device connection functionality
+from sessions import SessionManager, QUEUED, STREAMING  # One live session per watch, capped concurrency
+from timeseries import default_store  # Recent readings of every watch, for the query endpoints
+from host_identity import resolve_host_mac  # The gateway's own MAC address, looked up once
+from watch_cache import default_cache  # Per-watch handshake state, for fast reconnects
+from sync import SyncPolicy, LIVE, SYNC  # Periodic sync instead of live polling, except for high-risk watches
+
+log = logs.get_logger("merging")
 
 # The GATT characteristic UUIDs
 WRITE_CHAR_UUID = "6e400002-b5a3-f393-e0a9-e50e24dcca9d"
 NOTIFY_CHAR_UUID = "6e400003-b5a3-f393-e0a9-e50e24dcca9d"
 
+# Watches not heard for this many seconds (and not connected) are evicted from the registry
+STALE_AFTER = 60
+
+# Seconds between status lines
+STATUS_INTERVAL = 10
+
+# Maximum number of watches connected at the same time (per adapter when ADAPTERS is set)
+MAX_CONCURRENT_CONNECTIONS = 8
+
+# Bluetooth adapters to spread the watches over, one worker process each (e.g.
+# ["hci0", "hci1", "hci2"]); None scans and connects on the default adapter in this process
+ADAPTERS = None
+
+# "async" serves the API and the live vitals streams from the BLE event loop;
+# "flask" runs Flask's development server in a thread instead (no streams)
+SERVER_MODE = "async"
+SERVER_PORT = 5000
+
+# Directory to record every raw notification to (replay with capture.py); None disables it
+CAPTURE_DIRECTORY = None
+
+# Seconds between syncs: each watch is connected, asked for its current vitals once and
+# disconnected again. None keeps every watch connected and polled live. The watch has no
+# stored history to download, so every reading it takes between two syncs is lost: at
+# sync.DEFAULT_INTERVAL (60 s) that is half the data of live polling, at 300 s a tenth,
+# and an abnormal episode between syncs is never seen and never escalates the watch to
+# live polling. Only use it where adapter capacity matters more than that.
+SYNC_INTERVAL = None
+
+# Watches that are always polled live, even in sync mode (watches with an abnormal
+# reading are also polled live for a while, see sync.ESCALATION_HOLD). Sync mode stays
+# off while this is empty and no watch is flagged through /api/devices/<address>/high-risk
+HIGH_RISK_DEVICES = []
+
+# Seconds between checks for watches whose next sync is due
+SYNC_CHECK_INTERVAL = 2
+
+# Session manager and sync policy, created when scanning starts; with ADAPTERS, the shard
+# coordinator instead (sessions and handshake cache then live in its worker processes)
+session_manager = None
+sync_policy = None
+shard_coordinator = None
+
+# Live registry of every watch the background scanner hears
+device_registry = DeviceRegistry(stale_after=STALE_AFTER)
+
 # Flask app for serving the FBD MAC address
 app = Flask(__name__)
 
@@ -23,83 +80,231 @@ def get_mac_address():
     else:
         return jsonify({"error": "FBD MAC address not found."}), 404
 
-# Function to dynamically fetch the MAC address of the local machine (using ifconfig or ip command)
-def get_local_mac_address():
+# Sessions by state and the number of watches streaming, read when /metrics is scraped
+def _session_states():
+    counts = {}
+    if shard_coordinator:
+        states = [session["state"] for session in shard_coordinator.sessions()]
+    else:
+        states = [session.state for session in list(session_manager.sessions.values())] if session_manager else []
+    for state in states:
+        counts[(state,)] = counts.get((state,), 0) + 1
+    return counts
+
+metrics.Gauge("gateway_connected_devices", "Watches connected and streaming vitals.",
+              lambda: _session_states().get((STREAMING,), 0))
+metrics.Gauge("gateway_sessions", "Watch sessions by state.", _session_states, ("state",))
+metrics.Gauge("gateway_known_devices", "Watches heard by the background scanner.", lambda: len(device_registry.devices))
+
+# Prometheus scrape endpoint
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# Parse an optional float query parameter
+def _float_arg(name, default=None):
+    value = request.args.get(name)
+    return default if value is None else float(value)
+
+# API endpoint listing every watch with local history
+@app.route('/api/devices', methods=['GET'])
+def list_devices():
+    return jsonify({address: default_store.get(address).latest() for address in default_store.addresses()})
+
+# API endpoint for the latest reading of one watch
+@app.route('/api/devices/<address>/latest', methods=['GET'])
+def device_latest(address):
+    series = default_store.get(address)
+    latest = series.latest() if series else None
+    if latest is None:
+        return jsonify({"error": "No readings for this device."}), 404
+    return jsonify(latest)
+
+# API endpoint for raw readings in a time range (?start=&end= unix seconds, &limit=)
+@app.route('/api/devices/<address>/history', methods=['GET'])
+def device_history(address):
+    series = default_store.get(address)
+    if series is None:
+        return jsonify({"error": "No readings for this device."}), 404
+    try:
+        limit = request.args.get("limit")
+        readings = series.range(_float_arg("start"), _float_arg("end"), int(limit) if limit else None)
+    except ValueError:
+        return jsonify({"error": "start, end and limit must be numbers."}), 400
+    return jsonify(readings)
+
+# API endpoint for downsampled min/mean/max per bucket (?start=&end=&bucket= seconds)
+@app.route('/api/devices/<address>/aggregate', methods=['GET'])
+def device_aggregate(address):
+    series = default_store.get(address)
+    if series is None:
+        return jsonify({"error": "No readings for this device."}), 404
     try:
-        # Run the ifconfig command and capture output
-        output = subprocess.check_output("ifconfig", universal_newlines=True)
-
-        # Search for the MAC address in the output (eth0 for Ethernet or wlan0 for Wi-Fi)
-        # We'll look for eth0 first, then wlan0 as a fallback
-        for interface in ["eth0", "wlan0"]:
-            # Check if the interface exists in the output
-            if interface in output:
-                # Look for the MAC address (after the word "ether")
-                start_index = output.find("ether", output.find(interface))
-                if start_index != -1:
-                    # Extract MAC address
-                    mac_address = output[start_index + 6:start_index + 23]
-                    return mac_address.strip()
-        
-        # If no MAC address found for the interfaces
-        print("No MAC address found for eth0 or wlan0.")
-        return None
-
-    except Exception as e:
-        print(f"Error fetching MAC address: {e}")
-        return None
+        bucket = _float_arg("bucket", 60.0)
+        if bucket <= 0:
+            raise ValueError
+        buckets = series.aggregate(_float_arg("start"), _float_arg("end"), bucket)
+    except ValueError:
+        return jsonify({"error": "start, end and bucket must be numbers, bucket > 0."}), 400
+    return jsonify(buckets)
+
+# API endpoint for each watch's cached handshake state and its last connect-to-first-reading time
+@app.route('/api/connections', methods=['GET'])
+def list_connections():
+    return jsonify(shard_coordinator.connections() if shard_coordinator else default_cache.snapshot())
+
+# API endpoint for each watch's sync mode and schedule
+@app.route('/api/sync', methods=['GET'])
+def list_sync():
+    return jsonify(sync_policy.snapshot() if sync_policy else {})
+
+# API endpoint to flag a watch high-risk (always polled live) or clear the flag ({"high_risk": true|false})
+@app.route('/api/devices/<address>/high-risk', methods=['PUT'])
+def set_high_risk(address):
+    body = request.get_json(silent=True) or {}
+    high_risk = body.get("high_risk")
+    if not isinstance(high_risk, bool):
+        return jsonify({"error": "Body must be {\"high_risk\": true|false}."}), 400
+    if high_risk and address not in HIGH_RISK_DEVICES:
+        HIGH_RISK_DEVICES.append(address)
+    elif not high_risk and address in HIGH_RISK_DEVICES:
+        HIGH_RISK_DEVICES.remove(address)
+    if sync_policy:
+        sync_policy.set_high_risk(address, high_risk)
+    return jsonify({"address": address, "high_risk": high_risk})
 
 # Connect to the device and extract data with retry logic
-async def connect_and_extract_data(device, write_char_uuid, notify_char_uuid, max_retries=5):
+# (returns True once data was fetched; sync, on_reading and keep_polling go to connect_to_device)
+async def connect_and_extract_data(device, write_char_uuid, notify_char_uuid, max_retries=5, on_state=None, adapter=None,
+                                   sync=False, on_reading=None, keep_polling=None):
+    device_log = logs.for_device(log, device.address)
     for attempt in range(max_retries):
         try:
             # Connect to the device
-            print(f"Attempting to connect to {device.name} ({device.address})... (Attempt {attempt + 1})")
-            await connect_to_device(device.address, write_char_uuid, notify_char_uuid)
+            device_log.info("Attempting to connect to %s (attempt %d)", device.name, attempt + 1)
+            client = await connect_to_device(device.address, write_char_uuid, notify_char_uuid, on_state=on_state,
+                                             adapter=adapter, sync=sync, on_reading=on_reading,
+                                             keep_polling=keep_polling)
 
             # Add your logic here to extract data from the device
-            print(f"Data extracted from {device.name} ({device.address}) successfully.")
-            return  # Exit the function if successful
+            device_log.info("Data extracted from %s successfully.", device.name)
+            return client is not None  # Exit the function if successful
 
         except Exception as e:
-            print(f"Failed to connect to {device.name} ({device.address}): {str(e)}")
+            device_log.warning("Failed to connect to %s: %s", device.name, e)
             await asyncio.sleep(2)  # Wait before retrying
 
-    print(f"Giving up on connecting to {device.name} ({device.address}) after {max_retries} attempts.")
+    device_log.error("Giving up on connecting to %s after %d attempts.", device.name, max_retries)
+    return False
 
-# Continuously scan for devices and connect to the ones that match criteria
-async def continuous_scan_and_connect():
-    processed_devices = set()  # Create a set to track processed devices
-    while True:
-        print("Starting BLE Scan...")
-        devices = await scan_ble_devices()  # Run the scanner
+# Session body run by the session manager for each watch
+async def run_watch_session(device, on_state):
+    def track_state(state):
+        on_state(state)
+        device_registry.set_connection_state(device.address, state)
+
+    address = device.address
+    mode = sync_policy.mode(address)
+    readings = [0]
+
+    def on_reading(reading):
+        readings[0] += 1
+        sync_policy.report_reading(address, reading)
+
+    try:
+        await connect_and_extract_data(
+            device, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID, on_state=track_state, sync=mode == SYNC,
+            on_reading=on_reading, keep_polling=(lambda: sync_policy.keep_live(address)) if mode == LIVE else None)
+    finally:
+        # Only a session that delivered a reading pushes the next sync a full interval out
+        sync_policy.session_ended(address, mode, readings[0] > 0)
+        # Forget the watch so its next advertisement queues a fresh session
+        device_registry.forget(address)
 
-        # Filter devices whose name starts with "GT"
-        target_devices = [device for device in devices if device.name and device.name.startswith("GT")]
+# Queue a watch for a session
+def offer_watch(entry):
+    if session_manager.offer(entry):
+        device_registry.set_connection_state(entry.address, QUEUED)
+        log.info("Found device %s. Queued for connection...", entry.name, extra={"device": entry.address})
 
-        # Check if there are any target devices
-        if target_devices:
-            # Attempt to connect to the first device found
-            device = target_devices[0]  # Get the first device
-            print(f"Found device: {device.name} ({device.address}). Attempting to connect...")
-            asyncio.create_task(connect_and_extract_data(device, WRITE_CHAR_UUID, NOTIFY_CHAR_UUID))
+# Queue every watch the background scanner reports as newly appeared, unless its next sync is not due yet
+def on_registry_event(event, entry):
+    if event == APPEARED and sync_policy.due(entry.address):
+        offer_watch(entry)
 
-        # Wait for a short period before scanning again
-        await asyncio.sleep(10)  # Adjust the delay as needed
+# Queue the watches whose next sync has come due since they were last heard
+async def offer_due_watches():
+    while True:
+        await asyncio.sleep(SYNC_CHECK_INTERVAL)
+        now = time.monotonic()
+        for entry in list(device_registry.devices.values()):
+            if entry.connection_state is None and sync_policy.due(entry.address, now):
+                offer_watch(entry)
+
+# Scan continuously in the background and hand every matching watch to the session manager
+async def continuous_scan_and_connect():
+    global session_manager, sync_policy
+    session_manager = SessionManager(run_watch_session, max_concurrent=MAX_CONCURRENT_CONNECTIONS)
+    sync_policy = SyncPolicy(interval=SYNC_INTERVAL, high_risk=HIGH_RISK_DEVICES)
+    if SYNC_INTERVAL is not None and not HIGH_RISK_DEVICES:
+        log.warning("SYNC_INTERVAL is set but HIGH_RISK_DEVICES is empty: periodic sample sync stays off "
+                    "and every watch is polled live until one is flagged high-risk")
+    elif SYNC_INTERVAL is not None:
+        log.warning("Periodic sample sync every %.0fs: one reading per connection, readings in between "
+                    "are not recorded", SYNC_INTERVAL)
+    device_registry.subscribe(on_registry_event)
+    scanner = BackgroundScanner(device_registry)
+    tasks = [asyncio.create_task(session_manager.run()), asyncio.create_task(scanner.run())]
+    if SYNC_INTERVAL is not None:
+        tasks.append(asyncio.create_task(offer_due_watches()))
+    try:
+        while True:
+            await asyncio.sleep(STATUS_INTERVAL)
+            log.info("Devices: %d known, %d connected, %d waiting", len(device_registry.devices),
+                     session_manager.active_count(), session_manager.queued_count())
+    finally:
+        device_registry.unsubscribe(on_registry_event)
+        for task in tasks:
+            task.cancel()
+
+# Scan and connect on the default adapter, or on every adapter in ADAPTERS through sharding workers
+async def scan_and_connect():
+    global shard_coordinator
+    if ADAPTERS:
+        from sharding import ShardCoordinator  # Imported here: the workers import this module
+        shard_coordinator = ShardCoordinator(ADAPTERS, max_per_adapter=MAX_CONCURRENT_CONNECTIONS)
+        await shard_coordinator.run()
+    else:
+        await continuous_scan_and_connect()
 
 # Start the Flask server in a separate thread
 def run_flask():
-    app.run(host='0.0.0.0', port=5000, debug=False, use_reloader=False)  # Disable Flask's reloader
+    app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, use_reloader=False)  # Disable Flask's reloader
+
+# Serve the API and live streams on the same event loop as the BLE sessions
+async def serve_and_scan():
+    server = await GatewayServer(app, port=SERVER_PORT).start()
+    try:
+        await scan_and_connect()
+    finally:
+        await server.stop()
 
 if __name__ == "__main__":
+    logs.configure()
+    if CAPTURE_DIRECTORY:
+        capture.enable(CAPTURE_DIRECTORY)
+
     # Fetch the local MAC address and store it
-    fbd_mac_address = get_local_mac_address()
+    fbd_mac_address = resolve_host_mac()
     if fbd_mac_address:
-        print(f"Local FBD MAC address: {fbd_mac_address}")
+        log.info("Local FBD MAC address: %s", fbd_mac_address)
     
-    # Start the Flask server in a background thread
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
+    if SERVER_MODE == "async":
+        asyncio.run(serve_and_scan())
+    else:
+        # Start the Flask server in a background thread
+        flask_thread = threading.Thread(target=run_flask)
+        flask_thread.start()
 
-    # Run the continuous scan and connect logic
-    asyncio.run(continuous_scan_and_connect())
+        # Run the continuous scan and connect logic
+        asyncio.run(scan_and_connect())
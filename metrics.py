@@ -0,0 +1,208 @@
+
+# metrics.py
+#
+# Prometheus-style counters and histograms for the gateway, rendered in the text
+# exposition format by the /metrics endpoint in merging.py.
+
+import bisect
+import logging
+import threading
+
+# Latency buckets in seconds: sub-millisecond handler work up to slow backend posts
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Every metric rendered by render(), in registration order
+_registry = []
+
+class _ThreadSharded:
+    """
+    Base for metrics updated from several threads without a lock on the hot path.
+
+    Every thread writes only to its own shard (a dict from label values to the
+    thread's partial value), so an update is a plain dict operation on data no other
+    thread writes. The lock is only taken the first time a thread records, to add
+    its shard to the list, and by a scrape to copy that list. A scrape sums the
+    shards; it may miss an update that is in progress, never double-count one.
+    """
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        _registry.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _collected_shards(self):
+        with self._shards_lock:
+            shards = list(self._shards)
+        # Copying a dict's items is a single step under the GIL
+        return [list(shard.items()) for shard in shards]
+
+class Counter(_ThreadSharded):
+    """
+    Monotonic counter, optionally split by labels.
+
+    Parameters:
+        name (str): Metric name.
+        help_text (str): One-line description.
+        labelnames (tuple): Label names; inc() takes the values in the same order.
+    """
+
+    metric_type = "counter"
+
+    def inc(self, labels=(), amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return sum(value for items in self._collected_shards() for key, value in items if key == labels)
+
+    def samples(self):
+        totals = {}
+        for items in self._collected_shards():
+            for labels, value in items:
+                totals[labels] = totals.get(labels, 0) + value
+        return [(self.name, zip(self.labelnames, labels), value) for labels, value in sorted(totals.items())]
+
+class Histogram(_ThreadSharded):
+    """
+    Histogram with fixed upper bounds, optionally split by labels.
+
+    Parameters:
+        name (str): Metric name.
+        help_text (str): One-line description.
+        labelnames (tuple): Label names; observe() takes the values in the same order.
+        buckets (tuple): Increasing upper bounds; +Inf is implied.
+    """
+
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            state = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def samples(self):
+        totals = {}
+        for items in self._collected_shards():
+            for labels, state in items:
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = list(state)
+                else:
+                    totals[labels] = [a + b for a, b in zip(total, state)]
+        samples = []
+        for labels, state in sorted(totals.items()):
+            pairs = tuple(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state):
+                cumulative += count
+                samples.append((self.name + "_bucket", pairs + (("le", _format_value(bound)),), cumulative))
+            samples.append((self.name + "_sum", pairs, state[-2]))
+            samples.append((self.name + "_count", pairs, state[-1]))
+        return samples
+
+class Gauge:
+    """
+    Value read at scrape time, so nothing is recorded on the hot path.
+
+    Parameters:
+        name (str): Metric name.
+        help_text (str): One-line description.
+        function (callable): Returns a number, or a dict from label value tuples to
+            numbers when labelnames is given.
+        labelnames (tuple): Label names.
+    """
+
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, function, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+        self.labelnames = tuple(labelnames)
+        _registry.append(self)
+
+    def samples(self):
+        try:
+            value = self.function()
+        except Exception as e:
+            logging.getLogger("gateway.metrics").warning("Error collecting %s: %s", self.name, e)
+            return []
+        if not self.labelnames:
+            return [(self.name, (), value)]
+        return [(self.name, zip(self.labelnames, labels), item) for labels, item in sorted(value.items())]
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def render():
+    """
+    Render every registered metric in the Prometheus text exposition format.
+
+    Returns:
+        str: The exposition text.
+    """
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        for sample_name, pairs, value in metric.samples():
+            labels = ",".join(f'{name}="{_escape(label)}"' for name, label in pairs)
+            if labels:
+                lines.append(f"{sample_name}{{{labels}}} {_format_value(value)}")
+            else:
+                lines.append(f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+# Label tuples for every opcode, built once so counting a notification allocates nothing
+OPCODE_LABELS = tuple((f"DA{value:02X}",) for value in range(256))
+
+# Gateway metrics. Gauges that need other modules' state are registered by those modules.
+notifications = Counter(
+    "gateway_notifications_total", "Frames received over BLE notifications, by response opcode.", ("opcode",))
+crc_failures = Counter(
+    "gateway_crc_failures_total", "Frames whose CRC-16 did not match.")
+parse_errors = Counter(
+    "gateway_parse_errors_total", "Notifications that could not be decoded, by frame kind and reason.",
+    ("kind", "reason"))
+handshake_step_seconds = Histogram(
+    "gateway_handshake_step_seconds", "Duration of each handshake step, retries included.", ("step", "result"))
+notification_to_upload_seconds = Histogram(
+    "gateway_notification_to_upload_seconds",
+    "Time from a vitals notification arriving to the backend accepting its payload.", ("kind",))
+backend_post_seconds = Histogram(
+    "gateway_backend_post_seconds", "Duration of backend POST requests.", ("kind",))
+backend_post_failures = Counter(
+    "gateway_backend_post_failures_total", "Backend POSTs that failed, by reason (status or error).",
+    ("kind", "reason"))
+upload_dropped = Counter(
+    "gateway_upload_dropped_total", "Payloads dropped from a full upload queue.", ("kind",))
+
@@ -0,0 +1,246 @@
+
+# outbox.py
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+DEFAULT_PATH = "outbox.db"
+
+class Outbox:
+    """
+    Durable, append-only store for outgoing payloads (SQLite in WAL mode).
+
+    Every payload is appended with an idempotency key before it is sent and is
+    deleted once the backend acknowledged it, so a reading survives both a backend
+    outage and a gateway restart (at-least-once delivery). Appends, acks and retry
+    updates are applied by one writer thread that commits them in groups, so there
+    is at most one fsync per commit_interval rather than one per reading.
+
+    Parameters:
+        path (str): SQLite database file.
+        commit_interval (float): Longest time an append waits before it is committed.
+        commit_batch (int): Number of operations that forces an early commit.
+        grace (float): Seconds a fresh payload is left to the live uploader before
+            the replayer is allowed to send it.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, commit_interval=0.2, commit_batch=500, grace=30.0):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self.grace = grace
+        self._ops = queue.Queue()
+        self._writer = None
+        self._closed = threading.Event()
+        conn = self._connect()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                idempotency_key TEXT NOT NULL UNIQUE,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL
+            )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (next_attempt)")
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL + NORMAL: durable at each checkpoint, no fsync per commit
+        return conn
+
+    def start(self):
+        if self._writer is None:
+            self._closed.clear()
+            self._writer = threading.Thread(target=self._write_loop, name="outbox-writer", daemon=True)
+            self._writer.start()
+        return self
+
+    def close(self, timeout=5):
+        """Commit everything still pending and stop the writer thread."""
+        self._closed.set()
+        if self._writer is not None:
+            self._writer.join(timeout)
+            self._writer = None
+
+    def append(self, kind, payload, key=None):
+        """
+        Record an outgoing payload. Returns immediately; the write is group-committed.
+
+        Parameters:
+            kind (str): Which endpoint the payload is for ("vitals" or "alerts").
+            payload (dict): The JSON payload.
+            key (str): Idempotency key, generated when not given.
+
+        Returns:
+            str: The idempotency key to send with the payload and to ack it with.
+        """
+        key = key or uuid.uuid4().hex
+        now = time.time()
+        self._ops.put(("append", (key, kind, json.dumps(payload), now, now + self.grace)))
+        return key
+
+    def ack(self, key):
+        """Forget a payload the backend has accepted."""
+        self._ops.put(("ack", (key,)))
+
+    def retry(self, key, attempts, next_attempt):
+        """Record a failed delivery and when it may be tried again."""
+        self._ops.put(("retry", (attempts, next_attempt, key)))
+
+    def due(self, limit=100, conn=None):
+        """
+        Read payloads whose next attempt is due, oldest first.
+
+        Returns:
+            list: (key, kind, payload, attempts) tuples.
+        """
+        own = conn is None
+        conn = conn or self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT idempotency_key, kind, payload, attempts FROM outbox "
+                "WHERE next_attempt <= ? ORDER BY id LIMIT ?", (time.time(), limit)).fetchall()
+        finally:
+            if own:
+                conn.close()
+        return [(key, kind, json.loads(payload), attempts) for key, kind, payload, attempts in rows]
+
+    def flush(self, timeout=None):
+        """Block until every operation queued so far has been committed."""
+        if self._writer is None:
+            return False
+        done = threading.Event()
+        self._ops.put(("flush", done))
+        return done.wait(timeout)
+
+    def pending_count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        finally:
+            conn.close()
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while not (self._closed.is_set() and self._ops.empty()):
+                try:
+                    ops = [self._ops.get(timeout=self.commit_interval)]
+                except queue.Empty:
+                    continue
+                deadline = time.monotonic() + self.commit_interval
+                while len(ops) < self.commit_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        ops.append(self._ops.get(timeout=remaining))
+                    except queue.Empty:
+                        break
+                self._commit(conn, ops)
+        finally:
+            conn.close()
+
+    def _commit(self, conn, ops):
+        grouped = {"append": [], "retry": [], "ack": [], "flush": []}
+        for op, args in ops:
+            grouped[op].append(args)
+        # Appends first, so an ack for a payload appended in the same group still applies
+        with conn:
+            if grouped["append"]:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO outbox (idempotency_key, kind, payload, created, next_attempt) "
+                    "VALUES (?, ?, ?, ?, ?)", grouped["append"])
+            if grouped["retry"]:
+                conn.executemany(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE idempotency_key = ?",
+                    grouped["retry"])
+            if grouped["ack"]:
+                conn.executemany("DELETE FROM outbox WHERE idempotency_key = ?", grouped["ack"])
+        for done in grouped["flush"]:
+            done.set()
+
+class OutboxReplayer:
+    """
+    Background thread that resends due payloads from an Outbox.
+
+    Each round reads up to batch_size due payloads and sends them at no more than
+    max_per_second. The first failure ends the round and pushes that payload back
+    with exponential backoff, so a backend that is still down is probed, not flooded.
+
+    Parameters:
+        outbox (Outbox): Where the payloads are stored.
+        send (callable): send(kind, payload, key) -> bool, True once delivered.
+    """
+
+    def __init__(self, outbox, send, max_per_second=20.0, batch_size=200, idle_interval=5.0,
+                 base_backoff=5.0, max_backoff=600.0):
+        self.outbox = outbox
+        self.send = send
+        self.max_per_second = max_per_second
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.replayed = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="outbox-replayer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def replay_once(self, conn=None):
+        """
+        Send one round of due payloads.
+
+        Returns:
+            int: Number of payloads delivered.
+        """
+        delivered = 0
+        interval = 1.0 / self.max_per_second if self.max_per_second else 0
+        for key, kind, payload, attempts in self.outbox.due(self.batch_size, conn):
+            if self._stopping.is_set():
+                break
+            started = time.monotonic()
+            if self.send(kind, payload, key):
+                self.outbox.ack(key)
+                delivered += 1
+            else:
+                backoff = min(self.base_backoff * (2 ** attempts), self.max_backoff)
+                self.outbox.retry(key, attempts + 1, time.time() + backoff)
+                break
+            wait = interval - (time.monotonic() - started)
+            if wait > 0:
+                time.sleep(wait)
+        # Make the acks visible before the next round reads due payloads again
+        self.outbox.flush()
+        self.replayed += delivered
+        return delivered
+
+    def _run(self):
+        conn = self.outbox._connect()
+        try:
+            while not self._stopping.is_set():
+                if not self.replay_once(conn):
+                    self._stopping.wait(self.idle_interval)
+        finally:
+            conn.close()
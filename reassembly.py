@@ -0,0 +1,165 @@
+
+# reassembly.py
+#
+# Splits a connection's notification stream back into frames. A frame longer than the
+# negotiated MTU arrives in several notifications, and one notification may carry
+# several frames; the decoders only ever see whole, CRC-checked frames.
+
+import time
+import logs
+import metrics
+from crc_utils import crc16_update
+from frames import FRAME_HEADER, HEADER_SIZE, CRC_SIZE
+
+log = logs.get_logger("reassembly")
+
+# Shortest frame: header, length, one payload byte and the CRC
+MIN_FRAME_LENGTH = HEADER_SIZE + 1 + CRC_SIZE
+
+# A length field claiming more than this is taken as a corrupted header
+MAX_FRAME_LENGTH = 1024
+
+# Seconds an incomplete frame may wait for the rest of its bytes
+STALE_AFTER = 5.0
+
+discarded_bytes = metrics.Counter(
+    "gateway_reassembly_discarded_bytes_total", "Received bytes that did not belong to a valid frame.")
+reassembled_frames = metrics.Counter(
+    "gateway_reassembled_frames_total", "Frames split over several notifications or sharing one, put back together.")
+
+class FrameReassembler:
+    """
+    Incremental frame finder for one connection.
+
+    A notification holding exactly one valid frame, the usual case, is passed on as
+    it is without touching the buffer. Anything else is appended to a reusable
+    bytearray, where frames are found by the DA header and the length field. The
+    CRC of a frame still waiting for bytes is carried over between notifications,
+    so every byte is summed once. Bytes before a header, and candidate frames whose
+    CRC does not match, are discarded one byte at a time until the next header.
+
+    Frames are handed to on_frame(sender, frame) as memoryviews of the buffer: they
+    are only valid during the call, so keep bytes(frame) if you need it later.
+
+    Parameters:
+        on_frame (callable): Called with (sender, frame) for every valid frame.
+        address (str): The watch address, for log messages.
+        max_frame (int): Longest frame accepted, header and CRC included.
+        stale_after (float): Seconds before an incomplete frame is dropped; None waits forever.
+    """
+
+    def __init__(self, on_frame, address=None, max_frame=MAX_FRAME_LENGTH, stale_after=STALE_AFTER):
+        self.on_frame = on_frame
+        self.address = address
+        self.max_frame = max_frame
+        self.stale_after = stale_after
+        self.buffer = bytearray()
+        self.frames = 0
+        self.discarded = 0
+        self._crc = 0
+        self._crc_start = 0  # The running CRC covers buffer[_crc_start:_crc_end]
+        self._crc_end = 0
+        self._waiting_since = None
+
+    def feed(self, data, sender=None):
+        """
+        Add one notification and emit every frame it completes.
+
+        Parameters:
+            data (bytes | bytearray | memoryview): The notification as received.
+            sender: Passed on to on_frame.
+        """
+        length = len(data)
+        if (length >= MIN_FRAME_LENGTH and data[0] == FRAME_HEADER
+                and HEADER_SIZE + CRC_SIZE + (data[2] | data[3] << 8) == length):
+            # One whole frame. Whatever is buffered was cut short (a fragment was lost).
+            if self.buffer:
+                self._discard_buffer("an incomplete frame")
+            if crc16_update(0, data, 0, length - CRC_SIZE) == data[length - 2] | data[length - 1] << 8:
+                self.frames += 1
+                self.on_frame(sender, data)
+            else:
+                self._crc_failed(length)
+            return
+        if self.buffer and self.stale_after is not None and time.monotonic() - self._waiting_since > self.stale_after:
+            self._discard_buffer("a frame that never completed")
+        self.buffer += data
+        self._drain(sender)
+
+    def _drain(self, sender):
+        buffer = self.buffer
+        end = len(buffer)
+        position = 0
+        try:
+            while position < end:
+                if buffer[position] != FRAME_HEADER:
+                    header = buffer.find(FRAME_HEADER, position)
+                    skipped = (end if header < 0 else header) - position
+                    self._count_discarded(skipped)
+                    position += skipped
+                    continue
+                if end - position < HEADER_SIZE:
+                    break
+                total = HEADER_SIZE + CRC_SIZE + (buffer[position + 2] | buffer[position + 3] << 8)
+                if total > self.max_frame or total < MIN_FRAME_LENGTH:
+                    self._count_discarded(1)
+                    position += 1
+                    continue
+                # Carry the CRC of this candidate frame forward over the bytes received so far
+                if self._crc_start != position:
+                    self._crc, self._crc_start, self._crc_end = 0, position, position
+                body_end = position + total - CRC_SIZE
+                summed_to = min(end, body_end)
+                if summed_to > self._crc_end:
+                    self._crc = crc16_update(self._crc, buffer, self._crc_end, summed_to - self._crc_end)
+                    self._crc_end = summed_to
+                if end < position + total:
+                    break  # Wait for the rest of the frame
+                if self._crc != buffer[body_end] | buffer[body_end + 1] << 8:
+                    self._crc_failed(1)
+                    position += 1
+                    continue
+                self.frames += 1
+                reassembled_frames.inc()
+                frame = memoryview(buffer)[position:position + total]
+                position += total  # Consumed even if on_frame raises
+                try:
+                    self.on_frame(sender, frame)
+                finally:
+                    try:
+                        frame.release()
+                    except BufferError:
+                        pass  # on_frame kept a view of the frame; _consume replaces the buffer
+        finally:
+            if position:
+                self._consume(position)
+            if not self.buffer:
+                self._waiting_since = None
+            elif self._waiting_since is None or position:
+                self._waiting_since = time.monotonic()
+
+    def _consume(self, count):
+        try:
+            del self.buffer[:count]  # In place: the buffer's memory is reused
+        except BufferError:
+            self.buffer = bytearray(self.buffer[count:])
+        self._crc_start -= count
+        self._crc_end -= count
+        if self._crc_start < 0:
+            self._crc, self._crc_start, self._crc_end = 0, 0, 0
+
+    def _count_discarded(self, count):
+        if count:
+            self.discarded += count
+            discarded_bytes.inc(amount=count)
+
+    def _crc_failed(self, count):
+        metrics.crc_failures.inc()
+        self._count_discarded(count)
+        log.warning("Discarded a frame that failed CRC verification.", extra={"device": self.address})
+
+    def _discard_buffer(self, reason):
+        log.warning("Dropped %d buffered bytes of %s.", len(self.buffer), reason, extra={"device": self.address})
+        self._count_discarded(len(self.buffer))
+        self._consume(len(self.buffer))
+        self._waiting_since = None
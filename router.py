@@ -0,0 +1,89 @@
+
+# router.py
+
+import metrics
+import logs
+import capture
+from reassembly import FrameReassembler
+
+log = logs.get_logger("router")
+
+class NotificationRouter:
+    """
+    The single notify subscription of a BleakClient, shared by every phase of a session.
+
+    start() subscribes once; from then on handlers are registered and unregistered
+    per opcode in memory (e.g. 0xF0 sensors-ON ack, 0x86 battery, 0x8D vitals), so
+    switching phases costs no GATT round-trip and no frame is lost in between.
+    Frames with no registered handler go to the default handler, if any.
+
+    Parameters:
+        client (BleakClient): Connected client.
+        notify_char_uuid (str): Characteristic the watch notifies on.
+        recorder (NotificationRecorder): Records every raw notification; defaults to
+            capture.default_recorder, which is None unless capture is enabled.
+
+    Notifications go through a FrameReassembler first, so handlers get one whole,
+    CRC-checked frame per call however the watch split or packed them. A frame may
+    be a memoryview that is only valid during the call.
+    """
+
+    def __init__(self, client, notify_char_uuid, recorder=None):
+        self.client = client
+        self.notify_char_uuid = notify_char_uuid
+        self.address = getattr(client, "address", None)
+        self.recorder = recorder if recorder is not None else capture.default_recorder
+        self.reassembler = FrameReassembler(self.route, self.address)
+        self.handlers = {}
+        self.default_handler = None
+        self.subscribed = False
+        self.unrouted = 0
+
+    async def start(self):
+        if not self.subscribed:
+            await self.client.start_notify(self.notify_char_uuid, self.dispatch)
+            self.subscribed = True
+        return self
+
+    async def stop(self):
+        if self.subscribed:
+            self.subscribed = False
+            try:
+                await self.client.stop_notify(self.notify_char_uuid)
+            except Exception as e:
+                # The link is often already gone when a session is torn down
+                log.info("Error stopping notifications: %s", e, extra={"device": self.address})
+
+    def register(self, response_opcode, handler):
+        """
+        Route frames with this opcode to handler(sender, data).
+
+        Raises:
+            RuntimeError: If another handler already owns the opcode.
+        """
+        current = self.handlers.get(response_opcode)
+        if current is not None and current != handler:
+            raise RuntimeError(f"Opcode DA{response_opcode:02X} already has a handler.")
+        self.handlers[response_opcode] = handler
+
+    def unregister(self, response_opcode, handler=None):
+        """Stop routing this opcode; if handler is given, only when it is the one registered."""
+        if handler is None or self.handlers.get(response_opcode) == handler:
+            self.handlers.pop(response_opcode, None)
+
+    def dispatch(self, sender, data):
+        if self.recorder is not None:
+            self.recorder.record(self.address, data)
+        self.reassembler.feed(data, sender)
+
+    def route(self, sender, frame):
+        """Hand one whole frame to the handler of its opcode."""
+        frame_opcode = frame[1]
+        metrics.notifications.inc(metrics.OPCODE_LABELS[frame_opcode])
+        handler = self.handlers.get(frame_opcode)
+        if handler is None:
+            handler = self.default_handler
+            if handler is None:
+                self.unrouted += 1
+                return
+        handler(sender, frame)
@@ -1,32 +1,216 @@
 import asyncio
+import time
 from bleak import BleakScanner
+import logs
 from connect import send_device_setting_request, connect_to_device  # Import required functions
 
-async def scan_ble_devices():
-    print("Scanning for GTS devices...")
+log = logs.get_logger("scan")
 
-    devices = []
+# Advertised name prefix of the watches the gateway connects to
+NAME_PREFIX = "GTS"
+
+# Smoothing factor of the running RSSI estimate (weight of the newest advertisement)
+RSSI_ALPHA = 0.3
+
+class DiscoveredDevice:
+    """A watch seen while scanning, with a running RSSI estimate that keeps updating."""
+
+    __slots__ = ("device", "address", "name", "rssi", "count", "first_seen", "last_seen", "connection_state")
+
+    def __init__(self, device, rssi):
+        now = time.monotonic()
+        self.device = device
+        self.address = device.address
+        self.name = device.name
+        self.rssi = float(rssi)
+        self.count = 1
+        self.first_seen = now
+        self.last_seen = now
+        self.connection_state = None  # Session state while a session exists, else None
+
+    def update(self, rssi, alpha=RSSI_ALPHA):
+        self.rssi += alpha * (rssi - self.rssi)
+        self.count += 1
+        self.last_seen = time.monotonic()
+
+    def __repr__(self):
+        return f"DiscoveredDevice({self.name!r}, {self.address}, rssi={self.rssi:.1f}, count={self.count})"
+
+async def discover_gts_devices(timeout=20, max_devices=None, name_prefix=NAME_PREFIX, seen=None):
+    """
+    Yield each matching watch the moment it is first seen, de-duplicated by address.
+
+    Parameters:
+        timeout (float): Stop scanning after this many seconds (None scans until closed).
+        max_devices (int): Stop as soon as this many watches were found.
+        name_prefix (str): Only advertisements whose name starts with this are reported.
+        seen (dict): Address -> DiscoveredDevice map to fill; lets callers read the
+            running RSSI and advertisement count of every watch after it was yielded.
+
+    Yields:
+        DiscoveredDevice: A newly seen watch.
+    """
+    seen = {} if seen is None else seen
+    new_devices = asyncio.Queue()
 
     def device_discovered(device, advertisement_data):
-        if device.name and device.name.startswith("GTS"):
-            rssi = advertisement_data.rssi
-            print(f"Discovered device: {device.name} ({device.address}), RSSI: {rssi} dBm")
-            devices.append(device)
+        if not (device.name and device.name.startswith(name_prefix)):
+            return
+        found = seen.get(device.address)
+        if found is None:
+            found = seen[device.address] = DiscoveredDevice(device, advertisement_data.rssi)
+            new_devices.put_nowait(found)
+        else:
+            found.update(advertisement_data.rssi)
 
-    # Create a BleakScanner to detect devices
     scanner = BleakScanner(detection_callback=device_discovered)
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    yielded = 0
 
+    await scanner.start()
     try:
-        await scanner.start()
-        await asyncio.sleep(20)  # Scan for 10 seconds
-    except Exception as e:
-        print(f"Error starting scanner: {str(e)}")
+        while max_devices is None or yielded < max_devices:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            try:
+                found = await asyncio.wait_for(new_devices.get(), remaining)
+            except asyncio.TimeoutError:
+                break
+            log.info("Discovered device %s, RSSI: %.0f dBm", found.name, found.rssi, extra={"device": found.address})
+            yielded += 1
+            yield found
     finally:
         try:
             await scanner.stop()
-            print("Scan completed.")
+            log.info("Scan completed.")
         except Exception as e:
-            print(f"Error stopping scanner: {str(e)}")
+            log.warning("Error stopping scanner: %s", e)
+
+# Registry events
+APPEARED = "appeared"
+DISAPPEARED = "disappeared"
+
+class DeviceRegistry:
+    """
+    Live view of every matching watch the background scanner hears, keyed by address.
+
+    Subscribers are called as callback(event, entry) when a watch appears (first
+    advertisement, or first one after it was evicted or forgotten) and when it
+    disappears (not heard for stale_after seconds). Watches with a connection state
+    are never evicted, since a connected watch stops advertising.
+    """
+
+    def __init__(self, stale_after=60.0):
+        self.stale_after = stale_after
+        self.devices = {}
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _emit(self, event, entry):
+        for callback in list(self._subscribers):
+            try:
+                callback(event, entry)
+            except Exception as e:
+                log.exception("Error in registry subscriber: %s", e)
+
+    def observe(self, device, rssi):
+        entry = self.devices.get(device.address)
+        if entry is None:
+            entry = self.devices[device.address] = DiscoveredDevice(device, rssi)
+            self._emit(APPEARED, entry)
+        else:
+            entry.update(rssi)
+        return entry
+
+    def set_connection_state(self, address, state):
+        entry = self.devices.get(address)
+        if entry is not None:
+            entry.connection_state = state
+
+    def forget(self, address):
+        """Drop a watch so its next advertisement is reported as a new appearance."""
+        entry = self.devices.pop(address, None)
+        if entry is not None:
+            self._emit(DISAPPEARED, entry)
+
+    def evict_stale(self):
+        cutoff = time.monotonic() - self.stale_after
+        stale = [address for address, entry in self.devices.items()
+                 if entry.connection_state is None and entry.last_seen < cutoff]
+        for address in stale:
+            self.forget(address)
+        return len(stale)
+
+    def snapshot(self):
+        now = time.monotonic()
+        return [{
+            "address": entry.address,
+            "name": entry.name,
+            "rssi": round(entry.rssi, 1),
+            "advertisements": entry.count,
+            "seconds_since_seen": round(now - entry.last_seen, 1),
+            "connection_state": entry.connection_state,
+        } for entry in list(self.devices.values())]
+
+class BackgroundScanner:
+    """
+    One long-lived BleakScanner feeding a DeviceRegistry, with periodic eviction.
+
+    The scanner is started once and left running; it is only restarted (with a
+    growing delay) if the adapter reports an error. adapter selects the Bluetooth
+    adapter (e.g. "hci1"); None uses the system default.
+    """
+
+    def __init__(self, registry, name_prefix=NAME_PREFIX, sweep_interval=5.0, adapter=None):
+        self.registry = registry
+        self.name_prefix = name_prefix
+        self.sweep_interval = sweep_interval
+        self.adapter = adapter
+
+    def _device_discovered(self, device, advertisement_data):
+        if device.name and device.name.startswith(self.name_prefix):
+            self.registry.observe(device, advertisement_data.rssi)
+
+    async def run(self):
+        restart_delay = 1.0
+        while True:
+            options = {"adapter": self.adapter} if self.adapter else {}
+            scanner = BleakScanner(detection_callback=self._device_discovered, **options)
+            try:
+                await scanner.start()
+                log.info("Background scanner started on %s.", self.adapter or "the default adapter")
+                restart_delay = 1.0
+                while True:
+                    await asyncio.sleep(self.sweep_interval)
+                    self.registry.evict_stale()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("Background scanner error: %s, restarting in %.0fs", e, restart_delay)
+            finally:
+                try:
+                    await scanner.stop()
+                except Exception:
+                    pass
+            await asyncio.sleep(restart_delay)
+            restart_delay = min(restart_delay * 2, 60.0)
+
+async def scan_ble_devices(timeout=20, max_devices=None):
+    log.info("Scanning for GTS devices...")
+
+    devices = []
+    try:
+        async for found in discover_gts_devices(timeout=timeout, max_devices=max_devices):
+            devices.append(found.device)
+    except Exception as e:
+        log.error("Error starting scanner: %s", e)
 
     return devices
 
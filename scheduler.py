@@ -0,0 +1,168 @@
+
+# scheduler.py
+
+import asyncio
+import time
+from alerts import HEART_RATE_LOW, HEART_RATE_HIGH, SPO2_LOW
+
+# Golden-ratio spacing spreads any number of watches evenly over one polling period
+GOLDEN_RATIO_FRACTION = 0.6180339887
+
+# Vitals outside the alert limits (alerts.HEART_RATE_LOW etc.) make a watch "abnormal"
+# and polled at the fast cadence
+# Changes at least this large between two readings also count as "changing"
+HEART_RATE_STEP = 10
+SPO2_STEP = 3
+
+def classify_reading(reading, last=None):
+    """
+    Return the polling mode a reading calls for: "slow" while the watch is not worn,
+    "fast" while vitals are abnormal or changing since last, "normal" otherwise.
+
+    Parameters:
+        reading (VitalsReading): The reading, with watch_status already set.
+        last (VitalsReading): The watch's previous reading, if any.
+    """
+    if reading.watch_status == "Not Worn":
+        return "slow"
+    if (not HEART_RATE_LOW <= reading.heart_rate <= HEART_RATE_HIGH or reading.spo2 < SPO2_LOW
+            or (last is not None and (abs(reading.heart_rate - last.heart_rate) >= HEART_RATE_STEP
+                                      or abs(reading.spo2 - last.spo2) >= SPO2_STEP))):
+        return "fast"
+    return "normal"
+
+class DevicePollState:
+    """
+    Polling cadence of one watch. offset is the watch's slot in the stagger: the gap
+    between its first poll, sent immediately, and its second one.
+    """
+
+    __slots__ = ("address", "offset", "interval", "mode", "last_battery_poll", "last_reading", "last_poll",
+                 "next_poll", "changed")
+
+    def __init__(self, address, offset, interval):
+        self.address = address
+        self.offset = offset
+        self.interval = interval
+        self.mode = "normal"
+        self.last_battery_poll = None
+        self.last_reading = None
+        self.last_poll = None
+        self.next_poll = None
+        self.changed = asyncio.Event()  # Set when the cadence changes, to wake wait_for_poll
+
+class PollScheduler:
+    """
+    Gateway-wide scheduler for the current-data and battery commands.
+
+    Every command write goes through a token bucket shared by all watches, so the
+    adapter never sees more than writes_per_second writes on average. A new watch
+    is polled immediately, then at a staggered offset so watches that connected
+    together do not keep polling together, and each watch's cadence follows its
+    last reading: fast while vitals are abnormal or changing, slow while the watch
+    is not worn, normal otherwise. Battery is only
+    polled every battery_interval seconds.
+    """
+
+    def __init__(self, writes_per_second=5.0, burst=5, normal_interval=30.0, fast_interval=10.0,
+                 slow_interval=120.0, battery_interval=600.0):
+        self.writes_per_second = writes_per_second
+        self.burst = burst
+        self.intervals = {"fast": fast_interval, "normal": normal_interval, "slow": slow_interval}
+        self.battery_interval = battery_interval
+        self.devices = {}
+        self.writes = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._registered = 0
+
+    @classmethod
+    def uniform(cls, interval, writes_per_second):
+        """
+        Scheduler that polls every watch every interval seconds whatever its readings
+        (battery every ten intervals), for load runs.
+        """
+        return cls(writes_per_second=writes_per_second, burst=max(1, int(writes_per_second)),
+                   normal_interval=interval, fast_interval=interval, slow_interval=interval,
+                   battery_interval=interval * 10)
+
+    def register(self, address):
+        normal = self.intervals["normal"]
+        offset = (self._registered * GOLDEN_RATIO_FRACTION) % 1.0 * normal
+        self._registered += 1
+        state = self.devices[address] = DevicePollState(address, offset, normal)
+        return state
+
+    def poll_sent(self, state):
+        """Record a current-data poll and schedule the next one."""
+        now = time.monotonic()
+        first = state.last_poll is None
+        state.last_poll = now
+        state.next_poll = now + ((state.offset or state.interval) if first else state.interval)
+
+    async def wait_for_poll(self, state):
+        """
+        Sleep until the watch's next poll is due. A reading that changes the cadence
+        reschedules the poll, so a watch switched to fast polling does not first sit
+        out the rest of a slow interval.
+        """
+        while state.next_poll is not None:
+            delay = state.next_poll - time.monotonic()
+            if delay <= 0:
+                return
+            state.changed.clear()
+            try:
+                await asyncio.wait_for(state.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                return
+
+    def unregister(self, address):
+        self.devices.pop(address, None)
+
+    async def acquire(self):
+        """Wait for a slot in the gateway-wide write budget."""
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.writes_per_second)
+        self._updated = now
+        # Reserve the token now; if the bucket went negative, wait until it is paid back
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.writes_per_second)
+
+    async def write(self, client, write_char_uuid, command):
+        await self.acquire()
+        self.writes += 1
+        await client.write_gatt_char(write_char_uuid, command)
+
+    def battery_due(self, state):
+        now = time.monotonic()
+        if state.last_battery_poll is None or now - state.last_battery_poll >= self.battery_interval:
+            state.last_battery_poll = now
+            return True
+        return False
+
+    def report_reading(self, address, reading):
+        """
+        Adapt a watch's cadence to its latest reading.
+
+        Parameters:
+            address (str): The watch address.
+            reading (VitalsReading): The reading, with watch_status already set.
+        """
+        state = self.devices.get(address)
+        if state is None:
+            return
+        mode = classify_reading(reading, state.last_reading)
+        state.last_reading = reading
+        if mode != state.mode:
+            state.mode = mode
+            state.interval = self.intervals[mode]
+            if state.last_poll is not None:
+                state.next_poll = state.last_poll + state.interval
+            state.changed.set()
+
+    def snapshot(self):
+        return {address: {"mode": state.mode, "interval": state.interval} for address, state in self.devices.items()}
+
+# Scheduler shared by every watch on this gateway
+default_scheduler = PollScheduler()
@@ -0,0 +1,212 @@
+
+# server.py
+#
+# Asynchronous HTTP server that runs on the BLE event loop. It streams live vitals
+# as Server-Sent Events and serves every other route from the Flask app, whose
+# views run on a thread pool so a slow query never blocks the loop.
+#
+#   GET /api/stream                          every watch
+#   GET /api/stream?device=AA:..&device=..   only these watches
+#   GET /api/devices/<address>/stream        one watch
+
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, unquote
+import logs
+from streams import default_hub, DEFAULT_BUFFER
+
+log = logs.get_logger("server")
+
+# Limits on what a client may send
+MAX_HEAD_BYTES = 16 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+READ_TIMEOUT = 10.0
+
+# Seconds between keep-alive comments on an idle stream
+STREAM_KEEPALIVE = 15.0
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           413: "Payload Too Large", 500: "Internal Server Error"}
+
+class GatewayServer:
+    """
+    Parameters:
+        app (flask.Flask): WSGI app serving the non-streaming routes.
+        hub (VitalsHub): Source of the live readings.
+        host (str): Address to listen on.
+        port (int): Port to listen on (0 picks a free one).
+        stream_buffer (int): Events each stream subscriber may fall behind by.
+        wsgi_workers (int): Threads running Flask views.
+    """
+
+    def __init__(self, app, hub=default_hub, host="0.0.0.0", port=5000, stream_buffer=DEFAULT_BUFFER, wsgi_workers=4):
+        self.app = app
+        self.hub = hub
+        self.host = host
+        self.port = port
+        self.stream_buffer = stream_buffer
+        self.executor = ThreadPoolExecutor(max_workers=wsgi_workers, thread_name_prefix="wsgi")
+        self.server = None
+        self._connections = set()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=MAX_HEAD_BYTES)
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info("Serving on %s:%d", self.host, self.port)
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+        self.executor.shutdown(wait=False)
+
+    def url(self, path="/"):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            request = await self._read_request(reader, writer)
+            if request is not None:
+                method, path, query, headers, body = request
+                devices = self._stream_devices(path, query)
+                if devices is not None:
+                    if method != "GET":
+                        await self._respond(writer, 405, b"Streams only support GET.\n")
+                    else:
+                        await self._stream(writer, devices or None)
+                else:
+                    await self._wsgi(writer, method, path, query, headers, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # Client went away
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.exception("Error handling request: %s", e)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), READ_TIMEOUT)
+        except asyncio.LimitOverrunError:
+            await self._respond(writer, 413, b"Request head too large.\n")
+            return None
+        except asyncio.TimeoutError:
+            return None
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            await self._respond(writer, 400, b"Malformed request line.\n")
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            await self._respond(writer, 400, b"Malformed Content-Length.\n")
+            return None
+        if length > MAX_BODY_BYTES:
+            await self._respond(writer, 413, b"Request body too large.\n")
+            return None
+        body = await asyncio.wait_for(reader.readexactly(length), READ_TIMEOUT) if length else b""
+        path, _, query = target.partition("?")
+        return method, unquote(path), query, headers, body
+
+    def _stream_devices(self, path, query):
+        """Return the devices a stream path asks for ([] for all), or None if it is not a stream."""
+        if path == "/api/stream":
+            return parse_qs(query).get("device", [])
+        parts = path.strip("/").split("/")
+        if len(parts) == 4 and parts[:2] == ["api", "devices"] and parts[3] == "stream":
+            return [parts[2]]
+        return None
+
+    async def _respond(self, writer, status, body, content_type="text/plain; charset=utf-8"):
+        writer.write((f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                      f"Content-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                      "Connection: close\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def _stream(self, writer, devices):
+        subscription = self.hub.subscribe(devices, self.stream_buffer)
+        log.info("Stream subscriber connected (%s)", ", ".join(sorted(devices)) if devices else "all devices")
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n"
+                         b"retry: 2000\n\n")
+            await writer.drain()
+            while True:
+                batch = await subscription.next_batch(STREAM_KEEPALIVE)
+                if batch:
+                    writer.write("".join(f"id: {sequence}\nevent: vitals\ndata: {data}\n\n"
+                                         for sequence, data in batch).encode())
+                else:
+                    writer.write(b": keep-alive\n\n")
+                # Only this subscriber waits on a slow socket; publish() keeps appending
+                # to its bounded buffer meanwhile
+                await writer.drain()
+        finally:
+            self.hub.unsubscribe(subscription)
+            log.info("Stream subscriber disconnected after %d dropped readings", subscription.dropped)
+
+    async def _wsgi(self, writer, method, path, query, headers, body):
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": path,
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": peer[0],
+            "CONTENT_TYPE": headers.pop("content-type", ""),
+            "CONTENT_LENGTH": headers.pop("content-length", ""),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+        status, response_headers, response_body = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._call_app, environ)
+        head = [f"HTTP/1.1 {status}"]
+        head += [f"{name}: {value}" for name, value in response_headers
+                 if name.lower() not in ("content-length", "connection")]
+        head += [f"Content-Length: {len(response_body)}", "Connection: close", "", ""]
+        writer.write("\r\n".join(head).encode("latin-1") + response_body)
+        await writer.drain()
+
+    def _call_app(self, environ):
+        response = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = response_headers
+
+        chunks = self.app(environ, start_response)
+        try:
+            body = b"".join(chunks)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+        return response["status"], response["headers"], body
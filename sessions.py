@@ -0,0 +1,134 @@
+
+# sessions.py
+
+import asyncio
+import time
+from collections import deque
+import logs
+
+log = logs.get_logger("sessions")
+
+# Session lifecycle states, in the order a healthy session goes through them
+QUEUED = "queued"
+CONNECTING = "connecting"
+HANDSHAKE = "handshake"
+STREAMING = "streaming"
+TEARDOWN = "teardown"
+CLOSED = "closed"
+
+LIVE_STATES = (QUEUED, CONNECTING, HANDSHAKE, STREAMING, TEARDOWN)
+
+class Session:
+    """One watch's connection, from the moment it is queued until it is torn down."""
+
+    __slots__ = ("address", "name", "state", "task", "queued_at", "state_changed_at", "history", "error")
+
+    def __init__(self, address, name=None):
+        self.address = address
+        self.name = name
+        self.state = QUEUED
+        self.task = None
+        self.queued_at = time.monotonic()
+        self.state_changed_at = self.queued_at
+        self.history = [(QUEUED, self.queued_at)]
+        self.error = None
+
+    def set_state(self, state):
+        now = time.monotonic()
+        self.state = state
+        self.state_changed_at = now
+        self.history.append((state, now))
+
+    @property
+    def live(self):
+        return self.state in LIVE_STATES
+
+    def as_dict(self):
+        return {
+            "address": self.address,
+            "name": self.name,
+            "state": self.state,
+            "seconds_in_state": round(time.monotonic() - self.state_changed_at, 3),
+            "error": self.error,
+        }
+
+class SessionManager:
+    """
+    Keeps at most one live session per watch address and at most max_concurrent
+    watches connected at once. Watches waiting for a free slot are served first
+    come, first served.
+
+    Parameters:
+        connect (callable): Coroutine function connect(device, on_state) that runs a
+            whole session; on_state(state) reports its progress. It returns or raises
+            when the session is over.
+        max_concurrent (int): Cap on simultaneously connected watches.
+    """
+
+    def __init__(self, connect, max_concurrent=5):
+        self.connect = connect
+        self.max_concurrent = max_concurrent
+        self.sessions = {}
+        self._waiting = deque()
+        self._wakeup = asyncio.Event()
+        self._running = set()
+
+    def offer(self, device):
+        """
+        Queue a discovered watch unless it already has a live session.
+
+        Parameters:
+            device: Anything with an address attribute (e.g. a bleak BLEDevice).
+
+        Returns:
+            bool: True if a new session was queued.
+        """
+        session = self.sessions.get(device.address)
+        if session is not None and session.live:
+            return False
+        session = Session(device.address, getattr(device, "name", None))
+        self.sessions[device.address] = session
+        self._waiting.append((session, device))
+        self._wakeup.set()
+        return True
+
+    def active_count(self):
+        return len(self._running)
+
+    def queued_count(self):
+        return len(self._waiting)
+
+    def snapshot(self):
+        return [session.as_dict() for session in self.sessions.values()]
+
+    async def run(self):
+        """Start queued sessions whenever a connection slot is free. Runs forever."""
+        while True:
+            while self._waiting and len(self._running) < self.max_concurrent:
+                session, device = self._waiting.popleft()
+                session.task = asyncio.create_task(self._run_session(session, device))
+                self._running.add(session.task)
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _run_session(self, session, device):
+        session.set_state(CONNECTING)
+        try:
+            await self.connect(device, session.set_state)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            session.error = str(e)
+            log.warning("Session failed: %s", e, extra={"device": session.address})
+        finally:
+            session.set_state(TEARDOWN)
+            self._running.discard(session.task)
+            session.set_state(CLOSED)
+            self._wakeup.set()
+
+    async def close(self):
+        """Cancel every running session and wait for them to finish."""
+        tasks = list(self._running)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,557 @@
+
+# sharding.py
+#
+# Spreads watches over several Bluetooth adapters, one worker process per adapter.
+#
+# Every worker scans on its own adapter and reports what it hears; the coordinator
+# (in the main process) assigns each watch to one worker, preferring the adapter that
+# hears it loudest and penalising adapters that are already busy. Workers run the
+# usual connect/handshake/fetch sessions and send their payloads and readings back
+# over a pipe, so there is still a single outbox and uploader, one local history
+# and one stream hub.
+#
+#   python sharding.py --adapters 3 --watches 60      # simulated adapters and watches
+
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+import time
+import back
+import logs
+import metrics
+from frames import VitalsReading
+from scheduler import PollScheduler
+from scan import DeviceRegistry, BackgroundScanner, NAME_PREFIX
+from sessions import SessionManager, STREAMING, CLOSED
+from streams import default_hub
+from timeseries import default_store
+from watch_cache import default_cache
+
+# Messages are tuples whose first item is one of these; both directions send lists of them
+MSG_SIGHTINGS = "sightings"  # worker: [(address, name, rssi), ...] of unconnected watches it hears
+MSG_STATE = "state"  # worker: address, session state
+MSG_UPLOAD = "upload"  # worker: kind, payload, received_at
+MSG_READING = "reading"  # worker: address, timestamp, reading fields
+MSG_STATUS = "status"  # worker: session snapshots, watch configuration cache snapshot
+MSG_ASSIGN = "assign"  # coordinator: address, name
+MSG_STOP = "stop"  # coordinator
+
+# Watches one adapter serves at most (most BLE controllers manage 8-10 links)
+MAX_PER_ADAPTER = 8
+
+# Seconds a new watch is left unassigned so every adapter can report its RSSI
+SETTLE_TIME = 1.0
+
+# How many dB of RSSI a fully loaded adapter has to win by to get another watch
+LOAD_WEIGHT = 20.0
+
+# Sightings older than this many seconds are ignored, and an unassigned watch with no
+# newer sighting is forgotten
+SIGHTING_TTL = 10.0
+
+# Messages a worker buffers for the coordinator before dropping the oldest
+SEND_QUEUE_SIZE = 10000
+
+log = logs.get_logger("sharding")
+
+class _Sender:
+    """
+    Sends messages over a pipe from a background thread, in batches, so a busy
+    receiver never blocks the sender's event loop. When the queue is full the oldest
+    message is dropped.
+    """
+
+    def __init__(self, conn, max_queue=SEND_QUEUE_SIZE, name="shard-sender"):
+        self.conn = conn
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        while True:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def close(self, timeout=5):
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch[-1] is None
+            batch = [message for message in batch if message is not None]
+            try:
+                if batch:
+                    self.conn.send(batch)
+            except (OSError, EOFError):
+                return  # The other side is gone
+            if closing:
+                return
+
+class _ReadingForwarder:
+    """Stands in for a worker's history store and stream hub: readings go to the coordinator."""
+
+    def __init__(self, sender):
+        self.sender = sender
+
+    def record(self, address, reading, timestamp=None):
+        self.sender.send((MSG_READING, address, time.time() if timestamp is None else timestamp,
+                          (reading.heart_rate, reading.systolic, reading.diastolic, reading.spo2,
+                           reading.glucose, reading.battery_level, reading.watch_status)))
+
+    def publish(self, address, reading, timestamp=None):
+        pass  # The coordinator publishes what record() forwards
+
+class ShardWorker:
+    """
+    The scan/connect/fetch loop of one adapter, run in its own process.
+
+    Parameters:
+        adapter (str): Bluetooth adapter, e.g. "hci1".
+        conn (multiprocessing.connection.Connection): Pipe to the coordinator.
+        max_concurrent (int): Watches connected at once on this adapter.
+        name_prefix (str): Advertised name prefix of the watches.
+        report_interval (float): Seconds between two sighting reports.
+    """
+
+    def __init__(self, adapter, conn, max_concurrent=MAX_PER_ADAPTER, name_prefix=NAME_PREFIX, report_interval=1.0):
+        self.adapter = adapter
+        self.conn = conn
+        self.report_interval = report_interval
+        self.registry = DeviceRegistry()
+        self.scanner = BackgroundScanner(self.registry, name_prefix=name_prefix, adapter=adapter)
+        self.sessions = SessionManager(self._run_session, max_concurrent=max_concurrent)
+        self.sender = _Sender(conn, name=f"shard-{adapter}-sender")
+        self._stopping = None
+
+    async def run(self):
+        import currentdata
+
+        # Payloads and readings leave through the pipe instead of this process's
+        # uploader, history store and stream hub
+        back.payload_sink = self._forward_payload
+        currentdata.default_store = currentdata.default_hub = _ReadingForwarder(self.sender)
+
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.conn.fileno(), self._on_messages)
+        tasks = [asyncio.create_task(self.sessions.run()), asyncio.create_task(self.scanner.run()),
+                 asyncio.create_task(self._report())]
+        try:
+            await self._stopping.wait()
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            for task in tasks:
+                task.cancel()
+            await self.sessions.close()
+            self.sender.close()
+
+    def _forward_payload(self, kind, payload, received_at):
+        self.sender.send((MSG_UPLOAD, kind, payload, received_at))
+        return True
+
+    def _on_messages(self):
+        try:
+            while self.conn.poll():
+                for message in self.conn.recv():
+                    if message[0] == MSG_ASSIGN:
+                        _, address, name = message
+                        device = self.registry.devices.get(address)
+                        self.sessions.offer(device if device is not None else _AssignedDevice(address, name))
+                    elif message[0] == MSG_STOP:
+                        self._stopping.set()
+        except (EOFError, OSError):
+            log.error("Coordinator went away, stopping the %s worker.", self.adapter)
+            self._stopping.set()
+
+    async def _report(self):
+        while True:
+            sightings = [(entry.address, entry.name, entry.rssi) for entry in list(self.registry.devices.values())
+                         if entry.connection_state is None]
+            if sightings:
+                self.sender.send((MSG_SIGHTINGS, sightings))
+            # Sessions and handshake cache live in this process; the coordinator serves them to the API
+            self.sender.send((MSG_STATUS, self.sessions.snapshot(), default_cache.snapshot()))
+            await asyncio.sleep(self.report_interval)
+
+    async def _run_session(self, device, on_state):
+        import merging
+
+        def track_state(state):
+            on_state(state)
+            self.registry.set_connection_state(device.address, state)
+            self.sender.send((MSG_STATE, device.address, state))
+
+        try:
+            await merging.connect_and_extract_data(device, merging.WRITE_CHAR_UUID, merging.NOTIFY_CHAR_UUID,
+                                                   on_state=track_state, adapter=self.adapter)
+        finally:
+            self.registry.forget(device.address)
+            self.sender.send((MSG_STATE, device.address, CLOSED))
+
+class _AssignedDevice:
+    """Address and name of a watch assigned before this worker heard it itself."""
+
+    __slots__ = ("address", "name")
+
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+def _configure_worker(options):
+    """Apply the worker options that tune module defaults (mostly for simulated runs)."""
+    import currentdata
+
+    if "poll_interval" in options:
+        currentdata.default_scheduler = PollScheduler.uniform(options["poll_interval"],
+                                                              options.get("writes_per_second", 5))
+    if "heartbeat_interval" in options:
+        back.upload_filter.heartbeat_interval = options["heartbeat_interval"]
+
+# Entry point of a worker process
+def run_worker(adapter, conn, options):
+    logs.configure(options.get("log_level", "INFO"))
+    _configure_worker(options)
+    simulated = options.get("simulated")
+    if simulated:
+        import simulator
+        installed = simulator.install(simulator.SimulatedFleet.generate(**simulated))
+    else:
+        installed = contextlib.nullcontext()
+    try:
+        with installed:
+            asyncio.run(ShardWorker(adapter, conn, max_concurrent=options.get("max_concurrent", MAX_PER_ADAPTER),
+                                    name_prefix=options.get("name_prefix", NAME_PREFIX)).run())
+    finally:
+        logs.shutdown()
+
+class _WorkerHandle:
+    """The coordinator's view of one worker process."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.process = None
+        self.conn = None
+        self.alive = False
+        self.assigned = set()
+        self.states = {}
+        self.sessions = []  # Latest MSG_STATUS report
+        self.connections = []
+        self.restart_at = None
+
+class _Watch:
+    __slots__ = ("address", "name", "first_seen", "sightings", "adapter")
+
+    def __init__(self, address, name, now):
+        self.address = address
+        self.name = name
+        self.first_seen = now
+        self.sightings = {}  # adapter -> (rssi, monotonic time)
+        self.adapter = None  # Adapter the watch is assigned to
+
+class ShardCoordinator:
+    """
+    Assigns watches to per-adapter worker processes and uploads what they send back.
+
+    Each unassigned watch goes to the adapter with the best score among those that
+    heard it recently and still have a free slot, where
+
+        score = RSSI - load_weight * assigned / max_per_adapter
+
+    so a weaker adapter wins once the strongest one is noticeably busier. A watch
+    whose session ends is released and reassigned when it advertises again; the
+    watches of a worker that dies are released and the worker is restarted.
+
+    Parameters:
+        adapters (list): Adapter names, one worker each (e.g. ["hci0", "hci1"]).
+        max_per_adapter (int): Watches one adapter serves at most.
+        settle (float): Seconds a new watch waits for every adapter's RSSI report.
+        load_weight (float): dB an adapter's full load is worth.
+        worker_options (dict): Passed to run_worker (see _configure_worker).
+        restart_delay (float): Seconds before a dead worker is restarted.
+    """
+
+    def __init__(self, adapters, max_per_adapter=MAX_PER_ADAPTER, settle=SETTLE_TIME, load_weight=LOAD_WEIGHT,
+                 worker_options=None, restart_delay=5.0):
+        self.max_per_adapter = max_per_adapter
+        self.settle = settle
+        self.load_weight = load_weight
+        self.worker_options = dict(worker_options or {})
+        self.worker_options.setdefault("max_concurrent", max_per_adapter)
+        self.restart_delay = restart_delay
+        self.workers = {adapter: _WorkerHandle(adapter) for adapter in adapters}
+        self.watches = {}
+        self.readings = 0
+        self.uploads = 0
+        self._stopping = False
+        self._context = multiprocessing.get_context("spawn")  # No forked copies of our threads
+        metrics.Gauge("gateway_shard_assigned_watches", "Watches assigned to each adapter's worker.",
+                      lambda: {(handle.adapter,): len(handle.assigned) for handle in self.workers.values()},
+                      ("adapter",))
+
+    def _start_worker(self, handle):
+        parent_conn, child_conn = self._context.Pipe()
+        handle.process = self._context.Process(target=run_worker, args=(handle.adapter, child_conn, self.worker_options),
+                                               name=f"shard-{handle.adapter}", daemon=True)
+        handle.process.start()
+        child_conn.close()
+        handle.conn = parent_conn
+        handle.alive = True
+        handle.restart_at = None
+        asyncio.get_running_loop().add_reader(parent_conn.fileno(), self._on_messages, handle)
+        log.info("Started worker for %s (pid %d)", handle.adapter, handle.process.pid)
+
+    def _worker_died(self, handle):
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(handle.conn.fileno())
+        handle.conn.close()
+        handle.alive = False
+        handle.sessions, handle.connections = [], []
+        for address in list(handle.assigned):
+            self._release(handle, address)
+        if self._stopping:
+            return
+        handle.restart_at = time.monotonic() + self.restart_delay
+        log.error("Worker for %s stopped; its watches were released, restarting in %.0fs",
+                  handle.adapter, self.restart_delay)
+
+    def _release(self, handle, address):
+        handle.assigned.discard(address)
+        handle.states.pop(address, None)
+        watch = self.watches.get(address)
+        if watch is not None and watch.adapter == handle.adapter:
+            watch.adapter = None
+            watch.sightings.clear()
+            watch.first_seen = time.monotonic()
+
+    def _on_messages(self, handle):
+        try:
+            while handle.conn.poll():
+                for message in handle.conn.recv():
+                    self._handle_message(handle, message)
+        except (EOFError, OSError):
+            self._worker_died(handle)
+
+    def _handle_message(self, handle, message):
+        kind = message[0]
+        if kind == MSG_READING:
+            _, address, timestamp, fields = message
+            reading = VitalsReading(*fields)
+            default_store.record(address, reading, timestamp)
+            default_hub.publish(address, reading, timestamp)
+            self.readings += 1
+        elif kind == MSG_UPLOAD:
+            _, payload_kind, payload, received_at = message
+            back.queue_payload(payload_kind, payload, received_at)
+            self.uploads += 1
+        elif kind == MSG_SIGHTINGS:
+            now = time.monotonic()
+            for address, name, rssi in message[1]:
+                watch = self.watches.get(address)
+                if watch is None:
+                    watch = self.watches[address] = _Watch(address, name, now)
+                watch.sightings[handle.adapter] = (rssi, now)
+        elif kind == MSG_STATUS:
+            _, handle.sessions, handle.connections = message
+        elif kind == MSG_STATE:
+            _, address, state = message
+            if state == CLOSED:
+                self._release(handle, address)
+            elif address in handle.assigned:
+                handle.states[address] = state
+
+    def choose_adapter(self, watch, now):
+        """
+        Return the adapter a watch should go to, or None if no adapter can take it.
+
+        Parameters:
+            watch (_Watch): An unassigned watch.
+            now (float): Current monotonic time.
+        """
+        best, best_score = None, None
+        for adapter, (rssi, seen) in watch.sightings.items():
+            handle = self.workers.get(adapter)
+            if handle is None or not handle.alive or now - seen > SIGHTING_TTL:
+                continue
+            if len(handle.assigned) >= self.max_per_adapter:
+                continue
+            score = rssi - self.load_weight * len(handle.assigned) / self.max_per_adapter
+            if best_score is None or score > best_score:
+                best, best_score = adapter, score
+        return best
+
+    def evict_stale(self, now=None):
+        """Forget unassigned watches not heard by any adapter for SIGHTING_TTL seconds. Returns how many."""
+        now = time.monotonic() if now is None else now
+        stale = [address for address, watch in self.watches.items() if watch.adapter is None
+                 and max((seen for _, seen in watch.sightings.values()), default=watch.first_seen) < now - SIGHTING_TTL]
+        for address in stale:
+            del self.watches[address]
+        return len(stale)
+
+    def assign_pending(self, now=None):
+        """Assign every settled, unassigned watch. Returns the number assigned."""
+        now = time.monotonic() if now is None else now
+        alive = sum(1 for handle in self.workers.values() if handle.alive)
+        assigned = 0
+        # Loudest watches first, so they get the best adapters while slots are free
+        pending = sorted((watch for watch in self.watches.values() if watch.adapter is None),
+                         key=lambda watch: -max((rssi for rssi, _ in watch.sightings.values()), default=-200))
+        for watch in pending:
+            if now - watch.first_seen < self.settle and len(watch.sightings) < alive:
+                continue
+            adapter = self.choose_adapter(watch, now)
+            if adapter is None:
+                continue
+            handle = self.workers[adapter]
+            watch.adapter = adapter
+            handle.assigned.add(watch.address)
+            handle.conn.send([(MSG_ASSIGN, watch.address, watch.name)])
+            log.info("Assigned to %s (RSSI %.0f dBm, %d/%d on that adapter)", adapter,
+                     watch.sightings[adapter][0], len(handle.assigned), self.max_per_adapter,
+                     extra={"device": watch.address})
+            assigned += 1
+        return assigned
+
+    def sessions(self):
+        """Every worker's sessions as last reported, like SessionManager.snapshot(), with the adapter."""
+        return [dict(session, adapter=handle.adapter) for handle in self.workers.values() for session in handle.sessions]
+
+    def connections(self):
+        """Every worker's watch configuration cache as last reported, like WatchConfigCache.snapshot()."""
+        return [dict(entry, adapter=handle.adapter) for handle in self.workers.values() for entry in handle.connections]
+
+    def snapshot(self):
+        return {handle.adapter: {
+            "alive": handle.alive,
+            "pid": handle.process.pid if handle.process else None,
+            "assigned": sorted(handle.assigned),
+            "streaming": sum(1 for state in handle.states.values() if state == STREAMING),
+        } for handle in self.workers.values()}
+
+    async def run(self, interval=0.25):
+        """Start the workers and keep assigning watches until cancelled."""
+        for handle in self.workers.values():
+            self._start_worker(handle)
+        try:
+            while True:
+                now = time.monotonic()
+                for handle in self.workers.values():
+                    if not handle.alive and handle.restart_at is not None and now >= handle.restart_at:
+                        self._start_worker(handle)
+                self.evict_stale(now)
+                self.assign_pending(now)
+                await asyncio.sleep(interval)
+        finally:
+            await self.stop()
+
+    async def stop(self, timeout=10.0):
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+        for handle in self.workers.values():
+            if handle.alive:
+                try:
+                    handle.conn.send([(MSG_STOP,)])
+                except OSError:
+                    pass
+        deadline = time.monotonic() + timeout
+        for handle in self.workers.values():
+            if handle.process is None:
+                continue
+            while handle.process.is_alive() and time.monotonic() < deadline:
+                # Keep taking messages while the worker winds down its sessions
+                await asyncio.sleep(0.1)
+            if handle.process.is_alive():
+                handle.process.terminate()
+            handle.process.join(1)
+            if handle.alive:
+                loop.remove_reader(handle.conn.fileno())
+                try:
+                    self._on_messages(handle)  # Whatever was sent before the pipe closed
+                except Exception:
+                    pass
+                handle.conn.close()
+                handle.alive = False
+
+# Run simulated watches through several simulated adapters against a local stand-in backend
+async def run_simulated(adapters=3, watches=30, duration=20.0, poll_interval=2.0, max_per_adapter=16,
+                        latency=0.05, loss=0.0, seed=1):
+    from standin_backend import StandinBackend
+
+    worker_options = {
+        "simulated": {"count": watches, "seed": seed, "latency": latency, "loss": loss},
+        "poll_interval": poll_interval,
+        "writes_per_second": 200.0,
+        "heartbeat_interval": 0,  # Upload every reading, to load the path fully
+        "log_level": "ERROR",
+    }
+    coordinator = ShardCoordinator([f"hci{i}" for i in range(adapters)], max_per_adapter=max_per_adapter,
+                                   worker_options=worker_options)
+    outbox_dir = tempfile.mkdtemp(prefix="gateway-shards-")
+    patched = [(back, "vital_url"), (back, "alert_url"), (back, "outbox_path")]
+    originals = [getattr(module, name) for module, name in patched]
+    with StandinBackend() as backend:
+        try:
+            back.vital_url = backend.url("/vitals")
+            back.alert_url = backend.url("/alerts")
+            back.outbox_path = os.path.join(outbox_dir, "outbox.db")
+            start = time.perf_counter()
+            task = asyncio.create_task(coordinator.run())
+            await asyncio.sleep(duration)
+            snapshot = coordinator.snapshot()
+            sessions = coordinator.sessions()
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+            back.stop_delivery()
+            elapsed = time.perf_counter() - start
+        finally:
+            for (module, name), original in zip(patched, originals):
+                setattr(module, name, original)
+        assigned = [address for shard in snapshot.values() for address in shard["assigned"]]
+        return {
+            "adapters": {adapter: {"assigned": len(shard["assigned"]), "streaming": shard["streaming"]}
+                         for adapter, shard in snapshot.items()},
+            "watches": watches,
+            "assigned": len(assigned),
+            "assigned_twice": len(assigned) - len(set(assigned)),
+            "sessions_reported": len(sessions),
+            "readings": coordinator.readings,
+            "uploads": coordinator.uploads,
+            "backend_payloads": backend.payloads,
+            "seconds": round(elapsed, 2),
+        }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run simulated watches through several simulated adapters.")
+    parser.add_argument("--adapters", type=int, default=3)
+    parser.add_argument("--watches", type=int, default=30)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--max-per-adapter", type=int, default=16)
+    args = parser.parse_args()
+    logs.configure("WARNING")
+    print(json.dumps(asyncio.run(run_simulated(args.adapters, args.watches, args.duration, args.poll_interval,
+                                               args.max_per_adapter)), indent=2))
+    logs.shutdown()
@@ -0,0 +1,150 @@
+
+# signals.py
+
+import numpy as np
+
+# Columns of the ring buffer
+HEART_RATE, SYSTOLIC, DIASTOLIC, SPO2 = range(4)
+METRICS = ("heart_rate", "systolic", "diastolic", "spo2")
+
+# Largest variance, per column, of a sensor that is only repeating a cached value. Integer
+# vitals that change by a single unit once in flat_count readings already exceed it.
+FLAT_VARIANCE = np.array([0.05, 0.05, 0.05, 0.05])
+
+# Smallest deviation from the window median that can count as a glitch, per column,
+# so a very steady signal (MAD close to 0) does not flag every small change
+MIN_GLITCH_DEVIATION = np.array([25.0, 30.0, 20.0, 6.0])
+MAD_TO_SIGMA = 1.4826
+
+class VitalsWindow:
+    """
+    Fixed-size ring buffer of a watch's recent readings with rolling statistics.
+
+    Running sums give mean and variance in O(1) per reading; the median (used for
+    smoothing and glitch detection) and the worn check are computed over at most
+    size rows, so the cost per reading is constant and the memory per watch is
+    size * 4 float64 values.
+
+    Parameters:
+        size (int): Number of readings kept.
+        flat_count (int): Number of latest readings whose variance decides whether the
+            watch is worn; a watch is reported as not worn once every vital stayed
+            flat (variance within FLAT_VARIANCE) over that many readings. A real
+            pulse varies a little over that span, even when the patient is steady.
+        glitch_sigmas (float): Deviation from the median, in robust sigmas, that
+            makes a reading an outlier.
+
+    Only an isolated outlier is a glitch: the median needs half the window to follow
+    a real change, so an outlier right after another one is taken as the vitals
+    really moving, not as a glitch.
+    """
+
+    __slots__ = ("size", "flat_count", "glitch_sigmas", "values", "count", "position", "_sum", "_sum_sq",
+                 "_outlier")
+
+    def __init__(self, size=16, flat_count=8, glitch_sigmas=4.0):
+        self.size = size
+        self.flat_count = min(flat_count, size)
+        self.glitch_sigmas = glitch_sigmas
+        self.values = np.zeros((size, 4))
+        self.count = 0
+        self.position = 0
+        self._sum = np.zeros(4)
+        self._sum_sq = np.zeros(4)
+        self._outlier = False  # The previous reading was an outlier
+
+    def push(self, reading):
+        """
+        Add a reading and report whether it looks like a sensor glitch.
+
+        Parameters:
+            reading (VitalsReading): The decoded reading.
+
+        Returns:
+            bool: True if the reading is an outlier against the current window and
+            the reading before it was not. A deviation that repeats is a real change.
+        """
+        row = np.array(reading.vitals(), dtype=float)
+        outlier = self.is_glitch(row)
+        glitch = outlier and not self._outlier
+        self._outlier = outlier
+
+        if self.count == self.size:
+            evicted = self.values[self.position]
+            self._sum -= evicted
+            self._sum_sq -= evicted * evicted
+        else:
+            self.count += 1
+        self.values[self.position] = row
+        self._sum += row
+        self._sum_sq += row * row
+        self.position = (self.position + 1) % self.size
+        return glitch
+
+    def window(self):
+        return self.values if self.count == self.size else self.values[:self.count]
+
+    def mean(self):
+        return self._sum / max(self.count, 1)
+
+    def variance(self):
+        if self.count < 2:
+            return np.zeros(4)
+        mean = self.mean()
+        # Clamp tiny negative values left by floating-point cancellation
+        return np.maximum(self._sum_sq / self.count - mean * mean, 0.0)
+
+    def latest(self, count):
+        """The last count readings (fewer while the window fills), oldest first."""
+        count = min(count, self.count)
+        start = self.position - count
+        if start >= 0:
+            return self.values[start:self.position]
+        return np.concatenate((self.values[start:], self.values[:self.position]))
+
+    def median(self):
+        return np.median(self.window(), axis=0)
+
+    def is_glitch(self, row):
+        """True if the row deviates from the window median by more than the glitch limit."""
+        if self.count < 4:
+            return False
+        window = self.window()
+        median = np.median(window, axis=0)
+        mad = np.median(np.abs(window - median), axis=0) * MAD_TO_SIGMA
+        limit = np.maximum(self.glitch_sigmas * mad, MIN_GLITCH_DEVIATION)
+        return bool(np.any(np.abs(row - median) > limit))
+
+    def is_worn(self):
+        """
+        Classify the watch from the latest readings.
+
+        Not worn: the latest reading has no pulse or SpO2 (the sensor reports 0), or
+        the variance of every vital over the last flat_count readings is within
+        FLAT_VARIANCE. Until flat_count readings are in, the watch counts as worn.
+        """
+        if self.count == 0:
+            return True
+        last = self.values[self.position - 1]
+        if last[HEART_RATE] == 0 or last[SPO2] == 0:
+            return False
+        if self.count < self.flat_count:
+            return True
+        return bool(np.any(self.latest(self.flat_count).var(axis=0) > FLAT_VARIANCE))
+
+    def smoothed(self):
+        """
+        Median of the window per metric, as a dict keyed like VitalsReading attributes.
+        """
+        if self.count == 0:
+            return {}
+        return dict(zip(METRICS, (int(round(value)) for value in self.median())))
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "mean": dict(zip(METRICS, self.mean().round(2).tolist())),
+            "variance": dict(zip(METRICS, self.variance().round(2).tolist())),
+            "median": self.smoothed(),
+            "worn": self.is_worn(),
+        }
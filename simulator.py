@@ -0,0 +1,326 @@
+
+# simulator.py
+#
+# Simulated GTS watches plus drop-in stand-ins for the parts of BleakClient and
+# BleakScanner the gateway uses, so the whole scan/connect/fetch/upload path can
+# run (and be load tested) without hardware.
+
+import asyncio
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+from types import SimpleNamespace
+from frames import build_frame, build_vitals_frame, OPCODE_BATTERY, OPCODE_VITALS
+from commands import RESPONSE_BIT
+
+OPCODE_BINDING = 0x01
+OPCODE_CURRENT_DATA = 0x0D
+OPCODE_BATTERY_REQUEST = 0x06
+HANDSHAKE_OPCODES = (0x70, 0x0E, 0x31)  # Sensors ON, master switch, measurement interval
+
+class SimulatedWatch:
+    """
+    One virtual watch: answers the real opcodes with CRC-framed responses.
+
+    Parameters:
+        address (str): BLE address.
+        name (str): Advertised name.
+        latency (float): Seconds between a command and its response.
+        loss (float): Probability that a command gets no response at all.
+        worn (bool): When False, the watch repeats the same vitals forever.
+        rssi (int): Mean advertised RSSI.
+        mtu (int): ATT MTU; longer frames are split over several notifications of
+            mtu - 3 bytes. None sends every frame in one notification.
+
+    Like a real watch, it keeps its handshake settings across disconnects and only
+    reports vitals ("measuring" frames otherwise) once every handshake step was
+    received; reset() simulates a reboot that loses them.
+    """
+
+    def __init__(self, address, name=None, latency=0.05, loss=0.0, worn=True, rssi=-60, mtu=None,
+                 heart_rate=75, systolic=120, diastolic=80, spo2=97, glucose=5, battery=80):
+        self.address = address
+        self.name = name or f"GTS-{address[-5:].replace(':', '')}"
+        self.latency = latency
+        self.loss = loss
+        self.worn = worn
+        self.rssi = rssi
+        self.mtu = mtu
+        self.vitals = [heart_rate, systolic, diastolic, spo2, glucose]
+        self.battery = battery
+        self.configured = set()  # Handshake opcodes received since the last reset
+        self.connected = False
+        self.link = None  # The client connected to the watch
+        self.connections = 0
+        self.commands = 0
+        self.frames_sent = 0
+
+    def rssi_for(self, adapter=None):
+        """Mean RSSI as heard by one adapter: a fixed per-adapter offset, the same in every process."""
+        if adapter is None:
+            return self.rssi
+        return self.rssi + random.Random(f"{self.address}/{adapter}").randint(-15, 15)
+
+    def reset(self):
+        self.configured.clear()
+
+    def drop_link(self):
+        """Break the connection, as if the watch went out of range."""
+        if self.link is not None:
+            self.link._connected = False
+            self.link = None
+        self.connected = False
+
+    def next_vitals(self):
+        if self.worn:
+            # Small random walk, kept inside plausible ranges
+            bounds = ((45, 160), (85, 180), (50, 110), (85, 100), (3, 15))
+            steps = (3, 4, 3, 1, 1)
+            for i, ((low, high), step) in enumerate(zip(bounds, steps)):
+                self.vitals[i] = min(high, max(low, self.vitals[i] + random.randint(-step, step)))
+        return self.vitals
+
+    def respond(self, command):
+        """
+        Return the frames the watch answers a command with.
+
+        Parameters:
+            command (bytes): The command frame written by the gateway.
+
+        Returns:
+            list: Response frames (bytes); empty when the command is lost.
+        """
+        self.commands += 1
+        if len(command) < 2 or random.random() < self.loss:
+            return []
+        command_opcode = command[1]
+        if command_opcode in HANDSHAKE_OPCODES:
+            self.configured.add(command_opcode)
+            return [build_frame(command_opcode | RESPONSE_BIT, b"\x00")]
+        if command_opcode == OPCODE_BINDING:
+            return [build_frame(OPCODE_BINDING | RESPONSE_BIT, b"\x00\x01")]
+        if command_opcode == OPCODE_CURRENT_DATA:
+            if len(self.configured) < len(HANDSHAKE_OPCODES):
+                return [build_frame(OPCODE_VITALS, bytes(4))]  # Sensors off: still "measuring"
+            return [build_vitals_frame(*self.next_vitals())]
+        if command_opcode == OPCODE_BATTERY_REQUEST:
+            return [build_frame(OPCODE_BATTERY, bytes((0, self.battery)))]
+        return []
+
+class SimulatedFleet:
+    """The set of virtual watches the simulated client and scanner talk to."""
+
+    def __init__(self, watches=()):
+        self.watches = {watch.address: watch for watch in watches}
+
+    @classmethod
+    def generate(cls, count, seed=None, **watch_options):
+        """Generate count watches; the same seed gives the same fleet (e.g. in several processes)."""
+        rng = random.Random(seed)
+        watches = []
+        for i in range(count):
+            address = "C0:FF:EE:{:02X}:{:02X}:{:02X}".format((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF)
+            options = dict(watch_options)
+            options.setdefault("heart_rate", rng.randint(60, 95))
+            options.setdefault("rssi", rng.randint(-90, -45))
+            watches.append(SimulatedWatch(address, **options))
+        return cls(watches)
+
+# Fleet used by the stand-in classes below, set by install()
+_fleet = SimulatedFleet()
+
+class SimulatedBleakClient:
+    """Stand-in for bleak.BleakClient backed by a SimulatedWatch."""
+
+    def __init__(self, address_or_device, **kwargs):
+        self.address = getattr(address_or_device, "address", address_or_device)
+        self.watch = None
+        self._callback = None
+        self._connected = False
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self, **kwargs):
+        watch = _fleet.watches.get(self.address)
+        if watch is None:
+            raise ConnectionError(f"Device with address {self.address} was not found.")
+        await asyncio.sleep(watch.latency)
+        if watch.connected:
+            raise ConnectionError(f"Device {self.address} is already connected.")
+        watch.connected = True
+        watch.connections += 1
+        watch.link = self
+        self.watch = watch
+        self._connected = True
+        return True
+
+    async def disconnect(self):
+        if self._connected:
+            self._connected = False
+            self.watch.connected = False
+            self.watch.link = None
+        return True
+
+    async def start_notify(self, char_uuid, callback, **kwargs):
+        self._callback = callback
+
+    async def stop_notify(self, char_uuid):
+        self._callback = None
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        if not self._connected:
+            raise ConnectionError("Not connected")
+        loop = asyncio.get_running_loop()
+        size = self.watch.mtu - 3 if self.watch.mtu else None  # ATT notification header takes 3 bytes
+        for frame in self.watch.respond(bytes(data)):
+            if size is None or len(frame) <= size:
+                loop.call_later(self.watch.latency, self._notify, bytearray(frame))
+            else:
+                fragments = [bytearray(frame[i:i + size]) for i in range(0, len(frame), size)]
+                loop.call_later(self.watch.latency, self._notify_fragments, fragments)
+
+    def _notify_fragments(self, fragments):
+        for fragment in fragments:
+            self._notify(fragment)
+
+    def _notify(self, frame):
+        if self._connected and self._callback is not None:
+            self.watch.frames_sent += 1
+            self._callback(None, frame)
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+
+class SimulatedBleakScanner:
+    """
+    Stand-in for bleak.BleakScanner: every unconnected watch advertises periodically,
+    heard at the RSSI it has for the scanner's adapter.
+    """
+
+    advertise_interval = 0.5
+
+    def __init__(self, detection_callback=None, adapter=None, **kwargs):
+        self.detection_callback = detection_callback
+        self.adapter = adapter
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _advertise(self):
+        while True:
+            for watch in list(_fleet.watches.values()):
+                if not watch.connected and self.detection_callback:
+                    device = SimpleNamespace(address=watch.address, name=watch.name)
+                    advertisement = SimpleNamespace(rssi=watch.rssi_for(self.adapter) + random.randint(-4, 4))
+                    self.detection_callback(device, advertisement)
+            await asyncio.sleep(self.advertise_interval)
+
+@contextlib.contextmanager
+def install(fleet):
+    """Point the gateway modules at the simulated client and scanner for the duration."""
+    import connect
+    import currentdata
+    import scan
+
+    global _fleet
+    previous_fleet = _fleet
+    patched = [(connect, "BleakClient"), (currentdata, "BleakClient"), (scan, "BleakScanner")]
+    originals = [getattr(module, name) for module, name in patched]
+    _fleet = fleet
+    connect.BleakClient = currentdata.BleakClient = SimulatedBleakClient
+    scan.BleakScanner = SimulatedBleakScanner
+    try:
+        yield fleet
+    finally:
+        for (module, name), original in zip(patched, originals):
+            setattr(module, name, original)
+        _fleet = previous_fleet
+
+# Run N virtual watches through the real gateway loop against a local stand-in backend
+async def run_load(watches=50, duration=60.0, latency=0.05, loss=0.0, poll_interval=2.0,
+                   writes_per_second=200.0, sync_interval=None, high_risk=0, quiet=True):
+    import back
+    import currentdata
+    import logs
+    import merging
+    import sync
+    from scheduler import PollScheduler
+    from standin_backend import StandinBackend
+
+    fleet = SimulatedFleet.generate(watches, latency=latency, loss=loss)
+    outbox_dir = tempfile.mkdtemp(prefix="gateway-load-")
+    patched = [(back, "vital_url"), (back, "alert_url"), (back, "outbox_path"),
+               (back.upload_filter, "heartbeat_interval"), (currentdata, "default_scheduler"),
+               (merging, "MAX_CONCURRENT_CONNECTIONS"), (merging, "SYNC_INTERVAL"), (merging, "HIGH_RISK_DEVICES")]
+    originals = [getattr(module, name) for module, name in patched]
+    with StandinBackend() as backend, install(fleet):
+        try:
+            back.vital_url = backend.url("/vitals")
+            back.alert_url = backend.url("/alerts")
+            back.outbox_path = os.path.join(outbox_dir, "outbox.db")
+            back.upload_filter.heartbeat_interval = 0  # Upload every reading, to load the path fully
+            currentdata.default_scheduler = PollScheduler.uniform(poll_interval, writes_per_second)
+            merging.MAX_CONCURRENT_CONNECTIONS = watches
+            merging.SYNC_INTERVAL = sync_interval
+            merging.HIGH_RISK_DEVICES = sorted(fleet.watches)[:high_risk]
+
+            logs.configure("ERROR" if quiet else "INFO")
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(merging.continuous_scan_and_connect(), duration)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                back.stop_delivery()
+                logs.shutdown()
+            elapsed = time.perf_counter() - start
+        finally:
+            # Leave the gateway modules as they were, like install() does
+            for (module, name), original in zip(patched, originals):
+                setattr(module, name, original)
+
+        sessions = merging.session_manager.snapshot() if merging.session_manager else []
+        return {
+            "watches": watches,
+            "seconds": round(elapsed, 2),
+            "connected": sum(1 for session in sessions if session["state"] == "streaming"),
+            "connections": sum(watch.connections for watch in fleet.watches.values()),
+            "commands": sum(watch.commands for watch in fleet.watches.values()),
+            "frames": sum(watch.frames_sent for watch in fleet.watches.values()),
+            "backend_requests": backend.requests,
+            "backend_payloads": backend.payloads,
+            "payloads_per_second": round(backend.payloads / elapsed, 1),
+            "syncs": int(sync.syncs.value(sync.SYNC_OK_LABELS)),
+        }
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run virtual GTS watches through the gateway.")
+    parser.add_argument("--watches", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=float, default=2.0)
+    parser.add_argument("--sync-interval", type=float, default=None,
+                        help="Seconds between syncs; live polling when omitted")
+    parser.add_argument("--high-risk", type=int, default=0, help="Watches kept on live polling in sync mode; sync stays off at 0")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run_load(args.watches, args.duration, args.latency, args.loss,
+                                          args.poll_interval, sync_interval=args.sync_interval,
+                                          high_risk=args.high_risk)), indent=2))
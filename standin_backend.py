@@ -0,0 +1,94 @@
+
+# standin_backend.py
+#
+# A local stand-in for the vitals/alerts API, used to measure upload throughput
+# without touching the real backend.
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StandinBackend:
+    """
+    Minimal HTTP server that accepts any JSON POST and answers 201.
+
+    Parameters:
+        host (str): Interface to bind.
+        port (int): Port to bind, 0 picks a free one.
+        delay (float): Seconds to wait before answering, to simulate a slow backend.
+        status (int): Status code returned for every request.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, delay=0.0, status=201):
+        self.delay = delay
+        self.status = status
+        self.requests = 0
+        self.payloads = 0
+        self.received = []  # (path, body) of every request, when keep_bodies is set
+        self.keep_bodies = False
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    def _make_handler(self):
+        backend = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive, like a real backend
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"null")
+                backend._record(self.path, body)
+                if backend.delay:
+                    time.sleep(backend.delay)
+                reply = b'{"status": "ok"}'
+                self.send_response(backend.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _record(self, path, body):
+        with self._lock:
+            self.requests += 1
+            self.payloads += len(body) if isinstance(body, list) else 1
+            if self.keep_bodies:
+                self.received.append((path, body))
+
+    def url(self, path=""):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}{path}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+if __name__ == "__main__":
+    backend = StandinBackend(port=8000).start()
+    print(f"Stand-in backend listening on {backend.url()}")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"Requests: {backend.requests}, payloads: {backend.payloads}")
+    except KeyboardInterrupt:
+        backend.stop()
@@ -0,0 +1,111 @@
+
+# streams.py
+
+import asyncio
+import collections
+import json
+import time
+import metrics
+
+# Readings a subscriber may fall behind by before the oldest are dropped
+DEFAULT_BUFFER = 256
+
+stream_dropped = metrics.Counter(
+    "gateway_stream_dropped_total", "Readings dropped from slow stream subscribers' buffers.")
+
+class Subscription:
+    """
+    One stream consumer: a bounded buffer of encoded events.
+
+    When the buffer is full the oldest event is dropped to make room, so a slow
+    consumer loses readings but never holds up the publisher. Event ids are the
+    hub's sequence numbers, so a consumer can see where the gaps are.
+
+    Parameters:
+        devices (set): Watch addresses to receive; None for the whole fleet.
+        max_buffer (int): Most events kept for this consumer.
+    """
+
+    def __init__(self, devices=None, max_buffer=DEFAULT_BUFFER):
+        self.devices = devices
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.dropped = 0
+        self._ready = asyncio.Event()
+
+    def wants(self, address):
+        return self.devices is None or address in self.devices
+
+    def push(self, event):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            stream_dropped.inc()
+        self.buffer.append(event)
+        self._ready.set()
+
+    async def next_batch(self, timeout=None):
+        """
+        Wait for events and take everything buffered.
+
+        Parameters:
+            timeout (float): Seconds to wait; an empty list is returned on timeout.
+
+        Returns:
+            list: (sequence, data) events, oldest first.
+        """
+        if not self.buffer:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        batch = list(self.buffer)
+        self.buffer.clear()
+        return batch
+
+class VitalsHub:
+    """
+    Fans readings out to every live subscriber on the BLE event loop.
+
+    publish() is called from the notification handler. It does nothing but a length
+    check while nobody is subscribed; otherwise each reading is encoded to JSON once
+    and the same bytes are pushed to every interested subscriber.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+        self.sequence = 0
+
+    def subscribe(self, devices=None, max_buffer=DEFAULT_BUFFER):
+        subscription = Subscription(set(devices) if devices else None, max_buffer)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def publish(self, address, reading, timestamp=None):
+        """
+        Parameters:
+            address (str): The watch address.
+            reading (VitalsReading): The decoded reading.
+            timestamp (float): Unix time of the reading, defaults to now.
+        """
+        if not self.subscribers:
+            return
+        targets = [subscription for subscription in self.subscribers if subscription.wants(address)]
+        if not targets:
+            return
+        self.sequence += 1
+        values = reading.as_dict()
+        if reading.smoothed is not None:
+            values["smoothed"] = reading.smoothed
+        values["address"] = address
+        values["timestamp"] = time.time() if timestamp is None else timestamp
+        event = (self.sequence, json.dumps(values))
+        for subscription in targets:
+            subscription.push(event)
+
+# Hub shared by the notification handlers and the stream server
+default_hub = VitalsHub()
+
+metrics.Gauge("gateway_stream_subscribers", "Live stream subscribers.", lambda: len(default_hub.subscribers))
@@ -0,0 +1,129 @@
+
+# sync.py
+#
+# Periodic sample sync mode. Instead of holding every watch's connection and polling it every
+# ~30 s, a watch is connected every interval seconds, asked for its current vitals and
+# battery level and disconnected again, so each link is held for a few seconds and one
+# adapter can serve many more watches. Watches flagged high-risk, and any watch whose
+# last reading was abnormal, stay on live polling. Sync mode stays off until at least one
+# watch is flagged high-risk, so a misconfigured gateway never samples every watch.
+#
+# This is sampling, not a download: the protocol has no command for the readings a
+# watch took while disconnected, so nothing between two syncs is ever seen. A sync
+# every interval seconds yields interval / 30 times fewer readings than live polling,
+# and an abnormal episode that starts and ends between two syncs neither reaches the
+# backend nor escalates the watch to live polling.
+
+import time
+import logs
+import metrics
+from scheduler import classify_reading
+
+log = logs.get_logger("sync")
+
+# Connection modes of a watch
+LIVE = "live"  # Connected, polled at the scheduler's cadence
+SYNC = "sync"  # Connected every interval seconds for one sample
+
+# Seconds between two syncs of a watch: twice the live polling interval, and well within
+# the upload heartbeat (upload_filter.UploadFilter), so the backend hears from every watch
+# at least as often as it did before
+DEFAULT_INTERVAL = 60.0
+
+# Seconds before a failed sync is tried again
+RETRY_AFTER = 60.0
+
+# Seconds an abnormal or fast-changing reading keeps a watch on live polling
+ESCALATION_HOLD = 1800.0
+
+syncs = metrics.Counter("gateway_syncs_total", "Periodic sample syncs (one reading per connection), by result.", ("result",))
+SYNC_OK_LABELS = ("ok",)
+SYNC_FAILED_LABELS = ("failed",)
+
+class SyncPolicy:
+    """
+    Decides per watch between live polling and periodic sync, and when the next sync is due.
+
+    A watch is live while it is flagged high-risk or for escalation_hold seconds
+    after a reading the scheduler would poll fast (abnormal or changing vitals);
+    otherwise it syncs every interval seconds. While no watch is flagged high-risk
+    every watch stays live: sampling is refused rather than applied to the whole
+    fleet, including the watches that should have been flagged. A live session of a watch that is no
+    longer live ends at its next poll, and the watch goes back to syncing.
+
+    Parameters:
+        interval (float): Seconds between syncs; None keeps every watch on live polling.
+            Readings between two syncs are lost (see the top of this module).
+        high_risk (iterable): Addresses always polled live; empty keeps sync mode off.
+        escalation_hold (float): Seconds an abnormal reading keeps a watch live.
+        retry_after (float): Seconds before a failed sync is retried.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, high_risk=(), escalation_hold=ESCALATION_HOLD,
+                 retry_after=RETRY_AFTER):
+        self.interval = interval
+        self.high_risk = set(high_risk)
+        self.escalation_hold = escalation_hold
+        self.retry_after = retry_after
+        self.next_sync = {}
+        self.live_until = {}
+        self.last_readings = {}
+        self.last_sync = {}
+
+    def mode(self, address, now=None):
+        if self.interval is None or not self.high_risk or address in self.high_risk:
+            return LIVE
+        now = time.monotonic() if now is None else now
+        return LIVE if self.live_until.get(address, 0) > now else SYNC
+
+    def due(self, address, now=None):
+        """True if the watch should be connected now (live watches always are)."""
+        now = time.monotonic() if now is None else now
+        return self.mode(address, now) == LIVE or now >= self.next_sync.get(address, 0)
+
+    def keep_live(self, address):
+        """Whether a live session should keep polling; passed to fetch_current_data."""
+        return self.mode(address) == LIVE
+
+    def set_high_risk(self, address, high_risk=True):
+        if high_risk:
+            self.high_risk.add(address)
+        else:
+            self.high_risk.discard(address)
+
+    def report_reading(self, address, reading):
+        """Escalate the watch to live polling if this reading calls for fast polling."""
+        last = self.last_readings.get(address)
+        self.last_readings[address] = reading
+        if classify_reading(reading, last) == "fast" and self.interval is not None:
+            if self.mode(address) == SYNC:
+                log.info("Abnormal reading, switching to live polling for %.0fs", self.escalation_hold,
+                         extra={"device": address})
+            self.live_until[address] = time.monotonic() + self.escalation_hold
+
+    def session_ended(self, address, mode, ok):
+        """
+        Schedule the watch's next sync after a session.
+
+        Parameters:
+            address (str): The watch address.
+            mode (str): LIVE or SYNC, the mode the session ran in.
+            ok (bool): Whether the session connected and fetched data.
+        """
+        now = time.monotonic()
+        if mode == SYNC:
+            syncs.inc(SYNC_OK_LABELS if ok else SYNC_FAILED_LABELS)
+            if ok:
+                self.last_sync[address] = now
+        # A live session that ended just had fresh data, so it counts as a sync too
+        self.next_sync[address] = now + ((self.interval or 0) if ok else self.retry_after)
+
+    def snapshot(self):
+        now = time.monotonic()
+        addresses = set(self.next_sync) | self.high_risk | set(self.live_until)
+        return {address: {
+            "mode": self.mode(address, now),
+            "high_risk": address in self.high_risk,
+            "seconds_until_sync": round(max(0.0, self.next_sync.get(address, now) - now), 1),
+            "seconds_since_sync": round(now - self.last_sync[address], 1) if address in self.last_sync else None,
+        } for address in sorted(addresses)}
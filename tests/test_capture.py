@@ -0,0 +1,59 @@
+# test_capture.py
+
+import capture
+from capture import NotificationRecorder, replay
+from frames import build_vitals_frame
+
+FRAME = build_vitals_frame(72, 120, 80, 97, 5)
+
+class _FailingFile:
+    def write(self, data):
+        raise OSError(28, "No space left on device")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_queue_is_bounded(tmp_path):
+    recorder = NotificationRecorder(str(tmp_path), max_pending=3)
+    for _ in range(5):
+        recorder.record("C0:FF:EE:00:00:01", FRAME)
+    assert recorder.dropped == 2
+    assert len(recorder._pending) == 3
+
+# Notifications lost to a failed write are counted, and the next drain starts a new file
+def test_write_failure_counts_dropped(tmp_path):
+    recorder = NotificationRecorder(str(tmp_path))
+    recorder.record("C0:FF:EE:00:00:01", FRAME)
+    recorder._drain()
+    assert recorder.recorded == 1 and len(recorder.files) == 1
+
+    dropped_before = capture.capture_dropped.value()
+    recorder._file = _FailingFile()
+    for _ in range(4):
+        recorder.record("C0:FF:EE:00:00:01", FRAME)
+    recorder._drain()
+    assert recorder.dropped == 4
+    assert capture.capture_dropped.value() - dropped_before == 4
+    assert recorder.recorded == 1
+    assert recorder._file is None
+
+    recorder.record("C0:FF:EE:00:00:02", FRAME)
+    recorder._drain()
+    recorder._close_file()
+    assert recorder.recorded == 2
+    assert len(recorder.files) == 2
+    assert replay(recorder.files[1:])["notifications"] == 1
+
+# Rotating in the middle of a drain keeps every notification and counts each once
+def test_rotation_during_drain(tmp_path):
+    recorder = NotificationRecorder(str(tmp_path), max_bytes=200)
+    for _ in range(10):
+        recorder.record("C0:FF:EE:00:00:01", FRAME)
+    recorder._drain()
+    recorder._close_file()
+    assert recorder.recorded == 10
+    assert len(recorder.files) > 1
+    assert replay(recorder.files)["notifications"] == 10
@@ -0,0 +1,19 @@
+# test_crc_utils.py
+
+import metrics
+from crc_utils import verify_frames, verify_frames_numpy
+from frames import build_vitals_frame
+
+# Every batch path counts the same CRC failures for the same frames
+def test_batch_paths_count_failures_alike():
+    frames = [bytearray(build_vitals_frame(70 + i, 120, 80, 97, 5)) for i in range(6)]
+    frames[1][5] ^= 0xFF
+    frames[4][-1] ^= 0x01
+
+    before = metrics.crc_failures.value()
+    assert verify_frames(frames) == [True, False, True, True, False, True]
+    listed = metrics.crc_failures.value() - before
+
+    before = metrics.crc_failures.value()
+    assert verify_frames_numpy(b"".join(frames), len(frames[0])).tolist() == [True, False, True, True, False, True]
+    assert metrics.crc_failures.value() - before == listed == 2
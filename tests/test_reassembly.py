@@ -0,0 +1,135 @@
+# test_reassembly.py
+
+import random
+import pytest
+from frames import build_frame, build_vitals_frame, OPCODE_BATTERY
+from reassembly import FrameReassembler
+
+def make_frames(count, seed=0):
+    rng = random.Random(seed)
+    frames = []
+    for _ in range(count):
+        if rng.random() < 0.7:
+            frames.append(build_vitals_frame(rng.randint(40, 180), rng.randint(90, 180), rng.randint(50, 110),
+                                             rng.randint(85, 100), rng.randint(3, 15),
+                                             payload_length=rng.choice((30, 60, 200))))
+        else:
+            frames.append(build_frame(OPCODE_BATTERY, bytes((0, rng.randint(0, 100)))))
+    return frames
+
+def collector(**options):
+    received = []
+    reassembler = FrameReassembler(lambda sender, frame: received.append(bytes(frame)), **options)
+    return reassembler, received
+
+def split(stream, rng, low=1, high=80):
+    position = 0
+    while position < len(stream):
+        size = rng.randint(low, high)
+        yield stream[position:position + size]
+        position += size
+
+# One whole frame per notification takes the fast path and comes out unchanged
+def test_whole_frames():
+    frames = make_frames(50)
+    reassembler, received = collector()
+    for frame in frames:
+        reassembler.feed(bytearray(frame))
+    assert received == frames
+    assert reassembler.discarded == 0
+    assert not reassembler.buffer
+
+# Random splits and merges of the stream give back every frame, in order
+@pytest.mark.parametrize("seed", range(5))
+def test_random_splits(seed):
+    rng = random.Random(seed)
+    frames = make_frames(2000, seed)
+    reassembler, received = collector()
+    for chunk in split(b"".join(frames), rng):
+        reassembler.feed(chunk)
+    assert received == frames
+    assert reassembler.discarded == 0
+    assert not reassembler.buffer
+
+# Fragments of one frame arriving one byte at a time carry the CRC across every feed
+def test_byte_at_a_time():
+    frames = make_frames(20, seed=7)
+    reassembler, received = collector()
+    for byte in b"".join(frames):
+        reassembler.feed(bytes((byte,)))
+    assert received == frames
+
+# Bytes before a header are skipped and counted
+def test_junk_between_frames():
+    frames = make_frames(3, seed=1)
+    junk = b"\x01\x02\xff\x00\x10"
+    reassembler, received = collector()
+    reassembler.feed(junk + frames[0] + junk + frames[1])
+    reassembler.feed(junk[:2])
+    reassembler.feed(frames[2])
+    assert received == frames
+    assert reassembler.discarded == 2 * len(junk) + 2
+
+# A frame with a corrupted byte is dropped and the next valid frame is found again
+def test_corrupted_frame():
+    frames = make_frames(3, seed=2)
+    corrupted = bytearray(frames[1])
+    corrupted[6] ^= 0xFF
+    reassembler, received = collector()
+    for chunk in split(frames[0] + bytes(corrupted) + frames[2], random.Random(3), 5, 17):
+        reassembler.feed(chunk)
+    assert received == [frames[0], frames[2]]
+    assert reassembler.discarded >= len(corrupted)
+
+# A frame whose tail never came is dropped when the next whole frame arrives
+def test_lost_fragment():
+    frames = make_frames(2, seed=4)
+    reassembler, received = collector()
+    reassembler.feed(frames[0][:len(frames[0]) // 2])
+    reassembler.feed(frames[1])
+    assert received == [frames[1]]
+    assert reassembler.discarded == len(frames[0]) // 2
+    assert not reassembler.buffer
+
+# An incomplete frame older than stale_after is discarded before new bytes are added
+def test_stale_partial_frame(monkeypatch):
+    import reassembly
+    now = [100.0]
+    monkeypatch.setattr(reassembly.time, "monotonic", lambda: now[0])
+    frames = make_frames(2, seed=5)
+    reassembler, received = collector(stale_after=5.0)
+    reassembler.feed(frames[0][:4])
+    now[0] += 10.0
+    reassembler.feed(frames[1][:3])
+    reassembler.feed(frames[1][3:])
+    assert received == [frames[1]]
+    assert reassembler.discarded == 4
+
+# A length field beyond max_frame is taken as a corrupted header, not waited for
+def test_oversized_length():
+    frame = make_frames(1, seed=6)[0]
+    bogus = bytes((0xDA, 0x8D, 0xFF, 0x7F))
+    reassembler, received = collector(max_frame=256)
+    reassembler.feed(bogus + frame[:5])
+    reassembler.feed(frame[5:])
+    assert received == [frame]
+
+# A handler that raises still consumes its frame; frames are views only valid during the call
+def test_handler_errors():
+    frames = make_frames(3, seed=8)
+    received = []
+    views = []
+
+    def on_frame(sender, frame):
+        views.append(frame)
+        received.append(bytes(frame))
+        if len(received) == 1:
+            raise ValueError("handler failed")
+
+    reassembler = FrameReassembler(on_frame)
+    with pytest.raises(ValueError):
+        reassembler.feed(frames[0] + frames[1][:3])
+    reassembler.feed(frames[1][3:] + frames[2])
+    assert received == frames
+    with pytest.raises(ValueError):
+        bytes(views[1])
@@ -0,0 +1,56 @@
+# test_sharding.py
+
+from sharding import ShardCoordinator, _Watch, SIGHTING_TTL
+
+NOW = 1000.0
+
+def coordinator(adapters=("hci0", "hci1"), max_per_adapter=4, load_weight=20.0):
+    shards = ShardCoordinator(list(adapters), max_per_adapter=max_per_adapter, load_weight=load_weight)
+    for handle in shards.workers.values():
+        handle.alive = True  # No processes: choose_adapter only looks at the handles
+    return shards
+
+def watch(sightings, address="C0:FF:EE:00:00:01"):
+    result = _Watch(address, "GTS-0001", NOW)
+    result.sightings = {adapter: (rssi, NOW - age) for adapter, (rssi, age) in sightings.items()}
+    return result
+
+def load(shards, adapter, count):
+    shards.workers[adapter].assigned.update(f"other-{adapter}-{i}" for i in range(count))
+
+def test_loudest_adapter_wins():
+    shards = coordinator()
+    assert shards.choose_adapter(watch({"hci0": (-70, 0), "hci1": (-50, 0)}), NOW) == "hci1"
+
+# Load counts load_weight dB at full load: a busier adapter loses once the RSSI gap is small enough
+def test_load_outweighs_a_small_rssi_gap():
+    shards = coordinator()
+    load(shards, "hci1", 2)  # 10 dB penalty
+    assert shards.choose_adapter(watch({"hci0": (-58, 0), "hci1": (-50, 0)}), NOW) == "hci0"
+    assert shards.choose_adapter(watch({"hci0": (-62, 0), "hci1": (-50, 0)}), NOW) == "hci1"
+
+def test_full_adapter_is_skipped():
+    shards = coordinator()
+    load(shards, "hci1", 4)
+    assert shards.choose_adapter(watch({"hci0": (-90, 0), "hci1": (-40, 0)}), NOW) == "hci0"
+    load(shards, "hci0", 4)
+    assert shards.choose_adapter(watch({"hci0": (-90, 0), "hci1": (-40, 0)}), NOW) is None
+
+def test_dead_worker_and_stale_sightings_are_skipped():
+    shards = coordinator()
+    shards.workers["hci1"].alive = False
+    assert shards.choose_adapter(watch({"hci0": (-80, 0), "hci1": (-40, 0)}), NOW) == "hci0"
+    shards.workers["hci1"].alive = True
+    assert shards.choose_adapter(watch({"hci0": (-80, 0), "hci1": (-40, SIGHTING_TTL + 1)}), NOW) == "hci0"
+    assert shards.choose_adapter(watch({"hci3": (-40, 0)}), NOW) is None
+
+def test_unheard_watches_are_evicted():
+    shards = coordinator()
+    shards.watches = {
+        "stale": watch({"hci0": (-60, SIGHTING_TTL + 1)}, "stale"),
+        "fresh": watch({"hci0": (-60, SIGHTING_TTL + 1), "hci1": (-60, 1)}, "fresh"),
+        "assigned": watch({"hci0": (-60, SIGHTING_TTL + 1)}, "assigned"),
+    }
+    shards.watches["assigned"].adapter = "hci0"
+    assert shards.evict_stale(NOW) == 1
+    assert sorted(shards.watches) == ["assigned", "fresh"]
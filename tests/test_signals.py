@@ -0,0 +1,102 @@
+# test_signals.py
+
+import asyncio
+import pytest
+import back
+import currentdata
+from alerts import AlertEngine
+from frames import VitalsReading, build_vitals_frame, OPCODE_VITALS
+from scheduler import PollScheduler
+from signals import VitalsWindow
+
+ADDRESS = "C0:FF:EE:00:00:01"
+
+# Sixteen readings of a steady, worn watch: HR 70-72, SpO2 97
+STABLE = [(70 + i % 3, 120, 80, 97, 5) for i in range(16)]
+
+def stable_window():
+    window = VitalsWindow()
+    for vitals in STABLE:
+        window.push(VitalsReading(*vitals))
+    return window
+
+@pytest.mark.parametrize("step", [(140, 120, 80, 97, 5), (71, 120, 80, 89, 5)])
+def test_sustained_step_is_not_a_glitch(step):
+    window = stable_window()
+    assert [window.push(VitalsReading(*step)) for _ in range(10)] == [True] + [False] * 9
+
+def test_isolated_outlier_is_a_glitch():
+    window = stable_window()
+    assert window.push(VitalsReading(150, 120, 80, 97, 5))
+    assert not window.push(VitalsReading(71, 120, 80, 97, 5))
+
+def test_steady_vitals_stay_worn():
+    window = stable_window()
+    assert window.is_worn()
+    for _ in range(8):
+        window.push(VitalsReading(72, 120, 80, 97, 5))
+    assert not window.is_worn()
+
+class _Client:
+    address = ADDRESS
+    is_connected = True
+
+    async def write_gatt_char(self, char_uuid, data, response=False):
+        pass
+
+class _Router:
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, frame_opcode, handler):
+        self.handlers[frame_opcode] = handler
+
+    def unregister(self, frame_opcode, handler):
+        self.handlers.pop(frame_opcode, None)
+
+# Feed frames to fetch_current_data's vitals handler; returns the alert types raised per frame
+def run_handler(monkeypatch, vitals):
+    alerts = []
+    monkeypatch.setattr(back, "send_alert2", lambda address, host, alert_type, text, **kwargs: alerts.append(alert_type))
+    monkeypatch.setattr(back, "queue_data_for_backend", lambda *args, **kwargs: True)
+    scheduler = PollScheduler(writes_per_second=1000.0, burst=1000)
+    router = _Router()
+
+    async def run():
+        task = asyncio.create_task(currentdata.fetch_current_data(
+            _Client(), "write", "notify", ADDRESS, "host", router=router, scheduler=scheduler,
+            alert_engine=AlertEngine()))
+        await asyncio.sleep(0)
+        raised = []
+        for values in vitals:
+            before = len(alerts)
+            router.handlers[OPCODE_VITALS](None, build_vitals_frame(*values))
+            raised.append(alerts[before:])
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return raised
+
+    return asyncio.run(run())
+
+# A real jump in heart rate raises its alert on the first reading over the limit
+@pytest.mark.parametrize("heart_rate", [140, 50])
+def test_sustained_heart_rate_step_alerts_at_once(monkeypatch, heart_rate):
+    steady = [(86 + i % 3, 120, 80, 97, 5) for i in range(16)]  # Inside the 84-100 alert band
+    raised = run_handler(monkeypatch, steady + [(heart_rate, 120, 80, 97, 5)] * 3)
+    assert raised[:len(steady)] == [[]] * len(steady)
+    assert raised[len(steady):] == [["heart_rate"], [], []]
+
+# A real desaturation switches the watch to fast polling by its second reading
+def test_sustained_spo2_step_polls_fast(monkeypatch):
+    scheduler_modes = []
+    original = PollScheduler.report_reading
+
+    def report_reading(self, address, reading):
+        original(self, address, reading)
+        scheduler_modes.append(self.devices[address].mode)
+
+    monkeypatch.setattr(PollScheduler, "report_reading", report_reading)
+    run_handler(monkeypatch, STABLE + [(71, 120, 80, 89, 5)] * 2)
+    assert scheduler_modes[-1] == "fast"
+    assert len(scheduler_modes) == len(STABLE) + 1
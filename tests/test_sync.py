@@ -0,0 +1,30 @@
+import sync
+from sync import SyncPolicy, LIVE, SYNC
+
+
+def test_sync_refused_without_high_risk_watches():
+    policy = SyncPolicy(interval=60, high_risk=())
+    assert policy.mode("AA", now=0) == LIVE
+    assert policy.due("AA", now=0)
+
+
+def test_flagging_a_watch_turns_sync_on_for_the_others():
+    policy = SyncPolicy(interval=60, high_risk=())
+    policy.set_high_risk("AA")
+    assert policy.mode("AA", now=0) == LIVE
+    assert policy.mode("BB", now=0) == SYNC
+    policy.set_high_risk("AA", False)
+    assert policy.mode("BB", now=0) == LIVE
+
+
+def test_no_interval_keeps_every_watch_live():
+    policy = SyncPolicy(interval=None, high_risk=("AA",))
+    assert policy.mode("BB", now=0) == LIVE
+
+
+def test_sync_counts_periodic_samples():
+    policy = SyncPolicy(interval=60, high_risk=("AA",))
+    before = sync.syncs.value(sync.SYNC_OK_LABELS)
+    policy.session_ended("BB", SYNC, True)
+    assert sync.syncs.value(sync.SYNC_OK_LABELS) == before + 1
+    assert not policy.due("BB")
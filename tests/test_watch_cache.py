@@ -0,0 +1,83 @@
+# test_watch_cache.py
+
+from watch_cache import WatchConfigCache, FULL, VERIFIED
+
+ADDRESS = "C0:FF:EE:00:00:01"
+STEPS = [("sensors_on", "DA70"), ("master_switch", "DA0E"), ("measurement_interval", "DA31")]
+NAMES = [name for name, _ in STEPS]
+
+# A watch that completed a session with a valid reading, disconnected at time 100
+def configured_cache(monkeypatch, failed=()):
+    import watch_cache
+    monkeypatch.setattr(watch_cache.time, "monotonic", lambda: 100.0)
+    cache = WatchConfigCache(verify_within=600.0)
+    cache.connecting(ADDRESS)
+    for name, command in STEPS:
+        cache.step_applied(ADDRESS, name, command, name not in failed)
+    cache.handshake_done(ADDRESS, FULL)
+    cache.first_reading(ADDRESS)
+    cache.disconnected(ADDRESS)
+    return cache
+
+def test_unknown_watch_gets_every_step():
+    assert WatchConfigCache().plan(ADDRESS, STEPS) == (FULL, NAMES)
+
+# Even a reconnect a second later is verified, since a rebooted watch is back that fast
+def test_quick_reconnect_is_verified(monkeypatch):
+    cache = configured_cache(monkeypatch)
+    assert cache.plan(ADDRESS, STEPS, now=101.0) == (VERIFIED, [])
+
+def test_expired_cache_gets_every_step(monkeypatch):
+    cache = configured_cache(monkeypatch)
+    assert cache.plan(ADDRESS, STEPS, now=701.0) == (FULL, NAMES)
+
+# Failed and changed steps are sent again
+def test_failed_and_changed_steps_are_resent(monkeypatch):
+    cache = configured_cache(monkeypatch, failed=("master_switch",))
+    changed = [(name, "DA31FF" if name == "measurement_interval" else command) for name, command in STEPS]
+    assert cache.plan(ADDRESS, changed, now=110.0) == (VERIFIED, ["master_switch", "measurement_interval"])
+
+# Steps are only trusted once a session produced a valid reading
+def test_session_without_reading_is_not_trusted(monkeypatch):
+    cache = configured_cache(monkeypatch)
+    cache.connecting(ADDRESS)
+    cache.handshake_done(ADDRESS, VERIFIED)
+    cache.disconnected(ADDRESS)
+    assert cache.plan(ADDRESS, STEPS, now=110.0) == (FULL, NAMES)
+
+def test_invalidated_watch_gets_every_step(monkeypatch):
+    cache = configured_cache(monkeypatch)
+    cache.invalidate(ADDRESS)
+    assert cache.plan(ADDRESS, STEPS, now=110.0) == (FULL, NAMES)
+
+# A watch reset between two sessions gets its full handshake again
+def test_rebooted_watch_is_configured_again():
+    import asyncio
+    import connect
+    import simulator
+    from router import NotificationRouter
+
+    watch = simulator.SimulatedWatch(ADDRESS, latency=0.001)
+    cache = WatchConfigCache()
+
+    async def session():
+        client = simulator.SimulatedBleakClient(ADDRESS)
+        await client.connect()
+        router = await NotificationRouter(client, "notify").start()
+        try:
+            cache.connecting(ADDRESS)
+            mode, configured = await connect.configure_watch(client, "write", "notify", router, cache)
+            if configured and watch.configured:
+                cache.first_reading(ADDRESS)
+            return mode, configured
+        finally:
+            await router.stop()
+            await client.disconnect()
+            cache.disconnected(ADDRESS)
+
+    with simulator.install(simulator.SimulatedFleet([watch])):
+        assert asyncio.run(session()) == (FULL, True)
+        assert asyncio.run(session()) == (VERIFIED, True)
+        watch.reset()
+        assert asyncio.run(session()) == (FULL, True)
+    assert len(watch.configured) == 3
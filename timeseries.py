@@ -0,0 +1,162 @@
+
+# timeseries.py
+
+import threading
+import time
+import numpy as np
+
+# Column layout of every per-watch series; missing values are stored as -1
+COLUMNS = ("heart_rate", "systolic", "diastolic", "spo2", "glucose", "battery_level", "worn")
+MISSING = -1
+
+class DeviceSeries:
+    """
+    Recent readings of one watch in preallocated NumPy columns.
+
+    Rows are appended at the end of a buffer twice the capacity; when the end is
+    reached the live rows are moved back to the front, so appends are amortized O(1)
+    and the live rows always form one contiguous, time-ordered slice that range
+    queries can binary-search.
+
+    Parameters:
+        capacity (int): Most readings kept.
+        max_age (float): Readings older than this many seconds are evicted.
+    """
+
+    def __init__(self, capacity=4096, max_age=24 * 3600):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.timestamps = np.zeros(capacity * 2)
+        self.values = np.full((capacity * 2, len(COLUMNS)), MISSING, dtype=np.int16)
+        self.start = 0
+        self.end = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def append(self, timestamp, row):
+        with self.lock:
+            if self.end == len(self.timestamps):
+                live = self.end - self.start
+                self.timestamps[:live] = self.timestamps[self.start:self.end]
+                self.values[:live] = self.values[self.start:self.end]
+                self.start, self.end = 0, live
+            self.timestamps[self.end] = timestamp
+            self.values[self.end] = row
+            self.end += 1
+            if self.end - self.start > self.capacity:
+                self.start += 1
+            self._evict(timestamp)
+
+    def _evict(self, now):
+        cutoff = now - self.max_age
+        if self.start < self.end and self.timestamps[self.start] < cutoff:
+            self.start += int(np.searchsorted(self.timestamps[self.start:self.end], cutoff))
+
+    def latest(self):
+        with self.lock:
+            if self.end == self.start:
+                return None
+            return _row_dict(self.timestamps[self.end - 1], self.values[self.end - 1])
+
+    def _slice(self, start=None, end=None):
+        timestamps = self.timestamps[self.start:self.end]
+        lo = 0 if start is None else int(np.searchsorted(timestamps, start, side="left"))
+        hi = len(timestamps) if end is None else int(np.searchsorted(timestamps, end, side="right"))
+        return self.start + lo, self.start + hi
+
+    def range(self, start=None, end=None, limit=None):
+        """Readings with start <= timestamp <= end, oldest first (the newest limit if given)."""
+        with self.lock:
+            lo, hi = self._slice(start, end)
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            timestamps = self.timestamps[lo:hi].copy()
+            values = self.values[lo:hi].copy()
+        return [_row_dict(timestamp, row) for timestamp, row in zip(timestamps, values)]
+
+    def aggregate(self, start=None, end=None, bucket=60.0):
+        """
+        Downsample into fixed buckets with min, mean and max per metric.
+
+        Returns:
+            list: One dict per non-empty bucket, oldest first.
+        """
+        with self.lock:
+            lo, hi = self._slice(start, end)
+            timestamps = self.timestamps[lo:hi].copy()
+            values = self.values[lo:hi].astype(float)
+        if not len(timestamps):
+            return []
+        values[values == MISSING] = np.nan
+        bucket_ids = np.floor(timestamps / bucket).astype(np.int64)
+        # Rows are time-ordered, so each bucket is one contiguous run
+        boundaries = np.flatnonzero(np.diff(bucket_ids)) + 1
+        results = []
+        with np.errstate(all="ignore"):
+            for run_start, run_end in zip(np.r_[0, boundaries], np.r_[boundaries, len(timestamps)]):
+                run = values[run_start:run_end]
+                summary = {"start": float(bucket_ids[run_start] * bucket), "count": int(run_end - run_start)}
+                for column, name in enumerate(COLUMNS):
+                    column_values = run[:, column]
+                    if np.all(np.isnan(column_values)):
+                        continue
+                    summary[name] = {
+                        "min": float(np.nanmin(column_values)),
+                        "mean": round(float(np.nanmean(column_values)), 2),
+                        "max": float(np.nanmax(column_values)),
+                    }
+                results.append(summary)
+        return results
+
+def _row_dict(timestamp, row):
+    result = {"timestamp": float(timestamp)}
+    for name, value in zip(COLUMNS, row.tolist()):
+        if value != MISSING:
+            result[name] = value
+    if "worn" in result:
+        result["worn"] = bool(result["worn"])
+    return result
+
+class TimeSeriesStore:
+    """Bounded in-memory history of every watch, keyed by address."""
+
+    def __init__(self, capacity=4096, max_age=24 * 3600):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def _series(self, address):
+        series = self.series.get(address)
+        if series is None:
+            with self._lock:
+                series = self.series.setdefault(address, DeviceSeries(self.capacity, self.max_age))
+        return series
+
+    def record(self, address, reading, timestamp=None):
+        """
+        Store a VitalsReading.
+
+        Parameters:
+            address (str): The watch address.
+            reading (VitalsReading): The decoded reading.
+            timestamp (float): Unix time of the reading, defaults to now.
+        """
+        worn = MISSING if reading.watch_status is None else int(reading.watch_status == "Worn")
+        row = [MISSING if value is None else value for value in
+               (reading.heart_rate, reading.systolic, reading.diastolic, reading.spo2,
+                reading.glucose, reading.battery_level)]
+        row.append(worn)
+        self._series(address).append(time.time() if timestamp is None else timestamp, row)
+
+    def addresses(self):
+        with self._lock:
+            return list(self.series)
+
+    def get(self, address):
+        return self.series.get(address)
+
+# Store shared by every watch on this gateway
+default_store = TimeSeriesStore()
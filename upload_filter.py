@@ -0,0 +1,79 @@
+
+# upload_filter.py
+
+import threading
+import time
+
+# Payload fields that describe the reading; everything else identifies the watch
+VALUE_FIELDS = ("heart_rate", "blood_pressure", "spo2", "blood_glucose", "watch_battery", "watch_status")
+
+class UploadFilter:
+    """
+    Decides, per watch, whether a vitals payload needs to be uploaded at all.
+
+    A payload whose values equal the last one sent for the same watch is suppressed
+    until heartbeat_interval seconds have passed, after which a full payload is sent
+    anyway to prove the watch is still alive. With send_deltas, a changed reading is
+    sent with only the values that differ from the last state the backend
+    acknowledged, marked with "delta": True; heartbeats are always full payloads so
+    the backend can resynchronise. Delta encoding needs backend support and is off by
+    default.
+
+    Parameters:
+        heartbeat_interval (float): Longest time between two uploads for one watch.
+        send_deltas (bool): Send changed readings as deltas against the acked state.
+    """
+
+    def __init__(self, heartbeat_interval=300.0, send_deltas=False):
+        self.heartbeat_interval = heartbeat_interval
+        self.send_deltas = send_deltas
+        self.suppressed = 0
+        self._last_sent = {}  # address -> (values, monotonic time of the upload)
+        self._acked = {}  # address -> values the backend has acknowledged
+        self._lock = threading.Lock()  # acknowledge() runs on the uploader threads
+
+    def filter(self, payload, now=None):
+        """
+        Parameters:
+            payload (dict): Full vitals payload built by back.build_vitals_payload.
+            now (float): Monotonic time, defaults to time.monotonic().
+
+        Returns:
+            dict | None: The payload to upload (full or delta), or None to suppress it.
+        """
+        now = time.monotonic() if now is None else now
+        address = payload["smartwatch_mac_address"]
+        values = tuple(payload.get(field) for field in VALUE_FIELDS)
+        with self._lock:
+            last = self._last_sent.get(address)
+            heartbeat_due = last is None or now - last[1] >= self.heartbeat_interval
+            if not heartbeat_due and values == last[0]:
+                self.suppressed += 1
+                return None
+            self._last_sent[address] = (values, now)
+            acked = self._acked.get(address)
+        if heartbeat_due or not self.send_deltas or acked is None:
+            return payload
+        delta = {key: value for key, value in payload.items() if key not in VALUE_FIELDS}
+        for field, value, acked_value in zip(VALUE_FIELDS, values, acked):
+            if value != acked_value:
+                delta[field] = value
+        delta["delta"] = True
+        return delta
+
+    def acknowledge(self, payload):
+        """Record a payload the backend accepted as the new base for deltas."""
+        address = payload.get("smartwatch_mac_address")
+        with self._lock:
+            if payload.get("delta"):
+                acked = self._acked.get(address)
+                if acked is None:
+                    return
+                self._acked[address] = tuple(payload.get(field, value) for field, value in zip(VALUE_FIELDS, acked))
+            else:
+                self._acked[address] = tuple(payload.get(field) for field in VALUE_FIELDS)
+
+    def forget(self, address):
+        with self._lock:
+            self._last_sent.pop(address, None)
+            self._acked.pop(address, None)
@@ -0,0 +1,207 @@
+
+# uploader.py
+
+import json
+import queue
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+import logs
+
+# Default timeouts for backend requests: (connect, read) in seconds
+DEFAULT_TIMEOUT = (3.05, 10)
+HEADERS = {"Content-Type": "application/json"}
+
+log = logs.get_logger("uploader")
+
+def make_session(pool_size=10):
+    """
+    Create a requests session that keeps connections to the backend alive.
+
+    Parameters:
+        pool_size (int): Number of connections kept open per host.
+
+    Returns:
+        requests.Session: The pooled session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    session.verify = False
+    return session
+
+class VitalsUploader:
+    """
+    Background uploader for backend payloads (vitals, or alerts with a second instance).
+
+    submit() only puts the payload on a bounded queue and returns immediately, so
+    it is safe to call from a bleak notification callback. Worker threads drain the
+    queue in batches (up to batch_size payloads or batch_interval seconds, whichever
+    comes first) and post them over a keep-alive session. When batch_endpoint is
+    True a batch is posted as one JSON array; otherwise its payloads are posted
+    back-to-back on the same connection.
+    """
+
+    def __init__(self, url, max_queue=1000, batch_size=20, batch_interval=0.5, workers=2,
+                 timeout=DEFAULT_TIMEOUT, batch_endpoint=False, on_sent=None, on_failed=None, name="vitals"):
+        self.url = url
+        self.name = name
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.workers = workers
+        self.timeout = timeout
+        self.batch_endpoint = batch_endpoint
+        self.on_sent = on_sent  # Called with (payload, key) once the backend accepted a payload
+        self.on_failed = on_failed  # Called with the (key, payload) items of a failed batch
+        self.labels = (name,)  # Metric labels
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.stats = {"submitted": 0, "sent": 0, "failed": 0, "dropped": 0, "batches": 0}
+        self._stats_lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+
+    def start(self):
+        if self._threads:
+            return self
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-uploader-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Stop the workers after they have flushed what is already queued."""
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, payload, key=None, received_at=None):
+        """
+        Queue a payload for upload without blocking.
+
+        Parameters:
+            payload (dict): The JSON payload to post.
+            key (str): Idempotency key sent in the Idempotency-Key header, if any.
+            received_at (float): time.monotonic() of the notification the payload came
+                from, for the end-to-end latency metric; defaults to now.
+
+        Returns:
+            bool: True if queued, False if the queue was full and the oldest payload
+            had to be dropped to make room.
+        """
+        queued = True
+        item = (key, payload, time.monotonic() if received_at is None else received_at)
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                break
+            except queue.Full:
+                # Drop the oldest reading: a fresh one is worth more than a stale one
+                try:
+                    self.queue.get_nowait()
+                    self._count("dropped")
+                    metrics.upload_dropped.inc(self.labels)
+                    queued = False
+                except queue.Empty:
+                    pass
+        self._count("submitted")
+        return queued
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.batch_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        session = make_session()
+        try:
+            while not (self._stopping.is_set() and self.queue.empty()):
+                batch = self._next_batch()
+                if batch:
+                    self._send_batch(session, batch)
+        finally:
+            session.close()
+
+    def _post(self, session, body, keys):
+        headers = {"Idempotency-Key": ",".join(keys)} if keys else None
+        start = time.perf_counter()
+        try:
+            response = session.post(self.url, data=json.dumps(body), headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.backend_post_failures.inc(self.labels + ("error",))
+            log.warning("Error sending %s: %s", self.name, e)
+            return False
+        finally:
+            metrics.backend_post_seconds.observe(time.perf_counter() - start, self.labels)
+        if response.status_code in [200, 201]:
+            return True
+        metrics.backend_post_failures.inc(self.labels + ("status",))
+        log.warning("Failed to send %s. Status: %s, Response: %s", self.name, response.status_code, response.text)
+        return False
+
+    def _send_batch(self, session, batch):
+        self._count("batches")
+        if self.batch_endpoint:
+            keys = [key for key, _, _ in batch if key]
+            results = [self._post(session, [payload for _, payload, _ in batch], keys)] * len(batch)
+        else:
+            results = [self._post(session, payload, [key] if key else None) for key, payload, _ in batch]
+
+        failed = []
+        for (key, payload, received_at), ok in zip(batch, results):
+            if ok:
+                self._count("sent")
+                metrics.notification_to_upload_seconds.observe(time.monotonic() - received_at, self.labels)
+                if self.on_sent:
+                    self.on_sent(payload, key)
+            else:
+                self._count("failed")
+                failed.append((key, payload))
+        if failed and self.on_failed:
+            self.on_failed(failed)
+
+# Throughput check against the local stand-in backend
+def benchmark(count=2000, **uploader_options):
+    from standin_backend import StandinBackend
+
+    with StandinBackend() as backend:
+        uploader = VitalsUploader(backend.url("/vitals"), max_queue=count, **uploader_options).start()
+        start = time.perf_counter()
+        for i in range(count):
+            uploader.submit({"heart_rate": 70 + i % 20, "smartwatch_mac_address": "00:00:00:00:00:01"})
+        enqueue_elapsed = time.perf_counter() - start
+        uploader.stop(timeout=60)
+        elapsed = time.perf_counter() - start
+    return {
+        "payloads": count,
+        "enqueue_us_per_payload": enqueue_elapsed / count * 1e6,
+        "payloads_per_second": uploader.stats["sent"] / elapsed,
+        "stats": uploader.stats,
+    }
+
+if __name__ == "__main__":
+    print(benchmark())
@@ -0,0 +1,161 @@
+
+# watch_cache.py
+#
+# What each watch was last configured with, so a watch that drops out of range for a
+# moment can reconnect without repeating the whole handshake. A watch that rebooted
+# also drops its link and is usually back within seconds, with its settings lost, so
+# cached settings are always confirmed with one current-data poll before they are used.
+
+import time
+import logs
+import metrics
+
+log = logs.get_logger("watch_cache")
+
+# Handshake modes of a connection
+FULL = "full"  # Every step sent
+VERIFIED = "verified"  # Acknowledged steps skipped after one current-data poll confirmed them
+
+# A watch back within this many seconds of its last session may skip the steps it
+# acknowledged, once one current-data poll shows it is still configured
+VERIFY_WITHIN = 600.0
+
+connect_to_first_reading_seconds = metrics.Histogram(
+    "gateway_connect_to_first_reading_seconds",
+    "Time from the start of a connection attempt to the first valid reading, by handshake mode.", ("handshake",))
+handshakes = metrics.Counter(
+    "gateway_handshakes_total", "Connections by handshake mode.", ("handshake",))
+
+class WatchConfig:
+    """Cached configuration state of one watch."""
+
+    __slots__ = ("address", "steps", "confirmed", "connecting_at", "disconnected_at", "mode", "sessions",
+                 "first_reading_seconds")
+
+    def __init__(self, address):
+        self.address = address
+        self.steps = {}  # Step name -> (command bytes, monotonic time it was acknowledged)
+        self.confirmed = False  # A valid reading arrived after the steps were applied
+        self.connecting_at = None
+        self.disconnected_at = None
+        self.mode = None
+        self.sessions = 0
+        self.first_reading_seconds = None
+
+    def as_dict(self):
+        now = time.monotonic()
+        return {
+            "address": self.address,
+            "steps": {name: round(now - applied_at, 1) for name, (_, applied_at) in self.steps.items()},
+            "confirmed": self.confirmed,
+            "seconds_since_disconnect": None if self.disconnected_at is None else round(now - self.disconnected_at, 1),
+            "last_handshake": self.mode,
+            "sessions": self.sessions,
+            "first_reading_seconds": self.first_reading_seconds,
+        }
+
+class WatchConfigCache:
+    """
+    Last applied handshake settings of every watch, with when they were applied.
+
+    A watch's steps are only trusted after a session that produced a valid reading
+    ended less than verify_within seconds ago, and only for steps whose command is
+    unchanged. Steps that failed or changed are always sent again, and a watch whose
+    verification poll fails is invalidated, so it gets every step.
+
+    Parameters:
+        verify_within (float): Seconds after a disconnect during which trusted steps are
+            skipped once a current-data poll shows the watch is still configured.
+    """
+
+    def __init__(self, verify_within=VERIFY_WITHIN):
+        self.verify_within = verify_within
+        self.watches = {}
+
+    def _entry(self, address):
+        entry = self.watches.get(address)
+        if entry is None:
+            entry = self.watches[address] = WatchConfig(address)
+        return entry
+
+    def plan(self, address, steps, now=None):
+        """
+        Decide how much of the handshake a new connection needs.
+
+        Parameters:
+            address (str): The watch address.
+            steps (list): (name, command bytes) of every handshake step.
+            now (float): Current monotonic time.
+
+        Returns:
+            tuple: (mode, names of the steps to send). For VERIFIED, the caller
+            confirms with a poll first, and invalidates the watch and sends every
+            step if that fails.
+        """
+        entry = self.watches.get(address)
+        now = time.monotonic() if now is None else now
+        if entry is None or not entry.confirmed or entry.disconnected_at is None:
+            return FULL, [name for name, _ in steps]
+        if now - entry.disconnected_at <= self.verify_within:
+            return VERIFIED, [name for name, command in steps if entry.steps.get(name, (None,))[0] != command]
+        return FULL, [name for name, _ in steps]
+
+    def connecting(self, address, now=None):
+        """
+        Start the connect-to-first-reading clock, unless an earlier attempt that has
+        not connected yet already started it.
+        """
+        entry = self._entry(address)
+        if entry.connecting_at is None:
+            entry.connecting_at = time.monotonic() if now is None else now
+
+    def handshake_done(self, address, mode):
+        entry = self._entry(address)
+        entry.mode = mode
+        entry.confirmed = False
+        entry.sessions += 1
+        handshakes.inc((mode,))
+
+    def step_applied(self, address, name, command, ok):
+        entry = self._entry(address)
+        if ok:
+            entry.steps[name] = (command, time.monotonic())
+        else:
+            entry.steps.pop(name, None)
+
+    def first_reading(self, address):
+        """
+        Record the first valid reading of a connection.
+
+        Returns:
+            float | None: Seconds since connecting() was called for the watch.
+        """
+        entry = self.watches.get(address)
+        if entry is None or entry.connecting_at is None:
+            return None
+        entry.confirmed = True
+        elapsed = entry.first_reading_seconds = round(time.monotonic() - entry.connecting_at, 3)
+        entry.connecting_at = None
+        connect_to_first_reading_seconds.observe(elapsed, (entry.mode or FULL,))
+        log.info("First reading %.2fs after connecting (%s handshake)", elapsed, entry.mode or FULL,
+                 extra={"device": address})
+        return elapsed
+
+    def disconnected(self, address):
+        entry = self.watches.get(address)
+        if entry is not None:
+            entry.disconnected_at = time.monotonic()
+            entry.connecting_at = None
+
+    def invalidate(self, address):
+        """Forget a watch's steps, so its next connection sends them all."""
+        entry = self.watches.get(address)
+        if entry is not None:
+            entry.steps.clear()
+            entry.confirmed = False
+
+    def snapshot(self):
+        return [entry.as_dict() for entry in list(self.watches.values())]
+
+# Cache shared by every connection on this gateway
+default_cache = WatchConfigCache()